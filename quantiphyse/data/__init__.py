@@ -8,6 +8,11 @@ from .qpdata import DataGrid, OrthoSlice, QpData, NumpyData
 from .volume_management import ImageVolumeManagement
 from .load_save import load, save
 from .nifti import NiftiData
+from .session import save_session, load_session
+from .concat import ConcatData
+from .views import CropData, VolumeSubsetData
+from .voxels import VoxelTable
 
 __all__ = ["DataGrid", "OrthoSlice", "QpData", "ImageVolumeManagement", 
-           "NiftiData", "NumpyData", "load", "save"]
+           "NiftiData", "NumpyData", "ConcatData",
+           "CropData", "VolumeSubsetData", "VoxelTable", "load", "save", "save_session", "load_session"]
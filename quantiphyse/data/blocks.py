@@ -0,0 +1,143 @@
+"""
+Quantiphyse - Block-wise processing of data which may not fit in memory
+
+Data is processed as a sequence of blocks (e.g. volumes or slabs of slices) so
+that only a bounded amount of data is held in memory at any one time. Blocks are
+obtained using :meth:`QpData.blocks` and :meth:`QpData.map_blocks`. This module
+contains the block class and helpers for accumulating statistics over blocks.
+
+Copyright (c) 2013-2018 University of Oxford
+"""
+
+from __future__ import division
+
+import numpy as np
+
+# Approximate maximum number of values in a block when the block size is chosen
+# automatically
+BLOCK_VALUES = 16 * 1024 * 1024
+
+# Number of bins used in the first pass of the percentile calculation
+PERCENTILE_BINS = 4096
+
+class DataBlock(object):
+    """
+    Block of data returned by :meth:`QpData.blocks`
+
+    :ivar data: Numpy array containing the block data, including any halo
+    :ivar slices: Tuple of indices giving the position of the block, excluding
+                  the halo, within the full data array
+    :ivar inner: Tuple of slices selecting the block excluding the halo from ``data``
+    :ivar vol: Volume index if the block contains a single volume, otherwise None
+    """
+    def __init__(self, data, slices, inner, vol=None):
+        self.data = data
+        self.slices = tuple(slices)
+        self.inner = tuple(inner)
+        self.vol = vol
+
+    @property
+    def core(self):
+        """ Block data excluding the halo """
+        return self.data[self.inner]
+
+class RunningStats(object):
+    """
+    Summary statistics accumulated over a sequence of arrays
+
+    Uses the pairwise update of Chan et al so the standard deviation is accurate
+    even when the mean is large compared to the variance.
+
+    :ivar n: Number of values
+    :ivar mean: Mean of values
+    :ivar min: Minimum value or None if no values
+    :ivar max: Maximum value or None if no values
+    """
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.min, self.max = None, None
+        self._m2 = 0.0
+
+    @property
+    def std(self):
+        """ Population standard deviation, as returned by ``np.std`` """
+        if self.n == 0:
+            return 0.0
+        return np.sqrt(self._m2 / self.n)
+
+    def update(self, arr):
+        """
+        Add values to the statistics
+
+        :param arr: Numpy array of values of any shape
+        """
+        arr = np.asarray(arr)
+        if arr.size == 0:
+            return
+
+        n = arr.size
+        mean = np.mean(arr, dtype=np.float64)
+        m2 = np.sum(np.square(arr - mean, dtype=np.float64))
+        delta = mean - self.mean
+        total = self.n + n
+        self._m2 += m2 + delta * delta * self.n * n / total
+        self.mean += delta * n / total
+        self.n = total
+
+        mn, mx = np.min(arr), np.max(arr)
+        if self.min is None or mn < self.min:
+            self.min = mn
+        if self.max is None or mx > self.max:
+            self.max = mx
+
+def percentile(arrays, q):
+    """
+    Calculate a percentile of values spread over a sequence of arrays
+
+    The result is the same as ``np.percentile`` applied to all the values, but
+    only one array is needed in memory at a time. The arrays are iterated over
+    three times - first to find the range, then to build a histogram and finally
+    to extract the values in the histogram bins containing the percentile.
+
+    :param arrays: Callable which returns a new iterator over Numpy arrays
+                   each time it is called
+    :param q: Percentile in range 0-100
+    :return: Percentile value, or None if there are no values
+    """
+    stats = RunningStats()
+    for arr in arrays():
+        stats.update(arr)
+    if stats.n == 0:
+        return None
+    elif np.isnan(stats.mean):
+        return np.nan
+    elif stats.min == stats.max:
+        return stats.min
+
+    # Ranks of the values which the percentile is interpolated between
+    pos = float(q) / 100 * (stats.n - 1)
+    ranks = [int(np.floor(pos)), int(np.ceil(pos))]
+
+    def _bin(arr):
+        scaled = (np.asarray(arr, dtype=np.float64).ravel() - stats.min) / (float(stats.max) - stats.min)
+        return np.clip((scaled * PERCENTILE_BINS).astype(np.int64), 0, PERCENTILE_BINS-1)
+
+    counts = np.zeros(PERCENTILE_BINS, dtype=np.int64)
+    for arr in arrays():
+        counts += np.bincount(_bin(arr), minlength=PERCENTILE_BINS)
+    cumulative = np.cumsum(counts)
+    bins = [int(np.searchsorted(cumulative, rank, side="right")) for rank in ranks]
+
+    bin_values = dict([(b, []) for b in bins])
+    for arr in arrays():
+        arr = np.asarray(arr).ravel()
+        arr_bins = _bin(arr)
+        for b in bin_values:
+            bin_values[b].append(arr[arr_bins == b])
+
+    values = []
+    for b, rank in zip(bins, ranks):
+        first_rank = cumulative[b] - counts[b]
+        values.append(np.sort(np.concatenate(bin_values[b]))[rank - first_rank])
+    return values[0] + (values[1] - values[0]) * (pos - ranks[0])
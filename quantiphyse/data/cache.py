@@ -0,0 +1,151 @@
+"""
+Quantiphyse - Memory-bounded caches for data derived from QpData instances
+
+Copyright (c) 2013-2018 University of Oxford
+"""
+
+import collections
+import threading
+
+import numpy as np
+
+def sizeof(obj):
+    """
+    Estimate the memory used by a cached object
+
+    Numpy arrays and (possibly nested) sequences of arrays are counted. Memory
+    mapped arrays are not counted as they are not resident in memory. Other
+    objects are counted if they have an ``nbytes`` attribute, otherwise they
+    are treated as negligible.
+
+    :return: Approximate size in bytes
+    """
+    if isinstance(obj, np.memmap):
+        return 0
+    elif isinstance(obj, (list, tuple)):
+        return sum([sizeof(item) for item in obj])
+    else:
+        return getattr(obj, "nbytes", 0)
+
+class LruCache(object):
+    """
+    Least-recently-used cache with a limit on the total size of the cached items
+
+    When adding an item would take the cache over its size limit, the least recently
+    used items are discarded. Items which are bigger than the whole limit are never
+    cached. The cache is thread-safe so it can be filled from background threads.
+
+    :ivar name: Name of the cache, used for reporting only
+    :ivar max_bytes: Size limit in bytes
+    :ivar nbytes: Current total size of cached items in bytes
+    :ivar hits: Number of lookups which found the requested item
+    :ivar misses: Number of lookups which did not find the requested item
+    """
+
+    def __init__(self, max_bytes, name="cache"):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = collections.OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        """ Check if an item is cached without affecting the LRU order or hit counters """
+        return key in self._items
+
+    def get(self, key, default=None):
+        """
+        Look up a cached item, marking it as most recently used
+
+        :param key: Hashable key
+        :param default: Value to return if the item is not cached
+        """
+        with self._lock:
+            if key in self._items:
+                entry = self._items.pop(key)
+                self._items[key] = entry
+                self.hits += 1
+                return entry[0]
+            else:
+                self.misses += 1
+                return default
+
+    def put(self, key, value, nbytes=None):
+        """
+        Add an item to the cache, replacing any existing item with the same key
+
+        :param key: Hashable key
+        :param value: Object to cache
+        :param nbytes: Size of the object in bytes. If not given, estimated using ``sizeof``
+        """
+        if nbytes is None:
+            nbytes = sizeof(value)
+        with self._lock:
+            self._remove(key)
+            if nbytes <= self.max_bytes:
+                self._items[key] = (value, nbytes)
+                self.nbytes += nbytes
+                self._shrink(self.max_bytes)
+
+    def remove(self, key):
+        """
+        Remove an item from the cache if it is present
+        """
+        with self._lock:
+            self._remove(key)
+
+    def remove_if(self, predicate):
+        """
+        Remove all items whose key satisfies a condition
+
+        :param predicate: Callable taking a key and returning True if the item should be removed
+        """
+        with self._lock:
+            for key in [key for key in self._items if predicate(key)]:
+                self._remove(key)
+
+    def clear(self):
+        """
+        Remove all items from the cache. Hit and miss counters are not reset
+        """
+        with self._lock:
+            self._items.clear()
+            self.nbytes = 0
+
+    def resize(self, max_bytes):
+        """
+        Change the size limit, discarding items if required
+
+        :param max_bytes: New size limit in bytes
+        """
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._shrink(max_bytes)
+
+    def stats(self):
+        """
+        :return: Dictionary of cache statistics: ``items``, ``nbytes``, ``max_bytes``,
+                 ``hits`` and ``misses``
+        """
+        return {
+            "items" : len(self._items),
+            "nbytes" : self.nbytes,
+            "max_bytes" : self.max_bytes,
+            "hits" : self.hits,
+            "misses" : self.misses,
+        }
+
+    def _remove(self, key):
+        entry = self._items.pop(key, None)
+        if entry is not None:
+            self.nbytes -= entry[1]
+
+    def _shrink(self, max_bytes):
+        while self.nbytes > max_bytes:
+            _, (_, nbytes) = self._items.popitem(last=False)
+            self.nbytes -= nbytes
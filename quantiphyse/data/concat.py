@@ -0,0 +1,139 @@
+"""
+Quantiphyse - Virtual concatenation of data items into a single multi-volume data set
+
+Copyright (c) 2013-2018 University of Oxford
+"""
+from __future__ import division, print_function
+
+import logging
+
+import numpy as np
+
+from quantiphyse.utils import QpException
+from .qpdata import QpData, NumpyData, RESAMPLE_CACHE, resample_array, working_dtype
+from .cache import sizeof
+
+LOG = logging.getLogger(__name__)
+
+class ConcatData(QpData):
+    """
+    Multi-volume data formed by concatenating the volumes of several data items
+
+    No concatenated array is created unless ``raw()`` is called. Volumes and blocks are
+    read from the source items when required, and items which are not defined on the
+    output grid are resampled one volume at a time. Resampled volumes are stored in
+    ``RESAMPLE_CACHE`` under the source item's key, so they are discarded when the
+    source item is modified.
+
+    The source items should not be modified while this data is in use as data derived
+    from it, e.g. the data range, is not updated.
+    """
+    def __init__(self, items, grid=None, name="multi_data", order=0, **kwargs):
+        """
+        :param items: Sequence of QpData items
+        :param grid: DataGrid for the output. Defaults to the grid of the first item
+        :param name: Data name
+        :param order: Interpolation order used when resampling items onto the grid
+        """
+        if not items:
+            raise QpException("No data items to concatenate")
+        if grid is None:
+            grid = items[0].grid
+
+        self.items = list(items)
+        self.order = order
+        self.rawdata = None
+
+        # Source item and volume within that item for each output volume
+        self._sources = []
+        for item in self.items:
+            self._sources += [(item, vol) for vol in range(item.nvols)]
+
+        QpData.__init__(self, name, grid, len(self._sources), **kwargs)
+
+    def __getstate__(self):
+        # The concatenated array can be regenerated from the items
+        state = QpData.__getstate__(self)
+        state["rawdata"] = None
+        return state
+
+    @property
+    def memory_usage(self):
+        return sizeof(self.rawdata)
+
+    def raw(self):
+        if self.rawdata is None:
+            LOG.debug("Creating concatenated data for %s", self.name)
+            shape = list(self.grid.shape)
+            if self.nvols > 1:
+                shape.append(self.nvols)
+            rawdata = np.zeros(shape, dtype=working_dtype())
+            for vol in range(self.nvols):
+                rawdata[self._block_index([slice(None)] * 3, vol)] = self.volume(vol)
+            self.rawdata = rawdata
+        return self.rawdata
+
+    def volume(self, vol, qpdata=False):
+        vol = min(vol, self.nvols-1)
+        if self.rawdata is not None:
+            voldata = self.rawdata[self._block_index([slice(None)] * 3, vol)]
+        else:
+            item, item_vol = self._sources[vol]
+            voldata = self._item_volume(item, item_vol)
+
+        if qpdata:
+            return NumpyData(voldata, grid=self.grid, name="%s_vol_%i" % (self.name, vol))
+        else:
+            return voldata
+
+    def uncache(self):
+        QpData.uncache(self)
+        self.rawdata = None
+
+    def _item_volume(self, item, vol):
+        """
+        :return: Volume of a source item on the output grid
+        """
+        if item.grid.matches(self.grid):
+            return item.volume(vol)
+
+        cache_key = (item.uid, item.version, item.grid.key(), self.grid.key(), self.order, item.roi, "volume", vol)
+        voldata = RESAMPLE_CACHE.get(cache_key)
+        if voldata is None:
+            LOG.debug("Resampling volume %i of %s", vol, item.name)
+            voldata = resample_array(item.volume(vol), item.grid, self.grid, self.order, item.roi)
+            voldata.flags.writeable = False
+            RESAMPLE_CACHE.put(cache_key, voldata)
+        return voldata
+
+    def _read_block(self, index):
+        if self.rawdata is not None:
+            return QpData._read_block(self, index)
+
+        spatial = tuple(index[:3])
+        if self.nvols == 1:
+            vols = 0
+        else:
+            vols = index[3] if len(index) > 3 else slice(None)
+
+        if isinstance(vols, (int, np.integer)):
+            return self._read_volume_block(vols, spatial)
+
+        vols = range(self.nvols)[vols]
+        block = None
+        for idx, vol in enumerate(vols):
+            voldata = self._read_volume_block(vol, spatial)
+            if block is None:
+                block = np.zeros(list(voldata.shape) + [len(vols)], dtype=working_dtype())
+            block[..., idx] = voldata
+        return block
+
+    def _read_volume_block(self, vol, spatial):
+        """
+        :return: Part of a single volume, read from the source item without loading all of it if possible
+        """
+        item, item_vol = self._sources[vol]
+        if item.grid.matches(self.grid):
+            return item._read_block(item._block_index(spatial, item_vol))
+        else:
+            return self._item_volume(item, item_vol)[spatial]
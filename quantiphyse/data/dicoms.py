@@ -5,133 +5,367 @@ Copyright (c) 2013-2018 University of Oxford
 """
 from __future__ import division, print_function
 
-import sys
 import os
 import warnings
 import glob
 import logging
+import json
+import hashlib
+import tempfile
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
 
-import nibabel as nib
+HAVE_PYDICOM = True
+try:
+    import pydicom as dicom
+except ImportError:
+    try:
+        import dicom
+    except ImportError:
+        HAVE_PYDICOM = False
 
 HAVE_DCMSTACK = True
 try:
     import dcmstack
-    import dicom
 except ImportError:
     HAVE_DCMSTACK = False
     warnings.warn("DCMSTACK not found - may not be able to read DICOM folders")
 
 from quantiphyse.utils import QpException
-from .qpdata import DataGrid, QpData, NumpyData
+from .qpdata import DataGrid, QpData, working_dtype
+from .cache import sizeof
 
 LOG = logging.getLogger(__name__)
 
+#: Number of threads used to read DICOM files. Reading is mostly limited by file
+#: access, so this can be more than the number of processors
+DICOM_THREADS = 8
+
+#: Name of the file in a DICOM folder used to cache the series index, so the
+#: file headers do not need to be read again when the folder is reloaded
+INDEX_FNAME = ".qp_dicom_index.json"
+
+#: Version of the index file format
+INDEX_VERSION = 1
+
+def _read_file(fname, header_only=False):
+    if hasattr(dicom, "dcmread"):
+        return dicom.dcmread(fname, stop_before_pixels=header_only)
+    else:
+        return dicom.read_file(fname, stop_before_pixels=header_only)
+
+def _scan_file(fname):
+    """
+    Read the information needed to place a DICOM file in a series
+
+    :return: Tuple of series UID, slice location, instance number, file name or
+             None if the file is not a DICOM image file
+    """
+    try:
+        hdr = _read_file(fname, header_only=True)
+        return (getattr(hdr, "SeriesInstanceUID", None), float(hdr.SliceLocation),
+                int(getattr(hdr, "InstanceNumber", 0)), fname)
+    except Exception:
+        return None
+
+def _map(func, items, progress_cb=None):
+    """
+    Apply a function to items using a pool of threads
+
+    :param progress_cb: Optional callable taking the fraction of items completed
+    :return: List of results in the same order as the items
+    """
+    results = [None] * len(items)
+    pool = ThreadPool(DICOM_THREADS)
+    try:
+        percent = -1
+        for done, (idx, result) in enumerate(pool.imap_unordered(lambda idx: (idx, func(items[idx])), range(len(items)), chunksize=8)):
+            results[idx] = result
+            if progress_cb is not None and int(100 * (done + 1) / len(items)) != percent:
+                percent = int(100 * (done + 1) / len(items))
+                progress_cb(float(done + 1) / len(items))
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+class DicomSeries(object):
+    """
+    Set of DICOM files forming a 3D or 4D image
+
+    The volume sequence is determined using the InstanceNumber tag and slices are
+    put together into volumes using the SliceLocation tag.
+
+    :ivar fnames: File names, ordered with slice varying fastest and then volume
+    :ivar shape: 4D shape of the image
+    :ivar affine: Affine transformation from voxel co-ordinates to world space
+    :ivar scaling: Tuple of rescale slope, rescale intercept and scale slope. Pixel
+                   values are scaled as ``(value * slope + intercept) / scale``
+    """
+
+    def __init__(self, fnames, shape, affine, scaling=(1, 0, 1)):
+        self.fnames = list(fnames)
+        self.shape = list(shape)
+        self.affine = np.array(affine)
+        self.scaling = tuple(scaling)
+
+    @classmethod
+    def scan(cls, fnames, progress_cb=None):
+        """
+        Find the series in a set of files by reading only their headers
+
+        Files which are not DICOM image files are ignored, as are series whose files 
+        cannot be put together into a 3D or 4D image.
+
+        :param fnames: Sequence of file names
+        :param progress_cb: Optional callable taking the fraction of files scanned
+        :return: Dictionary of series UID : DicomSeries instance
+        """
+        files = {}
+        scanned = _map(_scan_file, list(fnames), progress_cb)
+        for info in scanned:
+            if info is not None:
+                files.setdefault(info[0], []).append(info[1:])
+        if not files:
+            raise QpException("This doesn't seem to be a DICOM folder")
+        LOG.debug("Ignored (non-DICOM) files: %i", scanned.count(None))
+
+        series, errors = {}, {}
+        for uid, series_files in files.items():
+            try:
+                series[uid] = cls._from_files(series_files)
+            except QpException as exc:
+                LOG.warn("Could not parse DICOM series %s: %s", uid, str(exc))
+                errors[uid] = exc
+        if not series:
+            raise errors[max(files, key=lambda uid: len(files[uid]))]
+        return series
+
+    @classmethod
+    def _from_files(cls, files):
+        """
+        :param files: Sequence of tuples of slice location, instance number, file name
+                      for all the files in a series
+        """
+        # Index files by slice location, each slice location gives a sequence of volumes
+        slices = {}
+        for slice_loc, instance, fname in files:
+            slices.setdefault(slice_loc, []).append((instance, fname))
+        locations = sorted(slices.keys())
+        n_vols = len(slices[locations[0]])
+        if any([len(slices[loc]) != n_vols for loc in locations]):
+            raise QpException("Could not parse DICOMS - unable to determine fixed number of volumes")
+        for loc in locations:
+            slices[loc].sort()
+        ordered = [slices[loc][vol][1] for vol in range(n_vols) for loc in locations]
+        LOG.debug("%i Volumes", n_vols)
+        LOG.debug("Slice locations are: %s", ", ".join([str(loc) for loc in locations]))
+
+        import nibabel.nicom.dicomwrappers as nib_dcm
+        hdr = _read_file(ordered[0], header_only=True)
+        wrapper = nib_dcm.wrapper_from_data(hdr)
+        shape = list(wrapper.image_shape[:2]) + [len(locations), n_vols]
+        scaling = (1, 0, 1)
+        try:
+            # Need all three of these to be of use
+            scaling = (hdr[0x2005, 0x140a].value, hdr[0x2005, 0x1409].value, hdr[0x2005, 0x100e].value)
+        except KeyError:
+            pass
+        LOG.debug("RescaleSlope: %s, RescaleIntercept: %s, ScaleSlope: %s", *scaling)
+        if hasattr(wrapper, "affine"):
+            affine = wrapper.affine
+        else:
+            # Older versions of nibabel
+            affine = wrapper.get_affine()
+        return cls(ordered, shape, affine, [float(val) for val in scaling])
+
+    @staticmethod
+    def largest(series):
+        """
+        :param series: Dictionary of series UID : DicomSeries as returned by ``scan``
+        :return: DicomSeries instance with the most files
+        """
+        uid = max(series, key=lambda uid: len(series[uid].fnames))
+        if len(series) > 1:
+            LOG.warn("Found %i DICOM series - using series %s with %i files", len(series), uid, len(series[uid].fnames))
+        return series[uid]
+
+    def to_dict(self, dirname):
+        """
+        :param dirname: Directory containing the files. File names are stored relative to it
+        :return: Dictionary describing the series which can be serialized as JSON
+        """
+        return {
+            "fnames" : [os.path.relpath(fname, dirname) for fname in self.fnames],
+            "shape" : self.shape,
+            "affine" : self.affine.tolist(),
+            "scaling" : list(self.scaling),
+        }
+
+    @classmethod
+    def from_dict(cls, desc, dirname):
+        """
+        Create a series from a dictionary returned by ``to_dict``
+
+        :param desc: Dictionary
+        :param dirname: Directory containing the files
+        """
+        return cls([os.path.join(dirname, fname) for fname in desc["fnames"]],
+                   desc["shape"], desc["affine"], desc["scaling"])
+
+    def read_data(self, progress_cb=None):
+        """
+        Read the pixel data of the series
+
+        Files are decoded in parallel straight into the output array
+
+        :param progress_cb: Optional callable taking the fraction of files read
+        :return: 4D Numpy array with the working data type
+        """
+        data = np.zeros(self.shape, dtype=working_dtype())
+        slope, intercept, scale = self.scaling
+        n_slices = self.shape[2]
+
+        def _read_slice(idx):
+            pixels = np.squeeze(_read_file(self.fnames[idx]).pixel_array)
+            if list(pixels.shape) != self.shape[:2]:
+                raise QpException("DICOM file %s has shape %s - expected %s" % (self.fnames[idx], pixels.shape, self.shape[:2]))
+            data[:, :, idx % n_slices, idx // n_slices] = (pixels * slope + intercept) / scale
+
+        _map(_read_slice, list(range(len(self.fnames))), progress_cb)
+        return data
+
+def _file_stats(dirname, fnames):
+    """
+    :return: Dictionary of file name relative to ``dirname`` : [size, modification time]
+    """
+    stats = {}
+    for fname in fnames:
+        stat = os.stat(fname)
+        stats[os.path.relpath(fname, dirname)] = [stat.st_size, stat.st_mtime]
+    return stats
+
+def _index_fnames(dirname):
+    """
+    :return: Possible locations for the index of a DICOM folder. The index is stored in
+             the folder itself if possible, otherwise in the temporary directory
+    """
+    dirname = os.path.abspath(dirname)
+    key = hashlib.md5(dirname.encode("utf-8")).hexdigest()
+    return [os.path.join(dirname, INDEX_FNAME), 
+            os.path.join(tempfile.gettempdir(), "qp_dicom_index_%s.json" % key)]
+
+def load_index(dirname, stats):
+    """
+    Load the cached series index for a DICOM folder
+
+    :param dirname: DICOM folder
+    :param stats: Current file sizes and modification times as returned by ``_file_stats``
+    :return: Dictionary of series UID : DicomSeries, or None if there is no index or the
+             files have changed since it was saved
+    """
+    for fname in _index_fnames(dirname):
+        try:
+            with open(fname, "r") as index_file:
+                index = json.load(index_file)
+            if index.get("version", None) == INDEX_VERSION and index["files"] == stats:
+                LOG.debug("Using DICOM index in %s", fname)
+                return dict([(uid, DicomSeries.from_dict(desc, dirname)) for uid, desc in index["series"].items()])
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+    return None
+
+def save_index(dirname, stats, series):
+    """
+    Save the series index for a DICOM folder
+
+    Failure to save the index is not an error as it is only used to speed up 
+    reloading the folder
+
+    :param dirname: DICOM folder
+    :param stats: File sizes and modification times as returned by ``_file_stats``
+    :param series: Dictionary of series UID : DicomSeries as returned by ``DicomSeries.scan``
+    """
+    index = {
+        "version" : INDEX_VERSION,
+        "files" : stats,
+        "series" : dict([(uid, ser.to_dict(dirname)) for uid, ser in series.items()]),
+    }
+    for fname in _index_fnames(dirname):
+        try:
+            with open(fname, "w") as index_file:
+                json.dump(index, index_file, separators=(",", ":"))
+            LOG.debug("Saved DICOM index to %s", fname)
+            return
+        except (IOError, OSError):
+            LOG.debug("Could not save DICOM index to %s", fname)
+
 class DicomFolder(QpData):
     """
     QpData instance loaded from a directory of DICOM files
+
+    Only the DICOM headers are read when the data is created. Pixel data is
+    read when it is first required. The series found in the folder are saved 
+    in an index file, so reloading an unchanged folder does not need to read
+    the headers again
     """
-    def __init__(self, fname):
-        # A directory containing DICOMs. Convert them to Nifti
-        print("Converting DICOMS in %s..." % (os.path.basename(fname)))
+    def __init__(self, fname, progress_cb=None):
+        """
+        :param fname: Directory name
+        :param progress_cb: Optional callable which will be passed the fraction
+                            complete while headers are scanned, and again while
+                            pixel data is read
+        """
+        LOG.info("Converting DICOMS in %s...", os.path.basename(fname))
         src_dcms = glob.glob('%s/*' % fname)
-        nii = None
+        self.dcmdata = None
+        self._series = None
+        self._progress_cb = progress_cb
         try:
-            if HAVE_DCMSTACK:
-                # Give DCMSTACK a chance to do its thing
-                stacks = dcmstack.parse_and_stack(src_dcms)
-                stack = stacks.values()[0]
-                nii = stack.to_nifti()
-        except:
-            warnings.warn("DCMSTACK failed - trying our method")
-        if nii is None:
-            # Try our top-secret in-house method
-            nii = self.fallback_dcmstack(src_dcms)
-
-        print("DONE\n")
-        if len(nii.shape) > 3:
-            nvols = nii.shape[3]
+            if not HAVE_PYDICOM:
+                raise QpException("pydicom not found")
+            stats = _file_stats(fname, src_dcms)
+            series = load_index(fname, stats)
+            if series is None:
+                series = DicomSeries.scan(src_dcms, progress_cb)
+                save_index(fname, stats, series)
+            self._series = DicomSeries.largest(series)
+            shape, affine = self._series.shape, self._series.affine
+        except QpException as exc:
+            if not HAVE_DCMSTACK:
+                raise
+            # Give DCMSTACK a chance to do its thing
+            LOG.warn("Could not read DICOM series (%s) - trying DCMSTACK", str(exc))
+            stacks = dcmstack.parse_and_stack(src_dcms)
+            nii = list(stacks.values())[0].to_nifti()
+            shape, affine = nii.shape, nii.header.get_best_affine()
+            self.dcmdata = nii.get_data()
+
+        if len(shape) > 3:
+            nvols = shape[3]
         else:
             nvols = 1
 
-        grid = DataGrid(nii.shape[:3], nii.header.get_best_affine())
-        self.dcmdata = nii.get_data()
+        grid = DataGrid(list(shape[:3]), affine)
         QpData.__init__(self, fname, grid, nvols, fname=fname)
 
     def raw(self):
+        if self.dcmdata is None:
+            self.dcmdata = self._series.read_data(self._progress_cb)
+            if self.nvols == 1:
+                self.dcmdata = np.squeeze(self.dcmdata, axis=-1)
+            LOG.info("Read DICOMS in %s", os.path.basename(self.fname))
         return self.dcmdata
 
-    def fallback_dcmstack(self, fnames):
-        """
-        Create NIFTI from DCM files. Quick and dirty method
-        for when DCMSTACK does not exist or fails.
-
-        Basically we determine the sequence using the InstanceNumber tag
-        but make sure we put slices together into volumes using the SliceLocation tag
-        """
-        import nibabel.nicom.dicomwrappers as nib_dcm
-        ignored_files = []
-        first = True
-        dcms = []
-        slices = set()
-        ss, rs, ri = 1, 1, 0 # Pixel value scaling
-        sys.stdout.write("  0%")
-        for idx, fname in enumerate(fnames):
-            try:
-                dcm = dicom.read_file(fname)
-            except:
-                ignored_files.append(fname)
-                continue
-            slices.add(float(dcm.SliceLocation))
-            dcms.append(dcm)
-
-            if first:
-                dcm1 = nib_dcm.wrapper_from_file(fname)
-                dcm_affine = dcm1.get_affine()
-                print(dcm_affine)
-                try:
-                    # Need all three of these to be of use
-                    ss = dcm[0x2005, 0x100e].value
-                    rs = dcm[0x2005, 0x140a].value
-                    ri = dcm[0x2005, 0x1409].value
-                except:
-                    pass
-                first = False
-
-            percent = 100*float(idx+1) / len(fnames)
-            sys.stdout.write("\b\b\b\b%3i%%" % int(percent))
-            sys.stdout.flush()
-        
-        if len(slices) < 0:
-            raise QpException("This doesn't seem to be a DICOM folder")
-            
-        n_vols = int(len(dcms) / len(slices))
-        if n_vols * len(slices) != len(dcms):
-            raise QpException("Could not parse DICOMS - unable to determine fixed number of volumes")
+    @property
+    def memory_usage(self):
+        return sizeof(self.dcmdata)
 
-        print("\n")
-        print("%i Volumes" % n_vols)
-        print("Ignored (non-DICOM) files: %i" % len(ignored_files))
-        print("Slice locations are: " + ", ".join([str(s) for s in slices]))
-        print("RescaleSlope: %f" % rs)
-        print("RescaleIntercept: %f" % ri)
-        print("ScaleSlope: %f" % ss)
-        for sidx, s in enumerate(sorted(slices)):
-            for idx, dcm in enumerate(sorted([d for d in dcms if d.SliceLocation == s], key=lambda x: x.InstanceNumber)):
-                dcm.GlobalIndex = sidx + len(slices) * idx
-            
-        print("Creating NIFTI...")
-        data = np.zeros([dcm1.image_shape[0], dcm1.image_shape[1], len(slices), int(n_vols)])
-        sidx, vidx = 0, 0
-        for dcm in sorted(dcms, key=lambda x: x.GlobalIndex):
-            data[:, :, sidx, vidx] = (np.squeeze(dcm.pixel_array)*rs + ri)/ss
-            sidx += 1
-            if sidx == len(slices):
-                sidx = 0
-                vidx += 1
-
-        nii = nib.Nifti1Image(data, dcm_affine)
-        nii.update_header()
-        print("DONE")
-        return nii
+    def uncache(self):
+        QpData.uncache(self)
+        if self._series is None or self.version > 0:
+            # Data cannot be re-read from the files
+            LOG.debug("Not uncaching data %s", self.name)
+        else:
+            self.dcmdata = None
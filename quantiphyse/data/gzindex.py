@@ -0,0 +1,512 @@
+"""
+Quantiphyse - Random access to gzip compressed files
+
+Reading from an arbitrary position in a gzip stream normally requires decompressing
+everything before it. A :class:`GzipIndex` records checkpoints at intervals through the
+uncompressed data so that reads can start from the nearest checkpoint instead. The index
+is built as the file is read and is shared by all readers of the same file, so each part
+of the file only needs to be decompressed sequentially once per session.
+
+Checkpoints inside a compressed stream hold a copy of the decompressor state, which the
+``zlib`` module cannot save to disk. Checkpoints at the start of each gzip member, and
+the total uncompressed size, are saved in an index file next to the compressed file (or
+in the temporary directory if that is not writable) once the whole file has been read,
+so files made up of multiple gzip members have random access as soon as they are
+reopened. :class:`GzipMemberWriter` writes files of this kind, compressing the members
+in parallel.
+
+Copyright (c) 2013-2018 University of Oxford
+"""
+from __future__ import division
+
+import os
+import io
+import zlib
+import json
+import bisect
+import hashlib
+import logging
+import tempfile
+import threading
+import collections
+from multiprocessing.pool import ThreadPool
+
+LOG = logging.getLogger(__name__)
+
+#: Approximate spacing of checkpoints in uncompressed bytes
+CHECKPOINT_SPACING = 4 * 1024 * 1024
+
+#: Number of compressed bytes read from the file at a time
+READ_SIZE = 64 * 1024
+
+#: Maximum number of uncompressed bytes produced by each decompression step
+INFLATE_SIZE = 1024 * 1024
+
+#: Uncompressed size of each gzip member written by GzipMemberWriter
+MEMBER_SIZE = CHECKPOINT_SPACING
+
+#: Extension added to the compressed file name to give the index file name
+INDEX_EXT = ".qpidx"
+
+INDEX_VERSION = 1
+
+# Shared indices, keyed by absolute file name
+_INDICES = {}
+_INDICES_LOCK = threading.Lock()
+
+def _file_stats(fname):
+    stat = os.stat(fname)
+    return [stat.st_size, stat.st_mtime]
+
+def _index_fnames(fname):
+    """
+    :return: Possible locations for the index of a gzip file. The index is stored
+             next to the file if possible, otherwise in the temporary directory
+    """
+    key = hashlib.md5(fname.encode("utf-8")).hexdigest()
+    return [fname + INDEX_EXT,
+            os.path.join(tempfile.gettempdir(), "qp_gzip_index_%s.json" % key)]
+
+def _compress_member(data, compresslevel):
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+class Checkpoint(object):
+    """
+    Position in a gzip file where decompression can be resumed
+
+    :ivar uoffset: Offset in the uncompressed data
+    :ivar coffset: Offset in the compressed file
+    :ivar state: Decompressor positioned at this checkpoint, or None if the checkpoint
+                 is at the start of a gzip member
+    """
+    def __init__(self, uoffset, coffset, state=None):
+        self.uoffset = uoffset
+        self.coffset = coffset
+        self.state = state
+
+    def decompressor(self):
+        """
+        :return: New decompressor for resuming decompression from this checkpoint
+        """
+        if self.state is None:
+            return zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            return self.state.copy()
+
+class GzipIndex(object):
+    """
+    Checkpoints for random access to a gzip file
+
+    :ivar fname: Absolute path to the compressed file
+    :ivar length: Total uncompressed size, or None if this is not yet known
+    """
+
+    def __init__(self, fname, stats=None):
+        self.fname = os.path.abspath(fname)
+        if stats is None:
+            stats = _file_stats(self.fname)
+        self.stats = stats
+        self.length = None
+        self._points = [Checkpoint(0, 0)]
+        self._uoffsets = [0]
+        self._lock = threading.Lock()
+
+    @classmethod
+    def get(cls, fname):
+        """
+        Get the shared index for a file
+
+        The index is loaded from the index file if there is one and the compressed file
+        has not changed since it was saved
+
+        :param fname: Compressed file name
+        :return: GzipIndex
+        """
+        fname = os.path.abspath(fname)
+        stats = _file_stats(fname)
+        with _INDICES_LOCK:
+            index = _INDICES.get(fname, None)
+            if index is None or index.stats != stats:
+                index = cls(fname, stats)
+                index.load()
+                _INDICES[fname] = index
+            return index
+
+    @property
+    def points(self):
+        """ Sequence of checkpoints in order of uncompressed offset """
+        return list(self._points)
+
+    def nearest(self, uoffset):
+        """
+        :return: The last checkpoint at or before an uncompressed offset
+        """
+        with self._lock:
+            return self._points[bisect.bisect_right(self._uoffsets, uoffset) - 1]
+
+    def wants(self, uoffset):
+        """
+        Checkpoints inside a gzip member are only needed if there is no other checkpoint
+        within ``CHECKPOINT_SPACING``, so that re-reading part of the file does not add
+        duplicates
+
+        :return: True if a checkpoint should be added at an uncompressed offset
+        """
+        with self._lock:
+            idx = bisect.bisect_left(self._uoffsets, uoffset)
+            if idx > 0 and uoffset - self._uoffsets[idx-1] < CHECKPOINT_SPACING:
+                return False
+            return idx == len(self._uoffsets) or self._uoffsets[idx] - uoffset >= CHECKPOINT_SPACING
+
+    def add(self, point):
+        """
+        Add a checkpoint
+
+        :param point: Checkpoint
+        """
+        with self._lock:
+            idx = bisect.bisect_left(self._uoffsets, point.uoffset)
+            if idx < len(self._uoffsets) and self._uoffsets[idx] == point.uoffset:
+                if point.state is not None:
+                    return
+                # Member start checkpoints are preferred as they do not need
+                # to keep the decompressor state
+                self._points[idx] = point
+                return
+            self._points.insert(idx, point)
+            self._uoffsets.insert(idx, point.uoffset)
+
+    def set_length(self, length):
+        """
+        Record the total uncompressed size once the end of the file has been reached
+        and save the index
+        """
+        if self.length is None:
+            self.length = length
+            self.save()
+
+    def load(self):
+        """
+        Load member checkpoints from the index file
+
+        :return: True if a valid index was found
+        """
+        for fname in _index_fnames(self.fname):
+            try:
+                with open(fname, "r") as index_file:
+                    index = json.load(index_file)
+                if index.get("version", None) == INDEX_VERSION and index["file"] == self.stats:
+                    for uoffset, coffset in index["members"]:
+                        self.add(Checkpoint(uoffset, coffset))
+                    self.length = index["length"]
+                    LOG.debug("Using gzip index in %s", fname)
+                    return True
+            except (IOError, OSError, ValueError, KeyError, TypeError):
+                pass
+        return False
+
+    def save(self):
+        """
+        Save member checkpoints to the index file
+
+        Failure to save the index is not an error as it is only used to speed up
+        reading the file
+        """
+        index = {
+            "version" : INDEX_VERSION,
+            "file" : self.stats,
+            "length" : self.length,
+            "members" : [[p.uoffset, p.coffset] for p in self.points if p.state is None],
+        }
+        for fname in _index_fnames(self.fname):
+            try:
+                with open(fname, "w") as index_file:
+                    json.dump(index, index_file, separators=(",", ":"))
+                LOG.debug("Saved gzip index to %s", fname)
+                return
+            except (IOError, OSError):
+                LOG.debug("Could not save gzip index to %s", fname)
+
+class IndexedGzipFile(object):
+    """
+    Read-only file object providing random access to the uncompressed contents of
+    a gzip file using a :class:`GzipIndex`
+
+    A single instance is not thread safe - callers must serialize seek and read
+    calls, as Nibabel array proxies do.
+    """
+
+    def __init__(self, fname):
+        self.name = fname
+        self.index = GzipIndex.get(fname)
+        self._fobj = open(fname, "rb")
+        self._pos = 0
+
+        # Decompression state: the decompressor (None at the start of a member), the
+        # uncompressed offset of the next output byte, compressed data read but not
+        # yet consumed and the file offset of the next compressed data to read
+        self._decomp = None
+        self._upos = None
+        self._input = b""
+        self._cpos = 0
+        self._file_eof = False
+
+    @property
+    def closed(self):
+        """ True if the file has been closed """
+        return self._fobj.closed
+
+    def close(self):
+        """ Close the underlying compressed file """
+        self._fobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def write(self, data):
+        raise IOError("%s is open for reading only" % self.name)
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self._length()
+        elif whence != io.SEEK_SET:
+            raise ValueError("Invalid value for whence: %s" % whence)
+        if offset < 0:
+            raise ValueError("Negative seek position %i" % offset)
+        self._pos = offset
+        return self._pos
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self._length() - self._pos
+        if self.index.length is not None:
+            size = min(size, self.index.length - self._pos)
+        if size <= 0:
+            return b""
+
+        self._seek_stream(self._pos)
+        chunks = []
+        while size > 0:
+            data = self._inflate(min(size, INFLATE_SIZE))
+            if not data:
+                break
+            chunks.append(data)
+            size -= len(data)
+        data = b"".join(chunks)
+        self._pos += len(data)
+        return data
+
+    def readinto(self, buf):
+        data = self.read(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+    def _length(self):
+        if self.index.length is None:
+            # Decompress to the end of the file to find the length
+            self._seek_stream(self._upos if self._upos is not None else 0)
+            while self._inflate(INFLATE_SIZE):
+                pass
+        return self.index.length
+
+    def _seek_stream(self, pos):
+        """
+        Position the decompressor so the next byte it produces is at an uncompressed
+        offset, restarting from a checkpoint if that is quicker than decompressing
+        forward from the current position
+        """
+        point = self.index.nearest(pos)
+        if self._upos is None or pos < self._upos or point.uoffset > self._upos:
+            self._decomp = None if point.state is None else point.decompressor()
+            self._upos = point.uoffset
+            self._cpos = point.coffset
+            self._input = b""
+            self._file_eof = False
+
+        while self._upos < pos:
+            if not self._inflate(min(pos - self._upos, INFLATE_SIZE)):
+                break
+
+    def _inflate(self, size):
+        """
+        Decompress data from the current position
+
+        :param size: Maximum number of bytes to return
+        :return: Uncompressed data, empty at the end of the file
+        """
+        while True:
+            if not self._input and not self._file_eof:
+                self._fobj.seek(self._cpos)
+                self._input = self._fobj.read(READ_SIZE)
+                self._cpos += len(self._input)
+                self._file_eof = not self._input
+
+            if self._decomp is None:
+                # Start of a gzip member - anything other than zero padding
+                # before the end of the file starts a new member
+                self._input = self._input.lstrip(b"\0")
+                if self._input:
+                    self._decomp = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                    self.index.add(Checkpoint(self._upos, self._cpos - len(self._input)))
+                elif self._file_eof:
+                    self.index.set_length(self._upos)
+                    return b""
+                else:
+                    continue
+
+            if self._input:
+                data = self._decomp.decompress(self._input, size)
+            elif self._file_eof:
+                # Truncated file, return anything left in the decompressor
+                data = self._decomp.flush()
+                self._decomp = None
+            else:
+                continue
+
+            if self._decomp is not None:
+                if getattr(self._decomp, "eof", False) or self._decomp.unused_data:
+                    self._input = self._decomp.unused_data
+                    self._decomp = None
+                else:
+                    self._input = self._decomp.unconsumed_tail
+
+            self._upos += len(data)
+            if self._decomp is not None and self.index.wants(self._upos):
+                self.index.add(Checkpoint(self._upos, self._cpos - len(self._input), self._decomp.copy()))
+            if data:
+                return data
+
+class GzipMemberWriter(object):
+    """
+    Write-only file object which compresses data into a sequence of independent gzip
+    members, using a pool of threads to compress several members at once
+
+    Standard gzip readers decode the members as a single stream. The start of each
+    member is saved in the gzip index when the file is closed, so it can be read
+    back with random access.
+    """
+
+    def __init__(self, fname, compresslevel=6, threads=4):
+        """
+        :param fname: File name
+        :param compresslevel: zlib compression level from 1 (fastest) to 9 (smallest)
+        :param threads: Number of members to compress at once
+        """
+        self.name = fname
+        self.compresslevel = compresslevel
+        self._fobj = open(fname, "wb")
+        self._pool = ThreadPool(threads) if threads > 1 else None
+        self._max_pending = 2 * max(threads, 1)
+        self._pending = collections.deque()
+        self._members = []
+        self._buffer, self._buffered = [], 0
+        self._member_pos = 0
+        self._pos = 0
+
+    @property
+    def closed(self):
+        """ True if the file has been closed """
+        return self._fobj.closed
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+        else:
+            self._abort()
+
+    def readable(self):
+        return False
+
+    def seekable(self):
+        return False
+
+    def writable(self):
+        return True
+
+    def read(self, size=-1):
+        raise IOError("%s is open for writing only" % self.name)
+
+    def tell(self):
+        return self._pos
+
+    def write(self, data):
+        start = 0
+        while self._buffered + len(data) - start >= MEMBER_SIZE:
+            end = start + MEMBER_SIZE - self._buffered
+            self._buffer.append(data[start:end])
+            self._submit()
+            start = end
+        if start < len(data):
+            self._buffer.append(data[start:])
+            self._buffered += len(data) - start
+        self._pos += len(data)
+        return len(data)
+
+    def close(self):
+        """
+        Write any remaining data, close the file and save the gzip index
+        """
+        if self.closed:
+            return
+        try:
+            if self._buffered > 0 or not self._members and not self._pending:
+                self._submit()
+            while self._pending:
+                self._write_member()
+        finally:
+            self._abort()
+
+        index = GzipIndex(self.name)
+        for uoffset, coffset in self._members:
+            index.add(Checkpoint(uoffset, coffset))
+        index.length = self._pos
+        index.save()
+        with _INDICES_LOCK:
+            _INDICES[index.fname] = index
+
+    def _abort(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+        self._fobj.close()
+
+    def _submit(self):
+        data = b"".join(self._buffer)
+        self._buffer, self._buffered = [], 0
+        if self._pool is None:
+            self._pending.append((self._member_pos, _compress_member(data, self.compresslevel)))
+        else:
+            self._pending.append((self._member_pos, self._pool.apply_async(_compress_member, (data, self.compresslevel))))
+        self._member_pos += len(data)
+
+        # Limit the amount of uncompressed data waiting to be written
+        while len(self._pending) > self._max_pending:
+            self._write_member()
+
+    def _write_member(self):
+        uoffset, compressed = self._pending.popleft()
+        if self._pool is not None:
+            compressed = compressed.get()
+        self._members.append((uoffset, self._fobj.tell()))
+        self._fobj.write(compressed)
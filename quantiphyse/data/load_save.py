@@ -21,20 +21,26 @@ from .dicoms import DicomFolder
 
 LOG = logging.getLogger(__name__)
 
-def load(fname):
+def load(fname, mmap="auto", progress_cb=None):
     """
     Load a data file
 
+    :param fname: File or directory name
+    :param mmap: Memory mapping policy for file formats which support it. True to
+                 memory map the data if possible, False to read it into memory, 
+                 ``auto`` to choose based on file size and available memory
+    :param progress_cb: Optional callable taking the fraction complete, for formats
+                        which may be slow to read such as DICOM folders
     :return: QpData instance
     """
     if os.path.isdir(fname):
-        return DicomFolder(fname)
+        return DicomFolder(fname, progress_cb=progress_cb)
     elif fname.endswith(".nii") or fname.endswith(".nii.gz"):
-        return NiftiData(fname)
+        return NiftiData(fname, mmap=mmap)
     else:
         raise QpException("%s: Unrecognized file type" % fname)
 
-def save(data, fname, grid=None, outdir=""):
+def save(data, fname, grid=None, outdir="", compresslevel=None, threads=None):
     """
     Save data to a file
     
@@ -42,5 +48,7 @@ def save(data, fname, grid=None, outdir=""):
     :param fname: File name
     :param grid: If specified, grid to save the data on
     :param outdir: Optional output directory if fname is not absolute
+    :param compresslevel: Compression level from 1 to 9 for compressed files
+    :param threads: Number of threads to use for compression
     """
-    save_nifti(data, fname, grid, outdir)
+    save_nifti(data, fname, grid, outdir, compresslevel=compresslevel, threads=threads)
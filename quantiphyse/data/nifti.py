@@ -6,24 +6,94 @@ Copyright (c) 2013-2018 University of Oxford
 from __future__ import division, print_function
 
 import os
+import gzip
+import threading
 import logging
 import traceback
 
 import nibabel as nib
+from nibabel.arrayproxy import ArrayProxy
 import numpy as np
 
-from .qpdata import DataGrid, QpData
+from quantiphyse.utils import QpException
+from .qpdata import DataGrid, QpData, label_dtype
+from .cache import LruCache, sizeof
+from .gzindex import IndexedGzipFile, GzipMemberWriter
 
 LOG = logging.getLogger(__name__)
 
 QP_NIFTI_EXTENSION_CODE = 42
 
+#: Shared cache of individual volumes read from 4D Nifti files which have not been
+#: fully loaded. Keys are (data UID, volume index)
+VOLUME_CACHE = LruCache(512 * 1024 * 1024, name="Nifti volumes")
+
+#: Number of volumes either side of a requested volume to load in the background
+#: in anticipation of them being needed, e.g. when scrolling through volumes
+PREFETCH_VOLS = 1
+
+#: In ``auto`` mode, uncompressed files larger than this fraction of the
+#: available physical memory will be memory mapped rather than read into memory
+MMAP_AUTO_FRACTION = 0.25
+
+#: In ``auto`` mode, files smaller than this are always read into memory
+MMAP_AUTO_MIN_SIZE = 256 * 1024 * 1024
+
+#: Default compression level for saving .nii.gz files, the same as Nibabel's default
+COMPRESS_LEVEL = 1
+
+#: Default number of threads used to compress data when saving .nii.gz files
+COMPRESS_THREADS = 4
+
+def available_memory():
+    """
+    :return: Available physical memory in bytes, or None if this cannot be determined
+    """
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+def use_mmap(fname, mmap="auto"):
+    """
+    Decide whether a Nifti file should be memory mapped
+
+    Memory mapping is only possible for uncompressed files, so compressed
+    files are always read into memory.
+
+    :param fname: File name
+    :param mmap: True to memory map if possible, False to always read into memory,
+                 ``auto`` to decide based on the file size and available memory
+    :return: True if the file should be memory mapped
+    """
+    if fname.endswith(".gz"):
+        return False
+    elif mmap == "auto":
+        size = os.path.getsize(fname)
+        if size < MMAP_AUTO_MIN_SIZE:
+            return False
+        avail = available_memory()
+        if avail is None:
+            return True
+        return size > avail * MMAP_AUTO_FRACTION
+    elif mmap in (True, False):
+        return mmap
+    else:
+        raise QpException("Invalid memory mapping mode: %s" % str(mmap))
+
 class NiftiData(QpData):
     """
     QpData from a Nifti file
     """
-    def __init__(self, fname):
+    def __init__(self, fname, mmap="auto"):
+        """
+        :param fname: File name
+        :param mmap: Memory mapping policy - True to access the file data using a read-only 
+                     memory map if possible, False to read it into memory, ``auto`` to 
+                     choose based on the file size and available memory. 
+        """
         nii = nib.load(fname)
+        self.mmap = use_mmap(fname, mmap)
         shape = list(nii.shape)
         while len(shape) < 3:
             shape.append(1)
@@ -34,8 +104,8 @@ class NiftiData(QpData):
             nvols = 1
 
         self.rawdata = None
-        self.voldata = None
         self.nifti_header = nii.header
+        self._dataobj = None
         metadata = None
         for ext in self.nifti_header.extensions:
             if ext.get_code() == QP_NIFTI_EXTENSION_CODE:
@@ -65,17 +135,23 @@ class NiftiData(QpData):
         QpData.__init__(self, fname, grid, nvols, vol_unit=vol_units, vol_scale=vol_scale, fname=fname, metadata=metadata)
 
     def raw(self):
-        # NB: copy() converts data to an in-memory array instead of a numpy file memmap.
-        # Appears to improve speed drastically as well as stop a bug with accessing the subset of the array
-        # memmap has been designed to save space on ram by keeping the array on the disk but does
-        # horrible things with performance, and analysis especially when the data is on the network.
+        # NB: Memory mapping saves RAM by keeping the array on disk but can be much slower, 
+        # especially when the data is on the network, so it is only used when the policy 
+        # given on load requires it. Copy-on-write mode is used so in-place modification of 
+        # the array (e.g. by the ROI builder) never alters the file. Memory mapping is not 
+        # possible if the data requires scaling, in which case the data is read into memory
         if self.rawdata is None:
-            nii = nib.load(self.fname)
-            #self.rawdata = nii.get_data().copy()
-            self.rawdata = nii.get_data()
+            if self.mmap:
+                nii = nib.load(self.fname, mmap="c")
+                self.rawdata = np.asanyarray(nii.dataobj)
+            else:
+                nii = nib.load(self.fname, mmap=False)
+                self.rawdata = nii.get_data()
             self.rawdata = self._correct_dims(self.rawdata)
 
-        self.voldata = None
+            # Individual volumes are no longer required
+            self._uncache_volumes()
+
         return self.rawdata
         
     def volume(self, vol):
@@ -85,13 +161,92 @@ class NiftiData(QpData):
         elif self.rawdata is not None:
             return self.rawdata[:, :, :, vol]
         else:
-            if self.voldata is None:
-                self.voldata = [None,] * self.nvols
-            if self.voldata[vol] is None:
-                nii = nib.load(self.fname)
-                self.voldata[vol] = self._correct_dims(nii.dataobj[..., vol])
+            voldata = VOLUME_CACHE.get((self.uid, vol))
+            if voldata is None:
+                voldata = self._load_volume(vol)
+            if PREFETCH_VOLS > 0:
+                self.prefetch(range(vol-PREFETCH_VOLS, vol+PREFETCH_VOLS+1))
+            return voldata
+
+    def prefetch(self, vols):
+        """
+        Load volumes into the volume cache in a background thread
+
+        This does nothing if the data has been fully loaded into memory
+
+        :param vols: Sequence of volume indices. Indices which are out of range
+                     or already cached are ignored
+        :return: The background thread, or None if there was nothing to load
+        """
+        vols = [vol for vol in vols if 0 <= vol < self.nvols and (self.uid, vol) not in VOLUME_CACHE]
+        if vols and self.rawdata is None:
+            thread = threading.Thread(target=self._prefetch, args=(vols,))
+            thread.daemon = True
+            thread.start()
+            return thread
+
+    @property
+    def memory_usage(self):
+        return sizeof(self.rawdata)
+
+    def uncache(self):
+        QpData.uncache(self)
+        if self.version > 0 and self.rawdata is not None:
+            # Data may have been modified in place so it cannot be re-read from the file
+            LOG.debug("Not uncaching modified data %s", self.name)
+        else:
+            self.rawdata = None
+        self._dataobj = None
+        self._uncache_volumes()
+
+    def release(self):
+        QpData.release(self)
+        self._uncache_volumes()
+
+    def _prefetch(self, vols):
+        try:
+            for vol in vols:
+                if (self.uid, vol) not in VOLUME_CACHE:
+                    self._load_volume(vol)
+        except Exception:
+            # Prefetching is only an optimization - the error will be
+            # reported if the volume is actually requested
+            LOG.debug("Failed to prefetch volumes %s from %s", vols, self.fname)
+
+    def _read_block(self, index):
+        if self.rawdata is None and not self.metadata.get("raw_2dt", False):
+            if self.nvols > 1 and isinstance(index[-1], (int, np.integer)) and (self.uid, index[-1]) in VOLUME_CACHE:
+                # Use the cached volume if we have it, e.g. the volume currently displayed
+                voldata = VOLUME_CACHE.get((self.uid, index[-1]))
+                if voldata is not None:
+                    return voldata[index[:-1]]
+            dataobj = self._get_dataobj()
+            if len(dataobj.shape) >= len(index):
+                # Read just the block from the file without loading the whole data
+                return self._correct_dims(dataobj[index])
+        return QpData._read_block(self, index)
+
+    def _get_dataobj(self):
+        if self._dataobj is None:
+            # Keep the array proxy so the header is not re-parsed for every read
+            if self.fname.endswith(".nii.gz"):
+                # Use the seek point index so reads do not decompress from the
+                # start of the file each time
+                gzfile = IndexedGzipFile(self.fname)
+                header = type(self.nifti_header).from_fileobj(gzfile)
+                self._dataobj = ArrayProxy(gzfile, header, mmap=False)
+            else:
+                self._dataobj = nib.load(self.fname, keep_file_open=True).dataobj
+        return self._dataobj
 
-        return self.voldata[vol]
+    def _load_volume(self, vol):
+        voldata = self._correct_dims(self._get_dataobj()[..., vol])
+        VOLUME_CACHE.put((self.uid, vol), voldata)
+        return voldata
+
+    def _uncache_volumes(self):
+        uid = self.uid
+        VOLUME_CACHE.remove_if(lambda key: key[0] == uid)
 
     def _correct_dims(self, arr):
         while arr.ndim < 3:
@@ -105,34 +260,31 @@ class NiftiData(QpData):
             arr = np.squeeze(arr, axis=-1)
         return arr
 
-def save(data, fname, grid=None, outdir=""):
+def save(data, fname, grid=None, outdir="", compresslevel=None, threads=None):
     """
     Save data to a file
+
+    The data is written one volume at a time so it is never copied in full. Compressed
+    files are written as a sequence of gzip members which are compressed in parallel.
+    Standard gzip readers treat these as a single stream, and the start of each member 
+    is saved in the gzip index so the file can be read back with random access.
     
     :param data: QpData instance
     :param fname: File name
     :param grid: If specified, grid to save the data on
     :param outdir: Optional output directory if fname is not absolute
+    :param compresslevel: Compression level from 1 (fastest) to 9 (smallest) for 
+                          ``.gz`` files. Defaults to ``COMPRESS_LEVEL``
+    :param threads: Number of threads used to compress ``.gz`` files. If 1, the data
+                    is compressed as a single gzip stream. Defaults to ``COMPRESS_THREADS``
     """
-    if grid is None:
-        grid = data.grid
-        arr = data.raw().copy()
-    else:
-        arr = data.resample(grid).raw().copy()
-        
     if hasattr(data, "nifti_header"):
         header = data.nifti_header.copy()
     else:
         header = None
 
-    img = nib.Nifti1Image(arr, grid.affine, header=header)
-    img.update_header()
-    if data.metadata:
-        from quantiphyse.utils.batch import to_yaml
-        yaml_metadata = to_yaml({"QpMetadata" : data.metadata})
-        LOG.debug("Writing metadata: %s", yaml_metadata)
-        ext = nib.nifti1.Nifti1Extension(QP_NIFTI_EXTENSION_CODE, yaml_metadata.encode('utf-8'))
-        img.header.extensions.append(ext)
+    if grid is not None:
+        data = data.resample(grid)
 
     if not fname:
         fname = data.name
@@ -148,6 +300,73 @@ def save(data, fname, grid=None, outdir=""):
     if not os.path.exists(dirname):
         os.makedirs(dirname)
 
+    if data.fname and os.path.abspath(data.fname) == os.path.abspath(fname):
+        # Overwriting the source file, so the data cannot be read from it while writing
+        data.raw()
+
+    dtype = _save_dtype(data, header)
+    if header is None:
+        header = nib.Nifti1Header()
+    shape = list(data.grid.shape)
+    if data.nvols > 1:
+        shape.append(data.nvols)
+
+    # The image is used only to set up the header from the affine, and the
+    # template array is broadcast so takes no memory
+    template = np.broadcast_to(np.zeros(1, dtype=dtype), shape)
+    img = nib.Nifti1Image(template, data.grid.affine, header=header)
+    img.update_header()
+    header = img.header
+    header.set_data_shape(shape)
+    header.set_data_dtype(dtype)
+    header.set_slope_inter(None, None)
+    header.set_data_offset(0)
+    header.extensions[:] = [ext for ext in header.extensions if ext.get_code() != QP_NIFTI_EXTENSION_CODE]
+    if data.metadata:
+        from quantiphyse.utils.batch import to_yaml
+        yaml_metadata = to_yaml({"QpMetadata" : data.metadata})
+        LOG.debug("Writing metadata: %s", yaml_metadata)
+        ext = nib.nifti1.Nifti1Extension(QP_NIFTI_EXTENSION_CODE, yaml_metadata.encode('utf-8'))
+        header.extensions.append(ext)
+
     LOG.debug("Saving %s as %s", data.name, fname)
-    img.to_filename(fname)
+    dtype = header.get_data_dtype()
+    with _open_output(fname, compresslevel, threads) as outfile:
+        header.write_to(outfile)
+        outfile.write(b"\0" * (header.get_data_offset() - outfile.tell()))
+        for vol in range(data.nvols):
+            outfile.write(np.asarray(data.volume(vol), dtype=dtype).tobytes(order="F"))
     data.fname = fname
+
+def _save_dtype(data, header):
+    """
+    :return: Data type to save data with. ROIs use the label data type policy. Otherwise 
+             the type in the existing header, if any, is used unless floating point data 
+             would need to be scaled to fit it
+    """
+    voldata = np.asarray(data.volume(0))
+    if data.roi and voldata.size > 0:
+        return label_dtype(np.max(voldata), np.min(voldata))
+
+    dtype = voldata.dtype
+    if dtype.kind == "b":
+        dtype = np.dtype(np.uint8)
+    if header is None:
+        return dtype
+    hdr_dtype = header.get_data_dtype()
+    if hdr_dtype.kind == "f" or (dtype.kind != "f" and hdr_dtype.itemsize >= dtype.itemsize):
+        return hdr_dtype
+    return dtype
+
+def _open_output(fname, compresslevel=None, threads=None):
+    if compresslevel is None:
+        compresslevel = COMPRESS_LEVEL
+    if threads is None:
+        threads = COMPRESS_THREADS
+
+    if not fname.endswith(".gz"):
+        return open(fname, "wb")
+    elif threads > 1:
+        return GzipMemberWriter(fname, compresslevel, threads)
+    else:
+        return gzip.GzipFile(fname, "wb", compresslevel)
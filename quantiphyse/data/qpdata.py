@@ -17,9 +17,13 @@ Concepts:
 Copyright (c) 2013-2018 University of Oxford
 """
 
+import os
 import logging
 import math
+import itertools
+import tempfile
 
+import six
 import numpy as np
 import scipy
 
@@ -32,13 +36,47 @@ from . import functions as pg
 
 # FIXME hack to ensure extras is frozen!
 from . import extras
+from .cache import LruCache, sizeof
+from .blocks import DataBlock, BLOCK_VALUES
+from .regions import RegionIndex
+from .voxels import VoxelTable
 
 #: Tolerance for treating values as equal
 #: Used to determine if matrices are diagonal or identity
 EQ_TOL = 1e-3
 
+#: Shared cache of resampled data arrays. Keys are (data UID, data version, source grid key, 
+#: target grid key, interpolation order, ROI flag). Only resampling which requires
+#: interpolation is cached, simple flips and transpositions are cheap anyway
+RESAMPLE_CACHE = LruCache(512 * 1024 * 1024, name="Resampled data")
+
+#: Shared cache of 2D slices extracted for display. Keys are (data UID, data version, 
+#: data grid key, slice plane key, volume index, interpolation order)
+SLICE_CACHE = LruCache(256 * 1024 * 1024, name="Data slices")
+
+#: Shared cache of ``SliceGeometry`` instances. Keys are (data grid key, slice plane key)
+SLICE_GEOMETRY_CACHE = LruCache(64 * 1024 * 1024, name="Slice geometry")
+
+#: Shared cache of downsampled volumes used for display. Keys are (data UID, data version,
+#: pyramid level, volume index)
+PYRAMID_CACHE = LruCache(256 * 1024 * 1024, name="Display pyramid")
+
+#: Shared cache of ``VoxelTable`` instances. Keys are (data UID, data version, ROI UID,
+#: ROI version, inverted ROI flag). The ROI UID is None for tables of all voxels
+VOXEL_TABLE_CACHE = LruCache(512 * 1024 * 1024, name="Voxel tables")
+
+#: Pyramid levels are not created if the largest dimension of the data would be
+#: smaller than this
+PYRAMID_MIN_SIZE = 16
+
+#: Floating point type for non-ROI data. Processes should create output and intermediate
+#: arrays in this type directly rather than relying on NumpyData to convert them
+WORKING_DTYPE = np.float32
+
 LOG = logging.getLogger(__name__)
 
+_UIDS = itertools.count()
+
 def is_diagonal(mat):
     """
     :return: True if mat is diagonal, to within a tolerance of ``EQ_TOL``
@@ -64,6 +102,86 @@ def is_ortho_vector(vec, shape=1):
             return axis, math.copysign(1, val)
     return None, None
 
+def downsample(arr, grid, roi=False):
+    """
+    Halve the resolution of a 3D array
+
+    Each axis with more than one voxel is downsampled by a factor of 2. Data values are 
+    averaged over blocks of voxels, ROI values are sampled so that the output still
+    contains only the original labels.
+
+    :param arr: 3D Numpy array
+    :param grid: DataGrid the array is defined on
+    :param roi: If True, array contains ROI labels
+    :return: Tuple of downsampled array, DataGrid it is defined on
+    """
+    factors = [2 if size > 1 else 1 for size in arr.shape]
+    affine = grid.affine
+    if roi:
+        arr = np.array(arr[::factors[0], ::factors[1], ::factors[2]])
+    else:
+        # Each output voxel is centred on the middle of the block it is averaged over
+        affine[:3, 3] = np.dot(affine, [(factor - 1) / 2.0 for factor in factors] + [1])[:3]
+        padding = [(0, size % factor) for size, factor in zip(arr.shape, factors)]
+        if any([pad[1] for pad in padding]):
+            arr = np.pad(arr, padding, mode="edge")
+        blocks_shape = []
+        for size, factor in zip(arr.shape, factors):
+            blocks_shape += [size // factor, factor]
+        arr = arr.reshape(blocks_shape).mean(axis=(1, 3, 5))
+
+    for axis, factor in enumerate(factors):
+        affine[:3, axis] *= factor
+    return arr, DataGrid(arr.shape, affine, units=grid.units)
+
+def working_dtype():
+    """
+    Data type policy for non-ROI data
+
+    :return: Numpy dtype used to store floating point data, as set by ``WORKING_DTYPE``
+    """
+    return np.dtype(WORKING_DTYPE)
+
+def working_zeros(shape):
+    """
+    :param shape: Shape of the array
+    :return: New Numpy array of zeros with the working data type
+    """
+    return np.zeros(shape, dtype=working_dtype())
+
+def label_dtype(max_label, min_label=0):
+    """
+    Data type policy for ROI labels
+
+    :param max_label: Largest label value which must be stored
+    :param min_label: Smallest label value which must be stored
+    :return: The smallest unsigned integer Numpy dtype which can hold the labels, or the
+             smallest signed integer dtype if there are negative labels
+    """
+    if min_label < 0:
+        dtypes = (np.int8, np.int16, np.int32, np.int64)
+    else:
+        dtypes = (np.uint8, np.uint16, np.uint32, np.uint64)
+    for dtype in dtypes:
+        info = np.iinfo(dtype)
+        if info.min <= min_label and max_label <= info.max:
+            return np.dtype(dtype)
+    raise QpException("ROI labels out of range: %s - %s" % (min_label, max_label))
+
+def as_labels(arr):
+    """
+    Convert an array of ROI labels to the data type given by :func:`label_dtype`
+
+    :param arr: Numpy array containing integer values
+    :return: Array of labels. This is ``arr`` itself if it already has the required type
+    """
+    arr = np.asarray(arr)
+    if arr.size == 0:
+        dtype = label_dtype(0)
+    else:
+        dtype = label_dtype(np.max(arr), np.min(arr))
+    return arr.astype(dtype, copy=False)
+
 def remove_nans(x, replace_val=0):
     """
     Remove NANs from a Numpy array
@@ -76,6 +194,67 @@ def remove_nans(x, replace_val=0):
     x[~np.isfinite(x)] = replace_val
     return x
 
+def resample_array(data, src_grid, grid, order=0, roi=False):
+    """
+    Resample a 3D or 4D array from one grid onto another
+
+    Unlike :meth:`QpData.resample` the result is not cached. If the transformation
+    reduces to flips and transpositions the result is a view of ``data``
+
+    :param data: Numpy array defined on ``src_grid``
+    :param src_grid: :class:`DataGrid` the data is defined on
+    :param grid: :class:`DataGrid` to resample the data on to
+    :param order: Interpolation order
+    :param roi: If True the output is converted to ROI labels
+    :return: Numpy array
+    """
+    # Affine transformation matrix from current grid to new grid
+    tmatrix = np.dot(np.linalg.inv(grid.affine), src_grid.affine)
+    reorder, flip, tmatrix = src_grid.simplify_transforms(tmatrix)
+
+    # Perform the flips and transpositions which simplify the transformation and
+    # may avoid the need for an affine transformation, or make it a simple scaling
+    if reorder != range(3):
+        if data.ndim == 4:
+            reorder = reorder + [3]
+        data = np.transpose(data, reorder)
+        
+    if flip:
+        for dim in flip:
+            data = np.flip(data, dim)
+
+    if not is_identity(tmatrix):
+        # We were not able to reduce the transformation down to flips/transpositions
+        # so we will need an affine transformation
+        # scipy requires the out->in transform so invert our in->out transform
+        tmatrix = np.linalg.inv(tmatrix)
+        affine = tmatrix[:3, :3]
+        offset = list(tmatrix[:3, 3])
+        output_shape = list(grid.shape[:])
+        if data.ndim == 4:
+            # Make 4D affine with identity transform in 4th dimension
+            affine = np.append(affine, [[0, 0, 0]], 0)
+            affine = np.append(affine, [[0], [0], [0], [1]], 1)
+            offset.append(0)
+            output_shape.append(data.shape[3])
+
+        if is_diagonal(affine):
+            # The transformation is diagonal, so use faster sequence mode
+            affine = np.diagonal(affine)
+        #LOG.debug("WARNING: affine_transform: ")
+        #LOG.debug(affine)
+        #LOG.debug("Offset = ", offset)
+        #LOG.debug("Input shape=", data.shape, data.min(), data.max())
+        #LOG.debug("Output shape=", output_shape)
+        data = scipy.ndimage.affine_transform(data, affine, offset=offset,
+                                              output_shape=output_shape, order=order)
+
+        if roi:
+            # If source data was ROI, output should be, however resampling could have
+            # led to non-integer data
+            data = as_labels(data)
+    return data
+
 class DataGrid(object):
     """
     Defines a regular 3D grid in some 'world' space
@@ -213,6 +392,25 @@ class DataGrid(object):
         else:
             return list(grid_coords)
 
+    def grid_to_grid_points(self, points, from_grid=None):
+        """
+        Transform multiple points into this grid's co-ordinates
+
+        All the points are transformed by a single matrix multiplication so this is
+        much faster than calling ``grid_to_grid`` for each point
+
+        :param points: Sequence of 3D or 4D co-ordinates, e.g. an N x 3 array. If 4D, the
+                       last entry of each point is ignored
+        :param from_grid: DataGrid the input co-ordinates are relative to. If not specified,
+                          the input co-ordinates are in world space
+        :return: N x 3 Numpy array of co-ordinates relative to this grid
+        """
+        points = np.atleast_2d(np.asarray(points, dtype=np.float64))[:, :3]
+        tmatrix = np.linalg.inv(self._affine)
+        if from_grid is not None:
+            tmatrix = np.dot(tmatrix, from_grid.affine)
+        return np.dot(points, tmatrix[:3, :3].T) + tmatrix[:3, 3]
+
     def get_standard(self):
         """
         Return a new grid in approximate RAS order, by axis transposition
@@ -238,6 +436,12 @@ class DataGrid(object):
         grid_axes = [world_axes.index(axis) for axis in range(3)]
         return grid_axes + [3, ]
 
+    def key(self):
+        """
+        :return: Hashable value which is the same for any two grids which ``match``
+        """
+        return (tuple(self._shape), self._affine.tobytes(), self._units)
+
     def matches(self, grid):
         """
         Determine if another grid matches this one
@@ -331,6 +535,145 @@ class OrthoSlice(DataGrid):
         """ 3D normal vector to the plane in world co-ordinates"""
         return self._normal
 
+class SliceGeometry(object):
+    """
+    Describes how to extract a 2D slice from data defined on a grid
+
+    This depends only on the data grid and the slice plane, not on the data itself, so 
+    it can be reused for any data on the same grid, any volume and any version of the
+    data. For orthogonal slices the geometry is a simple Numpy index. For oblique
+    slices the sampling co-ordinates are computed once and reused.
+
+    :ivar shape: Shape of the 2D slice array
+    :ivar trans_v: 2x2 transformation from slice array co-ordinates to plane co-ordinates
+    :ivar offset: Offset of the slice array in plane co-ordinates
+    :ivar index: Numpy index for an orthogonal slice, or None if the slice is oblique
+                 or outside the data
+    :ivar coords: 3 x slice shape array of data co-ordinates to sample for an oblique 
+                  slice, or None if the slice is orthogonal
+    """
+
+    def __init__(self, grid, plane):
+        """
+        :param grid: DataGrid that the data is defined on
+        :param plane: OrthoSlice representing the slice to be extracted. Note that this
+                      slice will not in general be defined on the same grid as the data
+        """
+        data_origin = np.array(grid.grid_to_grid([0, 0, 0], from_grid=plane))
+        data_normal = np.array(grid.grid_to_grid([0, 0, 1], from_grid=plane, direction=True))
+
+        data_scaled_normal = np.array([data_normal[idx] * grid.spacing[idx] * grid.spacing[idx] for idx in range(3)])
+        data_naxis = np.argmax(np.absolute(data_scaled_normal))
+
+        data_axes = list(range(3))
+        del data_axes[data_naxis]
+        slice_basis, slice_shape = [], []
+        for axis in data_axes:
+            vec = [0, 0, 0]
+            vec[axis] = 1
+            vec[data_naxis] = -(data_scaled_normal[axis] / data_scaled_normal[data_naxis])
+            slice_basis.append(vec)
+            slice_shape.append(grid.shape[axis])
+
+        trans_v = np.array([
+            np.array(grid.grid_to_grid(slice_basis[0], to_grid=plane, direction=True)),
+            np.array(grid.grid_to_grid(slice_basis[1], to_grid=plane, direction=True)),
+        ])
+
+        self.trans_v = np.delete(trans_v, 2, 1)
+        slice_origin = [0, 0, 0]
+        slice_origin[data_naxis] = np.dot(data_origin, data_scaled_normal) / data_scaled_normal[data_naxis]
+        data_offset = data_origin - slice_origin + 0.5
+        self.offset = -np.array(grid.grid_to_grid(data_offset, to_grid=plane, direction=True))[:2]
+        self.shape = tuple(slice_shape)
+        self.index, self.coords = None, None
+        self._nearest, self._inside = None, None
+
+        ax1, sign1 = is_ortho_vector(slice_basis[0], slice_shape[0])
+        ax2, sign2 = is_ortho_vector(slice_basis[1], slice_shape[0])
+        if ax1 is not None and ax2 is not None:
+            pos = int(math.floor(data_origin[data_naxis]+0.5))
+            if pos >= 0 and pos < grid.shape[data_naxis]:
+                index = [None, None, None]
+                index[ax1] = self._get_slice(grid.shape[ax1], sign1)
+                index[ax2] = self._get_slice(grid.shape[ax2], sign2)
+                index[data_naxis] = pos
+                self.index = tuple(index)
+            else:
+                LOG.debug("Outside data range: %i, %i", pos, grid.shape[data_naxis])
+        else:
+            self.coords = pg.affineSliceCoords(slice_shape, slice_origin, slice_basis, range(3))
+            self._data_shape = grid.shape
+
+    @property
+    def nbytes(self):
+        """ Memory used by the slice co-ordinates """
+        return sizeof([self.coords, self._nearest, self._inside])
+
+    def extract(self, rawdata, order=0, roi=False):
+        """
+        Extract the slice from a 3D data array
+
+        :param rawdata: 3D Numpy array defined on the grid
+        :param order: Interpolation order for oblique slices
+        :param roi: If True, the data is an ROI and the returned mask covers the
+                    whole slice
+        :return: Tuple of slice data, slice mask which is zero outside the data
+        """
+        if self.coords is None:
+            if self.index is None:
+                # Requested slice is outside the data range
+                return np.zeros(self.shape), np.zeros(self.shape)
+            LOG.debug("Using Numpy slice: %s %s", self.index, rawdata.shape)
+            return rawdata[self.index], np.ones(self.shape)
+
+        LOG.debug("Full affine slice")
+        if order == 0:
+            index, inside = self.nearest()
+            sdata = rawdata[index]
+        else:
+            inside = self.inside()
+            sdata = scipy.ndimage.map_coordinates(rawdata, self.coords, output=np.float64, 
+                                                  order=order, mode="nearest")
+        sdata[~inside] = 0
+        if roi:
+            smask = np.ones(self.shape)
+        else:
+            smask = inside.astype(np.float64)
+        return sdata, smask
+
+    def nearest(self):
+        """
+        :return: Tuple of Numpy index of the nearest data voxel to each point in an 
+                 oblique slice, boolean array which is False for points outside the data
+        """
+        if self._nearest is None:
+            voxels = np.round(self.coords).astype(np.int64)
+            inside = np.ones(self.shape, dtype=bool)
+            for axis in range(3):
+                inside &= (voxels[axis] >= 0) & (voxels[axis] <= self._data_shape[axis]-1)
+            voxels[:, ~inside] = 0
+            self._nearest = (tuple(voxels), inside)
+        return self._nearest
+
+    def inside(self):
+        """
+        :return: Boolean array which is False for points in an oblique slice which
+                 cannot be interpolated from the data
+        """
+        if self._inside is None:
+            inside = np.ones(self.shape, dtype=bool)
+            for axis in range(3):
+                inside &= (self.coords[axis] >= 0) & (self.coords[axis] <= self._data_shape[axis]-1)
+            self._inside = inside
+        return self._inside
+
+    def _get_slice(self, length, sign):
+        if sign == 1:
+            return slice(0, length, 1)
+        else:
+            return slice(length-1, None, -1)
+
 class MetaSignaller(QtCore.QObject):
     """
     This is required because you can't multiply inherit 
@@ -356,6 +699,14 @@ class Metadata(dict):
         #self.sig_changed.emit(key)
         dict.__setitem__(self, key, value)
 
+class DataSignaller(QtCore.QObject):
+    """
+    Emits signals on behalf of a QpData instance
+
+    Like :class:`MetaSignaller` this is required because QpData is not a QObject
+    """
+    sig_changed = QtCore.Signal(object)
+
 class QpData(object):
     """
     3D or 4D data
@@ -374,6 +725,10 @@ class QpData(object):
     def __init__(self, name, grid, nvols, roi=False, metadata=None, **kwargs):
         self.name = name
         self.grid = grid
+        self._uid = next(_UIDS)
+        self._version = 0
+        self._derived = {}
+        self._signaller = None
 
         # Number of volumes (1=3D data)
         self._nvols = nvols
@@ -396,10 +751,48 @@ class QpData(object):
         self._meta["vol_scale"] = kwargs.get("vol_scale", 1.0)
         self._meta["vol_units"] = kwargs.get("vol_units", None)
 
+    def __getstate__(self):
+        # The signaller is a QObject which cannot be pickled, e.g. when data is
+        # sent to a worker process. Derived data can be regenerated if required
+        state = dict(self.__dict__)
+        state["_signaller"] = None
+        state["_derived"] = {}
+        return state
+
     @property
     def metadata(self):
         return self._meta
 
+    @property
+    def sig_changed(self):
+        """
+        Qt signal emitted with this data object when it is marked as modified
+
+        The underlying QObject is only created when the signal is first used
+        """
+        if self._signaller is None:
+            self._signaller = DataSignaller()
+        return self._signaller.sig_changed
+
+    @property
+    def uid(self):
+        """ Identifier which is unique to this data object, used as a key for cached data """
+        return self._uid
+
+    @property
+    def version(self):
+        """ Version stamp which is increased whenever the data is marked as modified """
+        return self._version
+
+    @property
+    def memory_usage(self):
+        """
+        Approximate memory in bytes currently used to hold this data
+
+        Data which is memory mapped or has not yet been loaded from file is not counted
+        """
+        return 0
+
     @property
     def ndim(self):
         """ 3 or 4 for 3D or 4D data"""
@@ -433,6 +826,29 @@ class QpData(object):
                 if not np.all(np.equal(np.mod(rawdata, 1), 0)):
                     raise QpException("This data set cannot be an ROI - it does not contain integers")
         self._meta["roi"] = is_roi
+        if is_roi:
+            self._compact_labels()
+
+    def _compact_labels(self):
+        """
+        Called when the data is made an ROI. Subclasses which hold their data in memory
+        should convert it to the label data type, see :func:`label_dtype`
+        """
+        pass
+
+    def ensure_label(self, label):
+        """
+        Make sure the data type can hold an ROI label value
+
+        This must be called before writing label values into the array returned by
+        ``raw()``. Subclasses may convert the data to a larger type, in which case
+        ``raw()`` must be called again to get the new array.
+
+        :param label: Label value
+        """
+        dtype = self.raw().dtype
+        if dtype.kind in "iu" and not np.iinfo(dtype).min <= label <= np.iinfo(dtype).max:
+            raise QpException("Label %i cannot be stored in data of type %s" % (label, dtype))
 
     @property
     def regions(self):
@@ -455,6 +871,56 @@ class QpData(object):
                 self._meta["roi_regions"] = roi_regions
         return self._meta["roi_regions"]
 
+    def region_index(self):
+        """
+        Get an index of the voxels in each ROI region
+
+        The index is cached until the data is marked as modified, so region-wise
+        analyses should use this rather than comparing the data with each region label
+
+        :return: :class:`RegionIndex` instance
+        """
+        if not self.roi:
+            raise TypeError("Only ROIs have distinct regions")
+
+        if "region_index" not in self._derived:
+            self._derived["region_index"] = RegionIndex(self.raw())
+        return self._derived["region_index"]
+
+    def voxel_table(self, roi=None, invert=False):
+        """
+        Get the values of the data within an ROI as a voxels x volumes matrix
+
+        Tables are cached for each combination of data and ROI until either is modified,
+        so analyses which work on the voxels within an ROI should use this rather than
+        masking the data themselves. The cached arrays are read-only.
+
+        :param roi: ROI data item. If None, all voxels are included
+        :param invert: If True, use voxels outside the ROI
+        :return: :class:`VoxelTable` instance. If an ROI is given, its ``labels`` are the
+                 ROI region of each voxel
+        """
+        if roi is None:
+            cache_key = (self.uid, self.version, None, None, invert)
+        else:
+            cache_key = (self.uid, self.version, roi.uid, roi.version, invert)
+        table = VOXEL_TABLE_CACHE.get(cache_key)
+        if table is None:
+            LOG.debug("Creating voxel table for %s", self.name)
+            if roi is None:
+                table = VoxelTable(self, dtype=working_dtype())
+            else:
+                roi_data = roi.resample(self.grid).raw()
+                mask = roi_data > 0
+                if invert:
+                    mask = np.logical_not(mask)
+                table = VoxelTable(self, mask, labels=roi_data, dtype=working_dtype())
+            for arr in (table.indices, table.values, table.labels):
+                if arr is not None:
+                    arr.flags.writeable = False
+            VOXEL_TABLE_CACHE.put(cache_key, table)
+        return table
+
     @property 
     def fname(self):
         """
@@ -483,6 +949,7 @@ class QpData(object):
         # The grid transform can't be properly interpreted because basically the file is broken,
         # so just make it 2D and hope the remaining transform is sensible
         self.grid.shape[2] = 1
+        self.mark_dirty()
 
     def raw(self):
         """
@@ -523,21 +990,10 @@ class QpData(object):
         :param grid: If specified, interpret position in this ``DataGrid`` co-ordinate space.
         :param str: If True, return value as string to appropriate number of decimal places.
         """
-        if grid is None:
-            grid = DataGrid([1, 1, 1], np.identity(4))
-        if len(pos) == 3:
-            pos = list(pos) + [0,]
-            
-        data_pos = [int(math.floor(v+0.5)) for v in self.grid.grid_to_grid(pos[:3], from_grid=grid)]
-        if min(data_pos) < 0:
-            # Out of range but will be misinterpreted by indexing!
-            value = 0
-        else:
-            rawdata = self.volume(pos[3])
-            try:
-                value = rawdata[tuple(data_pos)]
-            except IndexError:
-                value = 0
+        vol = 0
+        if len(pos) == 4:
+            vol = int(pos[3])
+        value = self.sample([pos[:3]], grid, vols=vol)[0]
 
         if as_str:
             return sf(value)
@@ -556,19 +1012,244 @@ class QpData(object):
         if self.nvols == 1:
             return [self.value(pos, grid), ]
 
-        if grid is None:
-            grid = DataGrid([1, 1, 1], np.identity(4))
-
-        data_pos = [int(math.floor(v+0.5)) for v in self.grid.grid_to_grid(pos[:3], from_grid=grid)]
-        if min(data_pos) < 0:
-            # Out of range but will be misinterpreted by indexing!
+        coords = self.grid.grid_to_grid_points([pos[:3]], from_grid=grid)
+        if not self._voxels_inside(coords)[1][0]:
             return []
         else:
-            rawdata = self.raw()
-            try:
-                return list(rawdata[data_pos[0], data_pos[1], data_pos[2], :])
-            except IndexError:
-                return []
+            return list(self.sample_coords(coords)[0])
+
+    def sample(self, points, grid=None, vols=None, order=0, fill=0):
+        """
+        Sample the data at multiple points
+
+        :param points: Sequence of 3D or 4D positions, e.g. an N x 3 array. If 4D the last
+                       value of each point is ignored - use ``vols`` to select volumes. If
+                       ``grid`` not specified, positions are in world space
+        :param grid: If specified, interpret positions in this ``DataGrid`` co-ordinate space
+        :param vols: Volume index, or sequence of volume indices, to sample. If not specified,
+                     all volumes are sampled
+        :param order: Interpolation order. 0 returns the value of the nearest voxel,
+                      higher orders use spline interpolation
+        :param fill: Value returned for points outside the data
+        :return: If ``vols`` is a single index, Numpy array of N values. Otherwise N x V
+                 Numpy array where V is the number of volumes sampled
+        """
+        return self.sample_coords(self.grid.grid_to_grid_points(points, from_grid=grid),
+                                  vols=vols, order=order, fill=fill)
+
+    def sample_coords(self, coords, vols=None, order=0, fill=0):
+        """
+        Sample the data at multiple points given in this data's grid co-ordinates
+
+        This is the same as ``sample`` but avoids transforming the points when they
+        are already relative to this data's grid. Only the part of the data containing
+        the points is read, so data which has not been loaded is not loaded in full.
+
+        :param coords: N x 3 array of grid co-ordinates
+        :return: See ``sample``
+        """
+        coords = np.asarray(coords, dtype=np.float64).reshape(-1, 3)
+        single = vols is not None and np.ndim(vols) == 0
+        if vols is None:
+            vols = list(range(self.nvols))
+        elif single:
+            vols = [vols]
+        vols = [min(int(vol), self.nvols-1) for vol in vols]
+
+        if order == 0:
+            voxels, inside = self._voxels_inside(coords)
+            voxels = voxels[inside]
+            if len(voxels) == 0:
+                samples = np.zeros((0, len(vols)), dtype=np.asarray(fill).dtype)
+            else:
+                # Read only the bounding box of the sampled voxels
+                lower = voxels.min(axis=0)
+                spatial = [slice(lo, hi) for lo, hi in zip(lower, voxels.max(axis=0) + 1)]
+                voxels = voxels - lower
+                def _gather(vol):
+                    block = self._read_block(self._block_index(spatial, vol))
+                    return block[voxels[:, 0], voxels[:, 1], voxels[:, 2]]
+                if self.nvols > 1 and vols == list(range(self.nvols)):
+                    samples = _gather(None)
+                else:
+                    samples = np.stack([_gather(vol) for vol in vols], axis=-1)
+        else:
+            # Spline interpolation needs a margin of voxels around the points
+            inside = np.ones(len(coords), dtype=bool)
+            shape = self.grid.shape
+            lower = np.clip(np.floor(coords.min(axis=0)).astype(np.int64) - order, 0, shape)
+            upper = np.clip(np.ceil(coords.max(axis=0)).astype(np.int64) + order + 1, 0, shape)
+            samples = np.full((len(coords), len(vols)), fill, dtype=np.float64)
+            if np.all(upper > lower):
+                spatial = [slice(lo, hi) for lo, hi in zip(lower, upper)]
+                for idx, vol in enumerate(vols):
+                    block = self._read_block(self._block_index(spatial, vol))
+                    samples[:, idx] = scipy.ndimage.map_coordinates(block, (coords - lower).T, output=np.float64,
+                                                                    order=order, mode="constant", cval=fill)
+
+        dtype = samples.dtype
+        if not np.can_cast(np.min_scalar_type(fill), dtype):
+            dtype = np.promote_types(dtype, np.min_scalar_type(fill))
+        output = np.full((len(coords), len(vols)), fill, dtype=dtype)
+        output[inside] = samples
+        if single:
+            return output[:, 0]
+        else:
+            return output
+
+    def _voxels_inside(self, coords):
+        """
+        :return: Tuple of N x 3 array of nearest voxel indices to the grid co-ordinates
+                 and boolean array which is True for voxels inside the grid
+        """
+        voxels = np.floor(coords + 0.5).astype(np.int64)
+        inside = np.all((voxels >= 0) & (voxels < self.grid.shape), axis=1)
+        return voxels, inside
+
+    def blocks(self, by="volume", axis=2, size=None, halo=0, roi=None, vol=None, limits=None):
+        """
+        Iterate over the data in blocks so the whole data set is not required in memory
+
+        Block data may be a view of the underlying data so must not be modified.
+
+        :param by: ``volume`` to return each 3D volume in turn, ``slab`` to return slabs of
+                   slices along ``axis`` containing all volumes, or ``roi`` to return the
+                   bounding box of ``roi`` in each volume
+        :param axis: Spatial axis (0-2) to divide the data along when ``by=slab``
+        :param size: Number of slices in each slab. If not specified, chosen so that each
+                     block contains approximately ``BLOCK_VALUES`` values
+        :param halo: Number of additional voxels to include on each side of a slab or ROI
+                     bounding box, e.g. for filters which need neighbouring values. The halo
+                     is truncated at the edges of the data
+        :param roi: ROI data item, required when ``by=roi``
+        :param vol: If specified, only return data from this volume
+        :param limits: If specified, tuple of (start, stop) slice indices along ``axis``
+                       to restrict slabs to when ``by=slab``
+        :return: Generator of :class:`DataBlock` instances
+        """
+        if vol is not None:
+            vols = [min(vol, self.nvols-1)]
+        else:
+            vols = range(self.nvols)
+
+        if by == "volume":
+            for vol_idx in vols:
+                index = [slice(None)] * 3
+                yield DataBlock(self.volume(vol_idx), self._block_index(index, vol_idx), index, vol_idx)
+        elif by == "slab":
+            if axis not in (0, 1, 2):
+                raise QpException("Invalid axis for block iteration: %s" % str(axis))
+            length = self.grid.shape[axis]
+            first, last = 0, length
+            if limits is not None:
+                first, last = max(0, limits[0]), min(length, limits[1])
+            if size is None:
+                slice_values = self.grid.nvoxels // length * len(vols)
+                size = max(1, BLOCK_VALUES // slice_values)
+            for start in range(first, last, size):
+                end = min(start+size, last)
+                lower, upper = max(0, start-halo), min(length, end+halo)
+                outer, index, inner = [slice(None)] * 3, [slice(None)] * 3, [slice(None)] * 3
+                outer[axis] = slice(lower, upper)
+                index[axis] = slice(start, end)
+                inner[axis] = slice(start-lower, end-lower)
+                yield DataBlock(self._read_block(self._block_index(outer, vol)), 
+                                self._block_index(index, vol), inner, vol)
+        elif by == "roi":
+            if roi is None:
+                raise QpException("An ROI is required for block iteration by ROI")
+            if not roi.grid.matches(self.grid):
+                roi = roi.resample(self.grid)
+            if not np.any(roi.raw()):
+                return
+            outer, inner = [], []
+            index = roi.get_bounding_box(3)
+            for dim, bbox in enumerate(index):
+                lower, upper = max(0, bbox.start-halo), min(self.grid.shape[dim], bbox.stop+halo)
+                outer.append(slice(lower, upper))
+                inner.append(slice(bbox.start-lower, bbox.stop-lower))
+            for vol_idx in vols:
+                yield DataBlock(self._read_block(self._block_index(outer, vol_idx)),
+                                self._block_index(index, vol_idx), inner, vol_idx)
+        else:
+            raise QpException("Unknown block iteration type: %s" % by)
+
+    def map_blocks(self, func, output=None, dtype=None, **kwargs):
+        """
+        Apply a function to each block of the data and write the results to an output array
+
+        :param func: Callable taking a Numpy array of block data, including any halo, and
+                     returning an array of the same shape
+        :param output: Numpy array with the same shape as ``raw()``, which may be a memory
+                       map, or the file name of a ``.npy`` file to create as a memory map. 
+                       If not specified a new array is created. Parts of the output not 
+                       covered by any block (e.g. outside an ROI) are not modified
+        :param dtype: Data type of the output if a new array or file is created. Defaults
+                      to the working data type
+        :param kwargs: Block iteration options as for :meth:`blocks`
+        :return: Output array
+        """
+        shape = list(self.grid.shape)
+        if self.nvols > 1:
+            shape.append(self.nvols)
+        if dtype is None:
+            dtype = working_dtype()
+
+        if output is None:
+            output = np.zeros(shape, dtype=dtype)
+        elif isinstance(output, six.string_types):
+            output = np.lib.format.open_memmap(output, mode="w+", dtype=dtype, shape=tuple(shape))
+        elif list(output.shape) != shape:
+            raise QpException("Output array has shape %s - expected %s" % (list(output.shape), shape))
+
+        for block in self.blocks(**kwargs):
+            output[block.slices] = func(block.data)[block.inner]
+        return output
+
+    def _block_index(self, spatial, vol=None):
+        """
+        :return: Index into the raw data for a spatial region and optional volume
+        """
+        if self.nvols > 1:
+            return tuple(spatial) + (slice(None) if vol is None else vol, )
+        else:
+            return tuple(spatial)
+
+    def _read_block(self, index):
+        """
+        Read part of the data
+
+        The default implementation indexes the array returned by ``raw()``. Subclasses 
+        may override this to read only the required part of the data from a file.
+
+        :param index: Tuple of slices/indices into the raw data
+        """
+        return self.raw()[index]
+
+    def mark_dirty(self):
+        """
+        Flag that the data has been modified in place
+
+        This must be called after modifying the array returned by ``raw()`` or ``volume()``,
+        or after changing the grid, so that cached data derived from the previous contents
+        is not reused. The version stamp is increased, cached derived data such as the
+        data range is discarded and ``sig_changed`` is emitted.
+
+        For ROIs, regions may have been created or removed so they are regenerated,
+        keeping the names of existing regions
+        """
+        self._version += 1
+        self._uncache_derived()
+        self._meta.pop("range", None)
+        current_regions = self._meta.pop("roi_regions", None)
+        if current_regions and self.roi:
+            new_regions = self.regions
+            for label, desc in current_regions.items():
+                if label in new_regions:
+                    new_regions[label] = desc
+
+        if self._signaller is not None:
+            self._signaller.sig_changed.emit(self)
 
     def uncache(self):
         """
@@ -580,8 +1261,28 @@ class QpData(object):
         data from a file might implement the method to write the data out to a temporary
         file which is then re-read on the next call to ``raw()`` or ``volume()``
         
-        This method is optional and does not have to be implemented"""
-        pass
+        The base class implementation removes cached data derived from this data, e.g.
+        resampled copies. Subclasses which override this method should call it.
+        """
+        self._uncache_derived()
+
+    def release(self):
+        """
+        Discard shared cached data derived from this data
+
+        This is called when the data is removed from the :class:`ImageVolumeManagement`
+        so that caches do not hold on to memory for data which is no longer in use.
+        Unlike ``uncache()`` it does not make any attempt to preserve the data itself.
+        """
+        self._uncache_derived()
+
+    def _uncache_derived(self):
+        self._derived.clear()
+        uid = self._uid
+        RESAMPLE_CACHE.remove_if(lambda key: key[0] == uid)
+        SLICE_CACHE.remove_if(lambda key: key[0] == uid)
+        PYRAMID_CACHE.remove_if(lambda key: key[0] == uid)
+        VOXEL_TABLE_CACHE.remove_if(lambda key: uid in (key[0], key[2]))
 
     def range(self, vol=None):
         """
@@ -627,7 +1328,7 @@ class QpData(object):
             else:
                 ret.append(data)
             if output_mask:
-                ret.append(np.ones(data.shape[:3], dtype=np.int))
+                ret.append(np.ones(data.shape[:3], dtype=np.bool_))
         else:
             roi = roi.resample(self.grid)
             if region is None:
@@ -640,7 +1341,7 @@ class QpData(object):
             if output_flat:
                 ret.append(data[mask])
             else:
-                masked = np.zeros(data.shape)
+                masked = np.zeros(data.shape, dtype=data.dtype)
                 masked[mask] = data[mask]
                 ret.append(masked)
             if output_mask:
@@ -655,11 +1356,13 @@ class QpData(object):
         """
         Resample the data onto a new grid
 
+        Results which require interpolation are cached in ``RESAMPLE_CACHE``, so
+        repeated resampling of unmodified data onto the same grid is cheap. The 
+        cached arrays are read-only so the returned data must not be modified in place.
+
         :param grid: :class:`DataGrid` to resample the data on to
         :return: New :class:`QpData` object
         """
-        data = self.raw()
-
         LOG.debug("Resampling from:")
         LOG.debug(self.grid.affine)
         LOG.debug("To:")
@@ -667,156 +1370,105 @@ class QpData(object):
 
         # Affine transformation matrix from current grid to new grid
         tmatrix = np.dot(np.linalg.inv(grid.affine), self.grid.affine)
-        reorder, flip, tmatrix = self.grid.simplify_transforms(tmatrix)
-
-        # Perform the flips and transpositions which simplify the transformation and
-        # may avoid the need for an affine transformation, or make it a simple scaling
-        if reorder != range(3):
-            if data.ndim == 4:
-                reorder = reorder + [3]
-            data = np.transpose(data, reorder)
-            
-        if flip:
-            for dim in flip:
-                data = np.flip(data, dim)
+        _, _, tmatrix = self.grid.simplify_transforms(tmatrix)
+
+        if not is_identity(tmatrix):
+            cache_key = (self._uid, self._version, self.grid.key(), grid.key(), order, self.roi)
+            data = RESAMPLE_CACHE.get(cache_key)
+            if data is not None:
+                LOG.debug("Using cached resampled data")
+                return NumpyData(data=data, grid=grid, name=self.name + suffix, roi=self.roi, metadata=self._meta)
 
+        data = resample_array(self.raw(), self.grid, grid, order, self.roi)
         if not is_identity(tmatrix):
-            # We were not able to reduce the transformation down to flips/transpositions
-            # so we will need an affine transformation
-            # scipy requires the out->in transform so invert our in->out transform
-            tmatrix = np.linalg.inv(tmatrix)
-            affine = tmatrix[:3, :3]
-            offset = list(tmatrix[:3, 3])
-            output_shape = list(grid.shape[:])
-            if data.ndim == 4:
-                # Make 4D affine with identity transform in 4th dimension
-                affine = np.append(affine, [[0, 0, 0]], 0)
-                affine = np.append(affine, [[0], [0], [0], [1]], 1)
-                offset.append(0)
-                output_shape.append(data.shape[3])
-
-            if is_diagonal(affine):
-                # The transformation is diagonal, so use faster sequence mode
-                affine = np.diagonal(affine)
-            #LOG.debug("WARNING: affine_transform: ")
-            #LOG.debug(affine)
-            #LOG.debug("Offset = ", offset)
-            #LOG.debug("Input shape=", data.shape, data.min(), data.max())
-            #LOG.debug("Output shape=", output_shape)
-            data = scipy.ndimage.affine_transform(data, affine, offset=offset,
-                                                  output_shape=output_shape, order=order)
-
-            if self.roi:
-                # If source data was ROI, output should be, however resampling could have
-                # led to non-integer data
-                data = data.astype(np.int32)
+            data.flags.writeable = False
+            RESAMPLE_CACHE.put(cache_key, data)
 
         return NumpyData(data=data, grid=grid, name=self.name + suffix, roi=self.roi, metadata=self._meta)
 
-    def slice_data(self, plane, vol=0, interp_order=0):
+    @property
+    def pyramid_levels(self):
         """
-        Extract a data slice in raw data resolution
-
-        :param plane: OrthoSlice representing the slice to be extracted. Note that this
-                      slice will not in general be defined on the same grid as the data
-        :param vol: volume index for use if this is a 4D data set
-        :param interp_order: Order of interpolation for non-orthogonal slices
+        Number of resolution levels available from ``pyramid()``, including the
+        full resolution data
         """
-        rawdata = self.volume(vol)
-        
-        data_origin = np.array(self.grid.grid_to_grid([0, 0, 0], from_grid=plane))
-        data_normal = np.array(self.grid.grid_to_grid([0, 0, 1], from_grid=plane, direction=True))
-
-        data_scaled_normal = np.array([data_normal[idx] * self.grid.spacing[idx] * self.grid.spacing[idx] for idx in range(3)])
-        data_naxis = np.argmax(np.absolute(data_scaled_normal))
-
-        data_axes = list(range(3))
-        del data_axes[data_naxis]
-        slice_basis, slice_shape = [], []
-        for axis in data_axes:
-            vec = [0, 0, 0]
-            vec[axis] = 1
-            vec[data_naxis] = -(data_scaled_normal[axis] / data_scaled_normal[data_naxis])
-            slice_basis.append(vec)
-            slice_shape.append(rawdata.shape[axis])
+        levels, size = 1, max(self.grid.shape)
+        while size // 2 >= PYRAMID_MIN_SIZE:
+            size //= 2
+            levels += 1
+        return levels
 
-        trans_v = np.array([
-            np.array(self.grid.grid_to_grid(slice_basis[0], to_grid=plane, direction=True)),
-            np.array(self.grid.grid_to_grid(slice_basis[1], to_grid=plane, direction=True)),
-        ])
-
-        trans_v = np.delete(trans_v, 2, 1)
-        slice_origin = [0, 0, 0]
-        slice_origin[data_naxis] = np.dot(data_origin, data_scaled_normal) / data_scaled_normal[data_naxis]
-        data_offset = data_origin - slice_origin + 0.5
-        offset = -np.array(self.grid.grid_to_grid(data_offset, to_grid=plane, direction=True))[:2]
+    def pyramid(self, level, vol=0):
+        """
+        Get a reduced resolution copy of a volume, e.g. for display when zoomed out
 
-        ax1, sign1 = is_ortho_vector(slice_basis[0], slice_shape[0])
-        ax2, sign2 = is_ortho_vector(slice_basis[1], slice_shape[0])
-        if ax1 is not None and ax2 is not None:
-            #LOG.debug("\nOrthoSlice: data basis: %s (shape=%s)" % (str(slice_basis), str(slice_shape)))
-            slices = [None, None, None]
-            slices[ax1] = self._get_slice(rawdata.shape[ax1], sign1)
-            slices[ax2] = self._get_slice(rawdata.shape[ax2], sign2)
+        Level ``n`` is downsampled by a factor of ``2**n`` along each axis using 
+        ``downsample()``. Levels are built when first requested from the level above
+        and kept in ``PYRAMID_CACHE`` until the data is modified.
 
-            pos = int(math.floor(data_origin[data_naxis]+0.5))
-            if pos >= 0 and pos < rawdata.shape[data_naxis]:
-                slices[data_naxis] = pos
-                LOG.debug("Using Numpy slice: %s %s", slices, rawdata.shape)
-                sdata = rawdata[slices]
-                smask = np.ones(slice_shape)
-            else:
-                # Requested slice is outside the data range
-                LOG.debug("Outside data range: %i, %i", pos, rawdata.shape[data_naxis])
-                sdata = np.zeros(slice_shape)
-                smask = np.zeros(slice_shape)
-        else:
-            LOG.debug("Full affine slice")
-
-            #LOG.debug("OrthoSlice: plane origin: %s" % str(plane.origin))
-            #LOG.debug("OrthoSlice: plane v1: %s" % str(plane.basis[0]))
-            #LOG.debug("OrthoSlice: plane v2: %s" % str(plane.basis[1]))
-            #LOG.debug("OrthoSlice: plane n: %s" % str(plane.normal))
-            #LOG.debug("OrthoSlice: Plane affine")
-            #LOG.debug(plane.affine)
-
-            #LOG.debug("OrthoSlice: data origin: %s" % str(data_origin))
-            #LOG.debug("OrthoSlice: data n: %s" % str(data_normal))
-            #LOG.debug("OrthoSlice: data naxis: %i" % data_naxis)
-            #LOG.debug("OrthoSlice: data affine")
-            #LOG.debug(self.grid.affine)
-            
-            #LOG.debug("OrthoSlice: new normal=", data_scaled_normal)
-            #LOG.debug("OrthoSlice: data basis: %s (shape=%s)" % (str(slice_basis), str(slice_shape)))
-            #LOG.debug("OrthoSlice: trans matrix:\n%s" % (str(trans_v)))
-            #LOG.debug("OrthoSlice: slice origin=", slice_origin)
-            #LOG.debug("OrthoSlice: new origin: %s (offset=%s)" % (str(slice_origin), str(data_offset)))
-            #LOG.debug("OrthoSlice: new plane offset: %s" % (str(offset)))
-            
-            #LOG.debug("Origin: ", slice_origin)
-            #LOG.debug("Basis", slice_basis)
-            #LOG.debug("Shape", slice_shape)
-            if self.roi:
-                # Use nearest neighbour interpolation for ROIs
-                sdata = pg.affineSlice(rawdata, slice_shape, slice_origin, slice_basis, range(3), order=0)
-                smask = np.ones(sdata.shape)
+        :param level: Pyramid level, 0 for full resolution
+        :param vol: Volume index
+        :return: 3D QpData instance. For level 0 this is the volume at full resolution
+        """
+        vol = min(vol, self.nvols-1)
+        if level <= 0:
+            return NumpyData(self.volume(vol), grid=self.grid, name=self.name, roi=self.roi)
+        level = min(level, self.pyramid_levels-1)
+
+        cache_key = (self._uid, self._version, level, vol)
+        data = PYRAMID_CACHE.get(cache_key)
+        if data is None:
+            if level == 1:
+                arr, grid = self.volume(vol), self.grid
             else:
-                # Generate mask by flagging out of range data with value less than data minimum
-                dmin = np.min(rawdata)
-                sdata = pg.affineSlice(rawdata, slice_shape, slice_origin, slice_basis, range(3), 
-                                       order=interp_order, mode='constant', cval=dmin-100)
-                smask = np.ones(sdata.shape)
-                smask[sdata < dmin] = 0
-                sdata[sdata < dmin] = 0
-            LOG.debug("Done affine slice")
+                parent = self.pyramid(level-1, vol)
+                arr, grid = parent.raw(), parent.grid
+            arr, grid = downsample(arr, grid, roi=self.roi)
+            data = NumpyData(arr, grid=grid, name="%s_level_%i" % (self.name, level), roi=self.roi)
+            data.raw().flags.writeable = False
+            PYRAMID_CACHE.put(cache_key, data, nbytes=data.raw().nbytes)
+        return data
+
+    def slice_data(self, plane, vol=0, interp_order=0, level=0):
+        """
+        Extract a data slice in raw data resolution
 
-        return remove_nans(sdata), smask, trans_v, offset
+        Slices are cached in ``SLICE_CACHE``, so returning to a slice which has already
+        been displayed is cheap. The returned arrays are read-only.
 
-    def _get_slice(self, length, sign):
-        if sign == 1:
-            return slice(0, length, 1)
-        else:
-            return slice(length-1, None, -1)
+        :param plane: OrthoSlice representing the slice to be extracted. Note that this
+                      slice will not in general be defined on the same grid as the data
+        :param vol: volume index for use if this is a 4D data set
+        :param interp_order: Order of interpolation for non-orthogonal slices
+        :param level: If > 0, extract the slice from this level of the reduced resolution
+                      pyramid rather than the full resolution data. See ``pyramid()``
+        :return: Tuple of slice data, slice mask, 2x2 transformation and offset from
+                 slice array to ``plane`` co-ordinates
+        """
+        if level > 0 and self.pyramid_levels > 1:
+            return self.pyramid(level, vol).slice_data(plane, interp_order=interp_order)
+
+        geometry_key = (self.grid.key(), plane.key())
+        geometry = SLICE_GEOMETRY_CACHE.get(geometry_key)
+        if geometry is None:
+            geometry = SliceGeometry(self.grid, plane)
+            SLICE_GEOMETRY_CACHE.put(geometry_key, geometry)
+
+        vol = min(vol, self.nvols-1)
+        if geometry.coords is None or self.roi:
+            # Interpolation order is only relevant for oblique slices of non-ROI data
+            interp_order = 0
+        cache_key = (self._uid, self._version) + geometry_key + (vol, interp_order)
+        cached = SLICE_CACHE.get(cache_key)
+        if cached is not None:
+            return cached
+
+        sdata, smask = geometry.extract(self.volume(vol), interp_order, self.roi)
+        ret = (remove_nans(sdata), smask, geometry.trans_v, geometry.offset)
+        for arr in ret:
+            arr.flags.writeable = False
+        SLICE_CACHE.put(cache_key, ret)
+        return ret
 
     def get_bounding_box(self, ndim=3):
         """
@@ -840,14 +1492,17 @@ class QpData(object):
         if not self.roi:
             raise RuntimeError("get_bounding_box() called on non-ROI data")
 
-        slices = [slice(None)] * ndim
-        for dim in range(min(ndim, 3)):
-            axes = [i for i in range(3) if i != dim]
-            nonzero = np.any(self.raw(), axis=tuple(axes))
-            bb_start, bb_end = np.where(nonzero)[0][[0, -1]]
-            slices[dim] = slice(bb_start, bb_end+1)
+        key = ("bbox", ndim)
+        if key not in self._derived:
+            slices = [slice(None)] * ndim
+            for dim in range(min(ndim, 3)):
+                axes = [i for i in range(3) if i != dim]
+                nonzero = np.any(self.raw(), axis=tuple(axes))
+                bb_start, bb_end = np.where(nonzero)[0][[0, -1]]
+                slices[dim] = slice(bb_start, bb_end+1)
+            self._derived[key] = slices
 
-        return slices
+        return list(self._derived[key])
 
 class NumpyData(QpData):
     """
@@ -860,9 +1515,11 @@ class NumpyData(QpData):
             grid = DataGrid(data.shape[:3], np.identity(4))
 
         if data.dtype.kind in np.typecodes["AllFloat"]:
-            # Use float32 rather than default float64 to reduce storage
-            data = data.astype(np.float32)
+            # Store in the working type rather than default float64 to reduce storage.
+            # Data which is already in the working type is not copied
+            data = data.astype(working_dtype(), copy=False)
         self.rawdata = data
+        self._spill_fname = None
         
         if data.ndim > 3:
             nvols = data.shape[3]
@@ -872,7 +1529,59 @@ class NumpyData(QpData):
             nvols = 1
 
         QpData.__init__(self, name, grid, nvols, **kwargs)
-    
+
+    def __del__(self):
+        fname = getattr(self, "_spill_fname", None)
+        if fname is not None:
+            self.rawdata = None
+            try:
+                os.remove(fname)
+            except OSError:
+                LOG.warn("Failed to remove temporary file %s", fname)
+
+    def __getstate__(self):
+        # The spill file belongs to this instance and must not be removed by a copy
+        state = QpData.__getstate__(self)
+        state["_spill_fname"] = None
+        return state
+
+    @property
+    def memory_usage(self):
+        return sizeof(self.rawdata)
+
+    def _compact_labels(self):
+        self.rawdata = as_labels(self.rawdata)
+
+    def ensure_label(self, label):
+        dtype = self.rawdata.dtype
+        if dtype.kind in "iu" and not np.iinfo(dtype).min <= label <= np.iinfo(dtype).max:
+            self.rawdata = self.rawdata.astype(np.promote_types(dtype, label_dtype(label, min(label, 0))))
+
+    @property
+    def spilled(self):
+        """ True if the data has been written to a temporary file by ``uncache()`` """
+        return self._spill_fname is not None
+
+    def uncache(self):
+        """
+        Write the data to a temporary file and replace it with a memory map of that file
+
+        The data remains accessible through ``raw()`` and ``volume()`` and may still be
+        modified in place, however it no longer needs to be resident in memory.
+        """
+        QpData.uncache(self)
+        if self._spill_fname is None and not isinstance(self.rawdata, np.memmap):
+            fhandle, fname = tempfile.mkstemp(prefix="qp_%s_" % self.name, suffix=".npy")
+            os.close(fhandle)
+            try:
+                np.save(fname, self.rawdata)
+                self.rawdata = np.load(fname, mmap_mode="r+")
+                self._spill_fname = fname
+                LOG.debug("Spilled %s to %s", self.name, fname)
+            except Exception:
+                LOG.warn("Failed to write %s to temporary file", self.name)
+                os.remove(fname)
+
     def raw(self):
         if self._meta.get("raw_2dt", False) and self.rawdata.ndim == 3:
             # Single-slice, interpret 3rd dimension as time
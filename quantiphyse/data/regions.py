@@ -0,0 +1,308 @@
+"""
+Quantiphyse - Index of the voxels in each region of an ROI
+
+Copyright (c) 2013-2018 University of Oxford
+"""
+
+from __future__ import division
+
+import numpy as np
+
+from .blocks import BLOCK_VALUES, percentile
+
+# Labels up to this value are counted using np.bincount rather than sorting
+MAX_BINCOUNT_LABEL = 1024 * 1024
+
+class RegionIndex(object):
+    """
+    Index of the voxels in each region of an ROI
+
+    The index is built in a single pass over the ROI data and allows region-wise
+    analyses to extract the voxels in each region without comparing the whole
+    ROI with every region label. Voxels are identified by their index into the
+    flattened (C-order) 3D ROI array, and are sorted so that extracting values
+    gives the same result as indexing with a boolean mask, e.g. ``arr[roi == label]``.
+
+    :ivar shape: 3D shape of the ROI
+    :ivar labels: Sorted array of region labels, not including zero
+    :ivar counts: Array of number of voxels in each region, matching ``labels``
+    """
+
+    def __init__(self, roi_arr):
+        self.shape = tuple(roi_arr.shape[:3])
+        flat = np.asarray(roi_arr).reshape(-1).astype(np.int64)
+        nonzero = np.flatnonzero(flat)
+        values = flat[nonzero]
+
+        if values.size > 0 and values.min() >= 0 and values.max() <= MAX_BINCOUNT_LABEL:
+            all_counts = np.bincount(values)
+            self.labels = np.flatnonzero(all_counts)
+            self.counts = all_counts[self.labels]
+        else:
+            self.labels, self.counts = np.unique(values, return_counts=True)
+
+        # Stable sort keeps the voxels within each region in flat index order
+        self._indices = nonzero[np.argsort(values, kind="mergesort")]
+        self._offsets = np.concatenate([[0], np.cumsum(self.counts)]).astype(np.int64)
+        self._positions = dict([(label, pos) for pos, label in enumerate(self.labels)])
+        self._bboxes = None
+
+    def __contains__(self, label):
+        return label in self._positions
+
+    @property
+    def nbytes(self):
+        """ Approximate memory used by the index """
+        return self._indices.nbytes + self._offsets.nbytes + self.labels.nbytes + self.counts.nbytes
+
+    def position(self, label):
+        """
+        :return: Position of the region in ``labels``, or None if the region does not exist
+        """
+        return self._positions.get(label, None)
+
+    def count(self, label):
+        """
+        :return: Number of voxels in the region, zero if the region does not exist
+        """
+        pos = self._positions.get(label, None)
+        if pos is None:
+            return 0
+        return int(self.counts[pos])
+
+    def indices(self, label, start=None, stop=None):
+        """
+        Get the voxels in a region
+
+        :param label: Region label
+        :param start: If specified, only return voxels with flat index at least this value
+        :param stop: If specified, only return voxels with flat index less than this value
+        :return: Sorted array of flat voxel indices into the 3D ROI array
+        """
+        pos = self._positions.get(label, None)
+        if pos is None:
+            return np.array([], dtype=np.int64)
+        indices = self._indices[self._offsets[pos]:self._offsets[pos+1]]
+        if start is not None or stop is not None:
+            first = 0 if start is None else np.searchsorted(indices, start)
+            last = len(indices) if stop is None else np.searchsorted(indices, stop)
+            indices = indices[first:last]
+        return indices
+
+    def bbox(self, label):
+        """
+        :return: Tuple of 3 slices giving the bounding box of the region, or None if
+                 the region does not exist
+        """
+        pos = self._positions.get(label, None)
+        if pos is None:
+            return None
+        if self._bboxes is None:
+            # Bounding boxes of all regions are found together using the grouped indices
+            coords = np.unravel_index(self._indices, self.shape)
+            starts = [np.minimum.reduceat(coord, self._offsets[:-1]) for coord in coords]
+            stops = [np.maximum.reduceat(coord, self._offsets[:-1]) + 1 for coord in coords]
+            self._bboxes = [tuple([slice(int(starts[dim][idx]), int(stops[dim][idx])) for dim in range(3)])
+                            for idx in range(len(self.labels))]
+        return self._bboxes[pos]
+
+    def take(self, arr, label):
+        """
+        Extract the values of an array within a region
+
+        :param arr: 3D or 4D Numpy array on the same grid as the ROI
+        :return: 1D array of values for 3D data, 2D array of voxels x volumes for 4D data
+        """
+        return self._flat(arr)[self.indices(label)]
+
+    def put(self, arr, label, values):
+        """
+        Set the values of an array within a region
+
+        :param arr: 3D or 4D Numpy array on the same grid as the ROI
+        :param values: Values to set, e.g. a scalar or a 1D array of volume values for 4D data
+        """
+        if arr.flags.c_contiguous:
+            self._flat(arr)[self.indices(label)] = values
+        else:
+            arr[np.unravel_index(self.indices(label), self.shape)] = values
+
+    def values(self, data, label, vol=None):
+        """
+        Generate the values of a data set within a region, one block at a time
+
+        The data is read in slabs along the first axis, each of which covers a contiguous
+        range of flattened voxel indices, so the whole data set is not required in memory.
+
+        :param data: QpData instance on the same grid as the ROI
+        :param vol: If specified, only use values from this volume
+        :return: Generator of arrays of values as returned by :meth:`take`
+        """
+        bbox = self.bbox(label)
+        if bbox is None:
+            return
+
+        slice_voxels = self.shape[1] * self.shape[2]
+        limits = (bbox[0].start, bbox[0].stop)
+        for block in data.blocks(by="slab", axis=0, vol=vol, limits=limits):
+            start = block.slices[0].start * slice_voxels
+            indices = self.indices(label, start, block.slices[0].stop * slice_voxels) - start
+            yield self._flat(block.data)[indices]
+
+    def stats(self, data, vol=None, per_volume=False, hist_bins=20, hist_range=None):
+        """
+        Calculate summary statistics and histograms of a data set for every region
+
+        All regions are processed together, one slab of data at a time, using the
+        grouping of voxels by region in the index. Sums, minima and maxima are found 
+        in a first pass, followed by the variance and histograms in a second pass. 
+        Medians are found by selection on the values in each region, which are read 
+        using the bounding box of the region. Regions too large to hold in memory use
+        the streaming percentile calculation instead.
+
+        :param data: QpData instance on the same grid as the ROI
+        :param vol: If specified, only use values from this volume
+        :param per_volume: If True, calculate separate statistics for each volume of 4D data.
+                           Otherwise values from all volumes are combined
+        :param hist_bins: Number of histogram bins
+        :param hist_range: Histogram range. If not specified, the range of the values in 
+                           each region (and volume if ``per_volume``) is used
+        :return: Dictionary containing ``count``, ``mean``, ``median``, ``std``, ``min``, 
+                 ``max``, ``hist`` and ``hist_edges``. Each is an array whose first 
+                 dimension matches ``labels``. If ``per_volume`` the second dimension 
+                 is the volume. Histogram arrays have an additional last dimension for
+                 the histogram bins / bin edges. Statistics for regions with no values 
+                 are zero.
+        """
+        nregions = len(self.labels)
+        if per_volume and vol is None and data.nvols > 1:
+            ncols = data.nvols
+        else:
+            ncols = 1
+
+        # Pass 1: counts, sums, min and max
+        count = np.zeros(nregions, dtype=np.int64)
+        sums = np.zeros((nregions, ncols))
+        mins = np.full((nregions, ncols), np.inf)
+        maxs = np.full((nregions, ncols), -np.inf)
+        for present, starts, values in self._region_blocks(data, vol, ncols):
+            count[present] += np.diff(np.append(starts, values.shape[0])) * (values.shape[1] // ncols)
+            sums[present] += self._combine(np.add.reduceat(values, starts, axis=0), ncols, np.sum)
+            mins[present] = np.minimum(mins[present], self._combine(np.minimum.reduceat(values, starts, axis=0), ncols, np.min))
+            maxs[present] = np.maximum(maxs[present], self._combine(np.maximum.reduceat(values, starts, axis=0), ncols, np.max))
+
+        empty = count == 0
+        mean = sums / np.maximum(count, 1)[:, np.newaxis]
+        mins[empty], maxs[empty] = 0, 0
+
+        # Histogram bin edges, using the same defaults and bin edges as np.histogram
+        if hist_range is not None:
+            first_edge = np.full((nregions, ncols), float(hist_range[0]))
+            last_edge = np.full((nregions, ncols), float(hist_range[1]))
+        else:
+            first_edge, last_edge = mins.astype(np.float64), maxs.astype(np.float64)
+            first_edge[empty], last_edge[empty] = 0, 1
+        equal = first_edge == last_edge
+        first_edge[equal] -= 0.5
+        last_edge[equal] += 0.5
+        step = (last_edge - first_edge) / hist_bins
+        edges = np.arange(hist_bins+1) * step[..., np.newaxis] + first_edge[..., np.newaxis]
+        edges[..., -1] = last_edge
+
+        # Pass 2: sum of squared deviations from mean and histograms
+        sqdev = np.zeros((nregions, ncols))
+        hist = np.zeros((nregions * ncols * hist_bins,), dtype=np.int64)
+        for present, starts, values in self._region_blocks(data, vol, ncols):
+            rows = np.repeat(present, np.diff(np.append(starts, values.shape[0])))[:, np.newaxis]
+            cols = np.arange(values.shape[1])[np.newaxis, :] % ncols
+            sqdev[present] += self._combine(np.add.reduceat(np.square(values - mean[rows, cols]), starts, axis=0), ncols, np.sum)
+            hist += self._hist_counts(values, rows, cols, edges, hist_bins)
+        std = np.sqrt(sqdev / np.maximum(count, 1)[:, np.newaxis])
+
+        # Pass 3: medians
+        median = np.zeros((nregions, ncols))
+        for pos, label in enumerate(self.labels):
+            median[pos] = self._median(data, label, vol, ncols)
+
+        stats = {
+            "count" : count,
+            "mean" : mean,
+            "median" : median,
+            "std" : std,
+            "min" : mins,
+            "max" : maxs,
+            "hist" : hist.reshape((nregions, ncols, hist_bins)),
+            "hist_edges" : edges,
+        }
+        if ncols == 1:
+            for key in stats:
+                if key != "count":
+                    stats[key] = stats[key][:, 0]
+        return stats
+
+    def _region_blocks(self, data, vol, ncols):
+        """
+        Generate the values of a data set in all regions, one slab at a time
+
+        :return: Generator of tuples of (positions of regions present in the slab, 
+                 start row of each region in values, values). Values is a 2D array
+                 whose rows are voxels grouped by region and whose columns are volumes
+        """
+        slice_voxels = self.shape[1] * self.shape[2]
+        for block in data.blocks(by="slab", axis=0, vol=vol):
+            start = block.slices[0].start * slice_voxels
+            stop = block.slices[0].stop * slice_voxels
+            lower = np.zeros(len(self.labels), dtype=np.int64)
+            upper = np.zeros(len(self.labels), dtype=np.int64)
+            for pos in range(len(self.labels)):
+                first, last = self._offsets[pos], self._offsets[pos+1]
+                lower[pos] = first + np.searchsorted(self._indices[first:last], start)
+                upper[pos] = first + np.searchsorted(self._indices[first:last], stop)
+
+            present = np.flatnonzero(upper > lower)
+            if len(present) == 0:
+                continue
+            indices = np.concatenate([self._indices[lower[pos]:upper[pos]] for pos in present]) - start
+            starts = np.concatenate([[0], np.cumsum(upper[present] - lower[present])[:-1]])
+            values = self._flat(block.data)[indices]
+            yield present, starts, values.reshape(len(indices), -1)
+
+    def _combine(self, arr, ncols, func):
+        """ Combine reduced values from all volumes unless statistics are per volume """
+        if ncols == 1:
+            return func(arr, axis=1, keepdims=True)
+        return arr
+
+    def _hist_counts(self, values, rows, cols, edges, nbins):
+        """
+        Histogram counts for each region/volume, replicating the binning of np.histogram
+        """
+        first, last = edges[rows, cols, 0], edges[rows, cols, -1]
+        keep = (values >= first) & (values <= last)
+        values, rows, cols = values[keep], np.broadcast_to(rows, keep.shape)[keep], np.broadcast_to(cols, keep.shape)[keep]
+        first, last = first[keep], last[keep]
+
+        bins = ((values - first) * (nbins / (last - first))).astype(np.intp)
+        bins[bins == nbins] -= 1
+        bins[values < edges[rows, cols, bins]] -= 1
+        increment = (values >= edges[rows, cols, bins+1]) & (bins != nbins - 1)
+        bins[increment] += 1
+
+        ncols = edges.shape[1]
+        return np.bincount((rows * ncols + cols) * nbins + bins, minlength=edges.shape[0] * ncols * nbins)
+
+    def _median(self, data, label, vol, ncols):
+        nvalues = self.count(label) * (data.nvols if vol is None else 1)
+        if nvalues <= BLOCK_VALUES:
+            values = np.concatenate(list(self.values(data, label, vol=vol)))
+            values = values.reshape(values.shape[0], -1)
+            if ncols == 1:
+                return np.median(values)
+            return np.median(values, axis=0)
+        elif ncols == 1:
+            return percentile(lambda: self.values(data, label, vol=vol), 50)
+        else:
+            return [percentile(lambda: self.values(data, label, vol=col), 50) for col in range(ncols)]
+
+    def _flat(self, arr):
+        return arr.reshape((-1,) + tuple(arr.shape[3:]))
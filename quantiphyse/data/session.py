@@ -0,0 +1,246 @@
+"""
+Quantiphyse - Native session format for saving and restoring all the data in the IVM
+
+A session is a directory containing each data item as a ``.npy`` file and a single
+index file describing the grids, metadata (including view settings), extras and
+the main/current selections.
+
+Restoring a session only reads the index - data items are memory mapped from
+their files when first used. Saving a session over an existing one only rewrites
+items which have changed since they were last saved to it or loaded from it.
+
+The index is a Python pickle so sessions should only be opened from trusted sources.
+
+Copyright (c) 2013-2018 University of Oxford
+"""
+from __future__ import division, print_function
+
+import os
+import uuid
+import logging
+
+from six.moves import cPickle as pickle
+import numpy as np
+
+from quantiphyse.utils import QpException
+from .qpdata import DataGrid, QpData
+from .cache import sizeof
+
+LOG = logging.getLogger(__name__)
+
+#: Default extension for session directories
+SESSION_EXT = ".qps"
+
+#: Name of the index file within the session directory
+INDEX_FNAME = "index.pickle"
+
+SESSION_VERSION = 1
+
+# Identifies data objects created in this process, since data UIDs are only unique
+# within a process
+_PROCESS_TOKEN = uuid.uuid4().hex
+
+class SessionData(QpData):
+    """
+    QpData stored in a session, which is memory mapped from the session
+    directory when first used
+    """
+    def __init__(self, fname, name, grid, nvols, metadata=None):
+        """
+        :param fname: ``.npy`` file containing the data
+        :param name: Data name
+        :param grid: DataGrid
+        :param nvols: Number of volumes
+        :param metadata: Metadata dictionary as saved with the data
+        """
+        self.session_fname = fname
+        self.rawdata = None
+        QpData.__init__(self, name, grid, nvols)
+        if metadata is not None:
+            # Restored directly as ROI validation would require the data to be loaded
+            self._meta.update(metadata)
+
+    def raw(self):
+        # Copy-on-write mode so in-place modification never alters the session file
+        if self.rawdata is None:
+            self.rawdata = np.load(self.session_fname, mmap_mode="c")
+        return self.rawdata
+
+    @property
+    def memory_usage(self):
+        if self.version > 0:
+            # Modified pages of the copy-on-write map are held in memory
+            return sizeof(self.rawdata)
+        return 0
+
+    def uncache(self):
+        QpData.uncache(self)
+        if self.version == 0:
+            self.rawdata = None
+
+def _write_item(qpdata, fname):
+    """
+    Write a data item to a ``.npy`` file one volume at a time
+
+    The file is written under a temporary name and then renamed, so an
+    interrupted save does not leave a partial file in place of the old one
+    """
+    shape = list(qpdata.grid.shape)
+    if qpdata.nvols > 1:
+        shape.append(qpdata.nvols)
+
+    tmp_fname = fname + ".tmp"
+    arr = None
+    for vol in range(qpdata.nvols):
+        voldata = np.asarray(qpdata.volume(vol))
+        if arr is None:
+            arr = np.lib.format.open_memmap(tmp_fname, mode="w+", dtype=voldata.dtype, shape=tuple(shape))
+        if qpdata.nvols > 1:
+            arr[..., vol] = voldata
+        else:
+            arr[...] = voldata.reshape(shape)
+    arr.flush()
+    del arr
+    _replace(tmp_fname, fname)
+
+def _replace(src, dest):
+    if hasattr(os, "replace"):
+        os.replace(src, dest)
+    else:
+        # Python 2 on Windows cannot rename over an existing file
+        if os.path.exists(dest):
+            os.remove(dest)
+        os.rename(src, dest)
+
+def _picklable(extras):
+    """
+    :return: Dictionary of the extras which can be saved in the session index
+    """
+    ret = {}
+    for name, extra in extras.items():
+        try:
+            pickle.dumps(extra, 2)
+            ret[name] = extra
+        except Exception:
+            LOG.warn("Extra %s cannot be saved in a session", name)
+    return ret
+
+def _unchanged(qpdata, entry, path):
+    """
+    :return: True if a data item does not need to be rewritten to a session
+    """
+    if entry is None or entry["nvols"] != qpdata.nvols:
+        return False
+    if list(entry["shape"]) != list(qpdata.grid.shape) or not np.allclose(entry["affine"], qpdata.grid.affine):
+        return False
+    if isinstance(qpdata, SessionData) and qpdata.version == 0:
+        return os.path.abspath(qpdata.session_fname) == os.path.abspath(os.path.join(path, entry["file"]))
+    return (entry["token"], entry["uid"], entry["version"]) == (_PROCESS_TOKEN, qpdata.uid, qpdata.version)
+
+def _read_index(path):
+    fname = os.path.join(path, INDEX_FNAME)
+    try:
+        with open(fname, "rb") as index_file:
+            index = pickle.load(index_file)
+    except (IOError, OSError):
+        raise QpException("%s: Not a Quantiphyse session" % path)
+    except Exception as exc:
+        raise QpException("%s: Failed to read session index: %s" % (path, str(exc)))
+
+    if index.get("version", None) != SESSION_VERSION:
+        raise QpException("%s: Unsupported session version: %s" % (path, index.get("version", None)))
+    return index
+
+def save_session(ivm, path):
+    """
+    Save all data, extras and selections in the IVM to a session directory
+
+    If the directory already contains a session, data items which have not changed
+    since they were saved to it, or loaded from it, are not rewritten.
+
+    :param ivm: ImageVolumeManagement
+    :param path: Session directory. It is created if it does not exist
+    """
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    old_index = {"items" : {}, "generation" : 0}
+    if os.path.exists(os.path.join(path, INDEX_FNAME)):
+        old_index = _read_index(path)
+    generation = old_index["generation"] + 1
+
+    items = {}
+    for name, qpdata in ivm.data.items():
+        entry = old_index["items"].get(name, None)
+        if _unchanged(qpdata, entry, path):
+            LOG.debug("Session item %s is unchanged", name)
+            fname = entry["file"]
+        else:
+            fname = "%s.%i.npy" % (name, generation)
+            LOG.debug("Writing session item %s to %s", name, fname)
+            _write_item(qpdata, os.path.join(path, fname))
+
+        items[name] = {
+            "file" : fname,
+            "shape" : list(qpdata.grid.shape),
+            "affine" : qpdata.grid.affine,
+            "units" : qpdata.grid.units,
+            "nvols" : qpdata.nvols,
+            "metadata" : dict(qpdata.metadata),
+            "token" : _PROCESS_TOKEN,
+            "uid" : qpdata.uid,
+            "version" : qpdata.version,
+        }
+
+    index = {
+        "version" : SESSION_VERSION,
+        "generation" : generation,
+        "items" : items,
+        "main" : ivm.main.name if ivm.main is not None else None,
+        "current_data" : ivm.current_data.name if ivm.current_data is not None else None,
+        "current_roi" : ivm.current_roi.name if ivm.current_roi is not None else None,
+        "extras" : _picklable(ivm.extras),
+    }
+
+    # Replace the index in a single step so the session is never left inconsistent
+    tmp_fname = os.path.join(path, INDEX_FNAME + ".tmp")
+    with open(tmp_fname, "wb") as index_file:
+        pickle.dump(index, index_file, protocol=2)
+    _replace(tmp_fname, os.path.join(path, INDEX_FNAME))
+
+    # Remove files for data which has been deleted or rewritten
+    used = set([entry["file"] for entry in items.values()])
+    for old_entry in old_index["items"].values():
+        if old_entry["file"] not in used:
+            try:
+                os.remove(os.path.join(path, old_entry["file"]))
+            except OSError:
+                # e.g. file is still memory mapped on Windows
+                LOG.debug("Could not remove old session file %s", old_entry["file"])
+
+def load_session(path, ivm):
+    """
+    Restore a saved session, replacing any data currently in the IVM
+
+    Data items are not read until they are first used
+
+    :param path: Session directory
+    :param ivm: ImageVolumeManagement
+    """
+    index = _read_index(path)
+
+    ivm.reset()
+    for name, entry in index["items"].items():
+        grid = DataGrid(entry["shape"], np.array(entry["affine"]), units=entry["units"])
+        qpdata = SessionData(os.path.join(path, entry["file"]), name, grid, entry["nvols"], entry["metadata"])
+        ivm.add(qpdata, make_main=False, make_current=False)
+
+    for name, extra in index["extras"].items():
+        ivm.add_extra(name, extra)
+
+    if index["main"] is not None:
+        ivm.set_main_data(index["main"])
+    if index["current_data"] is not None:
+        ivm.set_current_data(index["current_data"])
+    if index["current_roi"] is not None:
+        ivm.set_current_roi(index["current_roi"])
@@ -0,0 +1,200 @@
+"""
+Quantiphyse - Views of part of a data item which share the data of the original item
+
+Copyright (c) 2013-2018 University of Oxford
+"""
+from __future__ import division, print_function
+
+import logging
+
+import numpy as np
+
+from quantiphyse.utils import QpException
+from .qpdata import QpData, NumpyData, DataGrid
+
+LOG = logging.getLogger(__name__)
+
+def _compose(outer, inner, size):
+    """
+    Combine an index into a sliced axis with the slice to give an index into the original axis
+
+    :param outer: Slice with non-negative start and stop and positive step
+    :param inner: Slice or integer index into the sliced axis
+    :param size: Length of the sliced axis
+    """
+    if isinstance(inner, slice):
+        start, stop, step = inner.indices(size)
+        if step < 0:
+            raise QpException("Negative steps are not supported when indexing data views")
+        stop = max(start, stop)
+        return slice(outer.start + start*outer.step, outer.start + stop*outer.step, step*outer.step)
+    else:
+        if inner < 0:
+            inner += size
+        return outer.start + inner*outer.step
+
+def _as_slice(indices):
+    """
+    :return: Slice equivalent to a sequence of evenly spaced increasing indices, or the
+             indices unchanged if there is no equivalent slice
+    """
+    indices = list(indices)
+    if not indices:
+        return indices
+    step = indices[1] - indices[0] if len(indices) > 1 else 1
+    if step > 0 and indices == list(range(indices[0], indices[-1]+1, step)):
+        return slice(indices[0], indices[-1]+1, step)
+    return indices
+
+class DataView(QpData):
+    """
+    Base class for data which is defined by part of another data item
+
+    Data is read from the parent item when required so a view does not hold a copy
+    of the data. If the parent keeps its data in memory, ``raw()`` returns a Numpy
+    view of the parent's array where possible so modifying it modifies the parent.
+
+    The version stamp includes the parent's version, so cached data derived from the
+    view is not reused after the parent is modified
+    """
+    def __init__(self, parent, name, grid, nvols, **kwargs):
+        self.parent = parent
+        QpData.__init__(self, name, grid, nvols, **kwargs)
+        # The parent has already been validated as an ROI
+        self._meta["roi"] = parent.roi and nvols == 1
+
+    @property
+    def version(self):
+        return self._version + self.parent.version
+
+    def raw(self):
+        return self._read_block(self._block_index([slice(None)] * 3))
+
+    def volume(self, vol, qpdata=False):
+        vol = min(vol, self.nvols-1)
+        voldata = self._read_block(self._block_index([slice(None)] * 3, vol))
+        if qpdata:
+            return NumpyData(voldata, grid=self.grid, name="%s_vol_%i" % (self.name, vol))
+        else:
+            return voldata
+
+    def _read_block(self, index):
+        return self.parent._read_block(self._parent_index(index))
+
+    def _parent_index(self, index):
+        """
+        :param index: Tuple of slices/indices into the raw data of this view
+        :return: Tuple of slices/indices into the raw data of the parent
+        """
+        raise NotImplementedError("Data views must implement _parent_index")
+
+class CropData(DataView):
+    """
+    View of a box within another data item
+
+    The grid of the view covers just the box, with the affine adjusted so that
+    voxels are in the same place in world space as in the parent
+    """
+    def __init__(self, parent, slices, name=None, **kwargs):
+        """
+        :param parent: QpData item to crop
+        :param slices: Sequence of 3 slice objects giving the box within the parent's grid,
+                       e.g. as returned by :meth:`QpData.get_bounding_box`. Steps other than 1
+                       may be used to subsample the data
+        :param name: Data name. Defaults to the parent name with a ``_crop`` suffix
+        """
+        if len(slices) != 3:
+            raise QpException("Crop requires a slice for each of the 3 spatial dimensions")
+
+        self.slices = []
+        shape = []
+        for dim_slice, size in zip(slices, parent.grid.shape):
+            start, stop, step = dim_slice.indices(size)
+            if step < 1:
+                raise QpException("Crop slices must have a positive step")
+            shape.append(len(range(start, stop, step)))
+            self.slices.append(slice(start, start + shape[-1]*step, step))
+        if min(shape) < 1:
+            raise QpException("Crop region is empty")
+
+        affine = np.array(parent.grid.affine, dtype=np.float64)
+        affine[:3, 3] = np.dot(parent.grid.affine, [s.start for s in self.slices] + [1])[:3]
+        affine[:3, :3] *= [s.step for s in self.slices]
+        grid = DataGrid(shape, affine, units=parent.grid.units)
+
+        if name is None:
+            name = parent.name + "_crop"
+        DataView.__init__(self, parent, name, grid, parent.nvols, **kwargs)
+
+    def _parent_index(self, index):
+        spatial = [_compose(outer, inner, size) for outer, inner, size in zip(self.slices, index[:3], self.grid.shape)]
+        return tuple(spatial) + tuple(index[3:])
+
+    def uncrop(self, data, fill=0):
+        """
+        Place data defined on the grid of this view into an array on the parent's grid
+
+        :param data: 3D or 4D Numpy array whose spatial dimensions match this view's grid
+        :param fill: Value for voxels outside the box
+        :return: Numpy array on the parent's grid with the same data type and number of
+                 volumes as ``data``
+        """
+        data = np.asarray(data)
+        if list(data.shape[:3]) != list(self.grid.shape):
+            raise QpException("Data has shape %s - expected %s" % (list(data.shape[:3]), list(self.grid.shape)))
+        output = np.full(list(self.parent.grid.shape) + list(data.shape[3:]), fill, dtype=data.dtype)
+        output[tuple(self.slices)] = data
+        return output
+
+class VolumeSubsetData(DataView):
+    """
+    View of a subset of the volumes in another data item
+
+    The view is defined on the parent's grid. Volumes may be given as a slice or
+    as a sequence of volume indices. If the volumes are evenly spaced, ``raw()``
+    returns a view of the parent's array where possible
+    """
+    def __init__(self, parent, vols, name=None, **kwargs):
+        """
+        :param parent: QpData item
+        :param vols: Slice or sequence of volume indices
+        :param name: Data name. Defaults to the parent name with a ``_vols`` suffix
+        """
+        if isinstance(vols, slice):
+            vols = range(parent.nvols)[vols]
+        self.vols = [int(vol) for vol in vols]
+        if not self.vols:
+            raise QpException("No volumes selected")
+        for vol in self.vols:
+            if vol < 0 or vol >= parent.nvols:
+                raise QpException("Volume %i out of range for %s" % (vol, parent.name))
+
+        if name is None:
+            name = parent.name + "_vols"
+        DataView.__init__(self, parent, name, parent.grid, len(self.vols), **kwargs)
+
+    def _parent_index(self, index):
+        spatial = tuple(index[:3])
+        if self.nvols == 1:
+            vols = self.vols[0]
+        else:
+            vols = index[3] if len(index) > 3 else slice(None)
+            if isinstance(vols, slice):
+                vols = _as_slice(self.vols[vols])
+            else:
+                vols = self.vols[vols]
+
+        if self.parent.nvols == 1:
+            # Only possible subset of 3D data is the data itself
+            return spatial
+        else:
+            return spatial + (vols, )
+
+    def _read_block(self, index):
+        index = self._parent_index(index)
+        if len(index) > 3 and isinstance(index[3], list):
+            # Volumes which are not evenly spaced are read one at a time, since
+            # file based data may not support indexing with a list
+            spatial = index[:3]
+            return np.stack([self.parent._read_block(spatial + (vol, )) for vol in index[3]], axis=-1)
+        return self.parent._read_block(index)
@@ -9,6 +9,7 @@ from __future__ import division
 import logging
 import keyword
 import re
+import collections
 
 from PySide import QtCore
 
@@ -22,6 +23,9 @@ from .extras import Extra
 
 LOG = logging.getLogger(__name__)
 
+# QSettings key for the default memory budget in Mb. Zero means no limit
+MEMORY_BUDGET_KEY = "memory_budget_mb"
+
 class ImageVolumeManagement(QtCore.QObject):
     """
     Holds all image datas used in analysis
@@ -37,6 +41,11 @@ class ImageVolumeManagement(QtCore.QObject):
       ``current_roi`` QpData with ``roi=True`` used as the current ROI
       ``extras`` Mapping from name to object for miscellaneous extra data.
                  Extras must support string-conversion for writing to files.
+      ``memory_budget`` Approximate limit in bytes on the memory used by data items,
+                        or None for no limit. When the budget is exceeded the least
+                        recently used data items are uncached, e.g. written to
+                        temporary files. Main data, current data and ROIs are never
+                        uncached by the budget manager.
     """
     # Signals
 
@@ -55,14 +64,21 @@ class ImageVolumeManagement(QtCore.QObject):
     # Change to set of extras (e.g. new one added)
     sig_extras = QtCore.Signal(list)
 
-    def __init__(self):
+    def __init__(self, memory_budget=None):
         super(ImageVolumeManagement, self).__init__()
+        if memory_budget is None:
+            budget_mb = int(QtCore.QSettings().value(MEMORY_BUDGET_KEY, 0))
+            if budget_mb > 0:
+                memory_budget = budget_mb * 1024 * 1024
+        self.memory_budget = memory_budget
+        self._recent = collections.OrderedDict()
         self.reset()
 
     def reset(self):
         """ Clear all data """
         self.main = None
         self.data = {}
+        self._recent.clear()
         self.current_data = None
         self.current_roi = None
         self.extras = {}
@@ -114,6 +130,7 @@ class ImageVolumeManagement(QtCore.QObject):
         """
         self._data_exists(name)
         self.main = self.data[name]
+        self.touch(name)
         self.sig_main_data.emit(self.main)
 
     def add(self, data, name=None, grid=None, make_current=None, make_main=None, roi=None):
@@ -146,6 +163,7 @@ class ImageVolumeManagement(QtCore.QObject):
         
         # If replacing existing data, delete the old one first
         if data.name in self.data:
+            self.data[data.name].release()
             del self.data[data.name]
             if self.current_data is not None and self.current_data.name == data.name:
                 make_current = True
@@ -153,6 +171,7 @@ class ImageVolumeManagement(QtCore.QObject):
                 make_main = True
             
         self.data[data.name] = data
+        self.touch(data.name)
 
         # Make main data if requested or if not specified and there is no current main data
         if make_main is None:
@@ -173,6 +192,50 @@ class ImageVolumeManagement(QtCore.QObject):
             else:
                 self.set_current_data(data.name)
 
+        self.apply_memory_budget()
+
+    def touch(self, name):
+        """
+        Record that a data item has been used
+
+        This affects which data items are uncached first when the memory budget
+        is exceeded
+
+        :param name: Name of data item which must exist within the IVM
+        """
+        self._data_exists(name)
+        self._recent.pop(name, None)
+        self._recent[name] = True
+
+    def memory_usage(self):
+        """
+        :return: Dictionary of data name : approximate memory in bytes currently used
+                 to hold the data
+        """
+        return dict([(name, qpd.memory_usage) for name, qpd in self.data.items()])
+
+    def apply_memory_budget(self):
+        """
+        Uncache the least recently used data items until memory usage is within the budget
+
+        Main data, current data and ROIs are never uncached as they are likely to
+        be accessed frequently
+        """
+        if self.memory_budget is None:
+            return
+
+        usage = self.memory_usage()
+        total = sum(usage.values())
+        for name in list(self._recent.keys()):
+            if total <= self.memory_budget:
+                break
+            qpd = self.data[name]
+            if qpd.roi or self.is_main_data(qpd) or self.is_current_data(qpd) or not usage[name]:
+                continue
+            LOG.debug("Memory usage %i exceeds budget %i - uncaching %s", total, self.memory_budget, name)
+            qpd.uncache()
+            total += qpd.memory_usage - usage[name]
+
     def _data_exists(self, name):
         if name not in self.data:
             raise RuntimeError("Data '%s' does not exist" % name)
@@ -211,6 +274,7 @@ class ImageVolumeManagement(QtCore.QObject):
         if name is not None:
             self._data_exists(name)
             self.current_data = self.data[name]
+            self.touch(name)
         else:
             self.current_data = None
         self.sig_current_data.emit(self.current_data)
@@ -241,6 +305,7 @@ class ImageVolumeManagement(QtCore.QObject):
         qpd.name = newname
         self.data[newname] = qpd
         del self.data[name]
+        self._recent = collections.OrderedDict([(newname if key == name else key, True) for key in self._recent])
         self.sig_all_data.emit(list(self.data.keys()))
 
     def delete(self, name):
@@ -250,7 +315,9 @@ class ImageVolumeManagement(QtCore.QObject):
         :param name: Name of data item which must exist within the IVM
         """
         self._data_exists(name)
+        self.data[name].release()
         del self.data[name]
+        self._recent.pop(name, None)
         if self.current_data is not None and self.current_data.name == name:
             self.current_data = None
             self.sig_current_data.emit(None)
@@ -268,6 +335,7 @@ class ImageVolumeManagement(QtCore.QObject):
         if name is not None:
             self._roi_exists(name)
             self.current_roi = self.rois[name]
+            self.touch(name)
         else:
             self.current_roi = None
         self.sig_current_roi.emit(self.current_roi)
@@ -289,6 +357,34 @@ class ImageVolumeManagement(QtCore.QObject):
         self.extras[name] = obj
         self.sig_extras.emit(self.extras.values())
 
+    def sample(self, points, grid=None, vols=None, order=0, fill=0, names=None):
+        """
+        Sample multiple data items at multiple points
+
+        The points are transformed once for each distinct data grid, so this is much
+        faster than sampling each data item separately when many items share a grid.
+
+        :param points: Sequence of 3D positions, e.g. an N x 3 array. If ``grid`` not
+                       specified, positions are in world space
+        :param grid: If specified, interpret positions in this ``DataGrid`` co-ordinate space
+        :param vols: Volume index or sequence of volume indices - see ``QpData.sample``
+        :param order: Interpolation order - see ``QpData.sample``
+        :param fill: Value returned for points outside the data
+        :param names: Sequence of data names to sample. If not specified, all data is sampled
+        :return: Dictionary of data name : array of values as returned by ``QpData.sample``
+        """
+        if names is None:
+            names = list(self.data.keys())
+
+        samples, grid_coords = {}, {}
+        for name in names:
+            qpd = self.data[name]
+            key = qpd.grid.key()
+            if key not in grid_coords:
+                grid_coords[key] = qpd.grid.grid_to_grid_points(points, from_grid=grid)
+            samples[name] = qpd.sample_coords(grid_coords[key], vols=vols, order=order, fill=fill)
+        return samples
+
     def values(self, pos, grid=None):
         """
         Get all the 3D data values at the current position
@@ -298,14 +394,8 @@ class ImageVolumeManagement(QtCore.QObject):
         :param grid: If specified, interpret position in this ``DataGrid`` co-ordinate space.
         :return: Dictionary of data name : value
         """
-        values = {}
-
-        # loop over all loaded data and save values in a dictionary
-        for name, qpd in self.data.items():
-            if qpd.nvols == 1:
-                values[name] = qpd.value(pos, grid)
-                
-        return values
+        names = [name for name, qpd in self.data.items() if qpd.nvols == 1]
+        return dict([(name, values[0]) for name, values in self.sample([pos[:3]], grid, vols=0, names=names).items()])
 
     def timeseries(self, pos, grid=None):
         """
@@ -0,0 +1,140 @@
+"""
+Quantiphyse - Table of the values of a data set at the voxels within an ROI
+
+Copyright (c) 2013-2018 University of Oxford
+"""
+
+from __future__ import division
+
+import numpy as np
+
+class VoxelTable(object):
+    """
+    Values of a data set at a set of voxels, as a contiguous voxels x volumes matrix
+
+    Many analyses (e.g. clustering and PCA) work on the timeseries of the voxels within
+    an ROI. The table extracts these once and remembers which voxel each row came from
+    so results can be placed back into an image. Voxels are identified by their index
+    into the flattened (C-order) 3D grid and are sorted, so rows are in the same order
+    as indexing with a boolean mask, e.g. ``arr[mask]``.
+
+    Tables only contain Numpy arrays so they can be passed to worker processes.
+    For data items, use :meth:`QpData.voxel_table` which caches the table.
+
+    :ivar shape: 3D shape of the grid
+    :ivar indices: Sorted array of flat voxel indices
+    :ivar values: 2D array of voxels x volumes in the working data type
+    :ivar labels: Array of ROI labels for each voxel, if labels were given, otherwise None
+    """
+
+    def __init__(self, data, mask=None, labels=None, dtype=None):
+        """
+        :param data: QpData instance or 3D/4D Numpy array. QpData is read in slabs so
+                     the whole data set is not required in memory
+        :param mask: Optional 3D boolean array selecting voxels. If not given, all
+                     voxels are included
+        :param labels: Optional 3D array, e.g. ROI data, whose values at the selected
+                       voxels are stored in ``labels``
+        :param dtype: Data type of ``values``. Defaults to the working data type
+        """
+        if dtype is None:
+            # Imported here as the data module uses this one
+            from .qpdata import working_dtype
+            dtype = working_dtype()
+
+        if hasattr(data, "grid"):
+            self.shape = tuple(data.grid.shape)
+            nvols = data.nvols
+        else:
+            self.shape = tuple(data.shape[:3])
+            nvols = data.shape[3] if data.ndim > 3 else 1
+
+        if mask is None:
+            self.indices = np.arange(int(np.prod(self.shape)), dtype=np.int64)
+        else:
+            mask = np.asarray(mask)
+            if tuple(mask.shape[:3]) != self.shape:
+                raise ValueError("Mask has shape %s - expected %s" % (list(mask.shape), list(self.shape)))
+            self.indices = np.flatnonzero(mask).astype(np.int64)
+
+        self.values = np.empty((len(self.indices), nvols), dtype=dtype)
+        if hasattr(data, "grid"):
+            self._read(data)
+        else:
+            self.values[...] = self._flat(np.asarray(data))[self.indices].reshape(-1, nvols)
+
+        self.labels = None
+        if labels is not None:
+            self.labels = self.take(np.asarray(labels))
+
+    @property
+    def nvoxels(self):
+        """ Number of voxels in the table """
+        return self.values.shape[0]
+
+    @property
+    def nvols(self):
+        """ Number of volumes in the table """
+        return self.values.shape[1]
+
+    @property
+    def nbytes(self):
+        """ Approximate memory used by the table """
+        nbytes = self.values.nbytes + self.indices.nbytes
+        if self.labels is not None:
+            nbytes += self.labels.nbytes
+        return nbytes
+
+    def take(self, arr):
+        """
+        Extract the values of another array at the voxels in the table
+
+        :param arr: 3D or 4D Numpy array on the same grid
+        :return: 1D array for 3D data, 2D array of voxels x volumes for 4D data
+        """
+        return self._flat(arr)[self.indices]
+
+    def scatter(self, values, fill=0, dtype=None, output=None):
+        """
+        Place values for each voxel in the table into an image
+
+        :param values: 1D array with a value for each voxel, or 2D array with a row of
+                       values for each voxel, e.g. volumes or features
+        :param fill: Value for voxels not in the table
+        :param dtype: Data type of the output. Defaults to the data type of ``values``
+        :param output: Optional existing array to set the values in. ``fill`` is not
+                       used in this case
+        :return: 3D array, or 4D array if ``values`` is 2D
+        """
+        values = np.asarray(values)
+        if values.shape[0] != self.nvoxels:
+            raise ValueError("Expected values for %i voxels, got %i" % (self.nvoxels, values.shape[0]))
+        if output is None:
+            if dtype is None:
+                dtype = values.dtype
+            output = np.full(self.shape + tuple(values.shape[1:]), fill, dtype=dtype)
+
+        if output.flags.c_contiguous:
+            self._flat(output)[self.indices] = values
+        else:
+            output[np.unravel_index(self.indices, self.shape)] = values
+        return output
+
+    def _read(self, data):
+        """
+        Read the values from a data item one slab at a time
+        """
+        if self.nvoxels == 0:
+            return
+        slice_voxels = self.shape[1] * self.shape[2]
+        limits = (int(self.indices[0] // slice_voxels), int(self.indices[-1] // slice_voxels) + 1)
+        row = 0
+        for block in data.blocks(by="slab", axis=0, limits=limits):
+            start = block.slices[0].start * slice_voxels
+            stop = np.searchsorted(self.indices, block.slices[0].stop * slice_voxels)
+            indices = self.indices[row:stop] - start
+            self.values[row:stop] = self._flat(block.data)[indices].reshape(len(indices), -1)
+            row = stop
+
+    def _flat(self, arr):
+        return arr.reshape((-1,) + tuple(arr.shape[3:]))
@@ -12,7 +12,7 @@ import numpy as np
 import pyqtgraph as pg
 from pyqtgraph.exporters.ImageExporter import ImageExporter
 
-from quantiphyse.utils import LogSource
+from quantiphyse.utils import LogSource, sf
 from quantiphyse.data import OrthoSlice, DataGrid
 from quantiphyse.gui.widgets import OptionsButton
 
@@ -20,6 +20,9 @@ from .HistogramWidget import MultiImageHistogramWidget
 from .pickers import PICKERS, PointPicker
 from .data_views import MainDataView, OverlayView, RoiView, OverlayViewWidget, RoiViewWidget
 
+#: Time in ms after the view stops changing before it is redrawn at full resolution
+SETTLE_TIME_MS = 200
+
 class OrthoView(pg.GraphicsView):
     """
     A single slice view of data and ROI
@@ -82,6 +85,12 @@ class OrthoView(pg.GraphicsView):
         self.resizeEventOrig = self.resizeEvent
         self.resizeEvent = self.resize_win
 
+        # Redraw at full resolution when the view stops changing
+        self._settle_timer = QtCore.QTimer()
+        self._settle_timer.setSingleShot(True)
+        self._settle_timer.setInterval(SETTLE_TIME_MS)
+        self._settle_timer.timeout.connect(self._update_slices)
+
         self.ivl.sig_focus_changed.connect(self.update)
         self.ivl.sig_arrows_changed.connect(self._arrows_changed)
     
@@ -125,12 +134,17 @@ class OrthoView(pg.GraphicsView):
         self._update_arrows()
 
         if self.force_redraw or self.focus_pos[self.zaxis] != self.slice_z or self.slice_vol != self.focus_pos[3]:
+            # Redraws caused by moving through the data may be done at reduced 
+            # resolution, followed by a full redraw when the movement stops
+            fast = not self.force_redraw
             self.slice_z = self.focus_pos[self.zaxis]
             self.slice_vol = self.focus_pos[3]
             self.slice_plane = OrthoSlice(self.ivl.grid, self.zaxis, self.focus_pos[self.zaxis])
             self.force_redraw = False
             for view in self._data_views:
-                view.redraw(self.vb, self.slice_plane, self.slice_vol)
+                view.redraw(self.vb, self.slice_plane, self.slice_vol, fast=fast)
+            if fast:
+                self._settle_timer.start()
 
     def _update_slices(self):
         self.force_redraw = True
@@ -315,15 +329,17 @@ class DataSummary(QtGui.QWidget):
     def _update(self):
         pos, grid = self.ivl.focus(), self.ivl.grid
         main, roi, data = self.ivl.ivm.main, self.ivl.ivm.current_roi, self.ivl.ivm.current_data
+        names = [qpd.name for qpd in (main, roi, data) if qpd is not None]
+        values = self.ivl.ivm.sample([pos[:3]], grid, vols=int(pos[3]), names=names)
         if main is not None:
-            self.vol_data.setText(main.value(pos, grid, as_str=True))
+            self.vol_data.setText(sf(values[main.name][0]))
         if roi is not None:
-            roi_value = roi.regions.get(int(roi.value(pos, grid)), "")
+            roi_value = roi.regions.get(int(values[roi.name][0]), "")
             if roi_value == "":
                 roi_value = "1"
             self.roi_region.setText(roi_value)
         if data is not None:
-            self.ov_data.setText(data.value(pos, grid, as_str=True))
+            self.ov_data.setText(sf(values[data.name][0]))
 
 class Navigator(LogSource):
     """
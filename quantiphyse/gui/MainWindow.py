@@ -13,7 +13,7 @@ import numpy as np
 from PySide import QtCore, QtGui
 import pyqtgraph.console
 
-from quantiphyse.data import load, save, ImageVolumeManagement
+from quantiphyse.data import load, save, save_session, load_session, ImageVolumeManagement
 from quantiphyse.gui.widgets import FingerTabWidget
 from quantiphyse.utils import get_icon, get_local_file, get_version, get_plugins, local_file_from_drop_url, show_help
 from quantiphyse import __contrib__, __acknowledge__
@@ -239,6 +239,16 @@ class MainWindow(QtGui.QMainWindow):
         save_roi_action.setStatusTip('Save current ROI as a NIFTI file')
         save_roi_action.triggered.connect(self.save_roi)
 
+        # File --> Open session
+        open_session_action = QtGui.QAction(QtGui.QIcon.fromTheme("document-open"), '&Open session', self)
+        open_session_action.setStatusTip('Restore all data from a saved session')
+        open_session_action.triggered.connect(self.open_session)
+
+        # File --> Save session
+        save_session_action = QtGui.QAction(QtGui.QIcon.fromTheme("document-save-as"), 'Save session', self)
+        save_session_action.setStatusTip('Save all data, extras and view settings as a session')
+        save_session_action.triggered.connect(self.save_session)
+
         # File --> Clear all
         clear_action = QtGui.QAction(QtGui.QIcon.fromTheme("clear"), '&Clear all data', self)
         clear_action.setStatusTip('Remove all data from the viewer')
@@ -279,6 +289,8 @@ class MainWindow(QtGui.QMainWindow):
         file_menu.addAction(load_action)
         file_menu.addAction(save_ovreg_action)
         file_menu.addAction(save_roi_action)
+        file_menu.addAction(open_session_action)
+        file_menu.addAction(save_session_action)
         file_menu.addAction(clear_action)
         file_menu.addAction(exit_action)
 
@@ -430,13 +442,16 @@ class MainWindow(QtGui.QMainWindow):
         
         self.ivm.add(data, make_main=options.make_main, make_current=not options.make_main)
 
-    def load_data(self, fname):
+    def load_data(self, fname, mmap="auto"):
         """
         Load data non-interactively. The data will not be flagged as an ROI but the user
         can change that later if they want. Any finer control and you need to use interactive
         loading.
+
+        :param fname: File name
+        :param mmap: Memory mapping policy - True, False or ``auto``
         """
-        qpdata = load(fname)
+        qpdata = load(fname, mmap=mmap)
         name = self.ivm.suggest_name(os.path.split(fname)[1].split(".", 1)[0])
         qpdata.name = name
         self.ivm.add(qpdata)
@@ -467,6 +482,26 @@ class MainWindow(QtGui.QMainWindow):
             else: # Cancelled
                 pass
 
+    def open_session(self):
+        """
+        Dialog for restoring a saved session, replacing the current data
+        """
+        path = QtGui.QFileDialog.getExistingDirectory(self, 'Open session', dir=self.default_directory)
+        if path:
+            self.default_directory = os.path.dirname(path)
+            load_session(path, self.ivm)
+
+    def save_session(self):
+        """
+        Dialog for saving all data as a session
+        """
+        path, _ = QtGui.QFileDialog.getSaveFileName(self, 'Save session', dir=self.default_directory, filter="Quantiphyse sessions (*.qps)")
+        if path:
+            if not path.endswith(".qps"):
+                path += ".qps"
+            self.default_directory = os.path.dirname(path)
+            save_session(self.ivm, path)
+
     def _clear(self):
         if self.ivm.data:
             msg_box = QtGui.QMessageBox()
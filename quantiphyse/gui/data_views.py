@@ -8,6 +8,7 @@ from __future__ import division, unicode_literals, absolute_import, print_functi
 
 import collections
 import logging
+import math
 
 from PySide import QtCore, QtGui
 import numpy as np
@@ -115,13 +116,16 @@ class DataView(QtCore.QObject):
             if name in self.redraw_options:
                 self.sig_redraw.emit(self)
 
-    def redraw(self, viewbox, slice_plane, slice_vol):
+    def redraw(self, viewbox, slice_plane, slice_vol, fast=False):
         """
         Redraw graphics items associated with the specified pg.ViewBox
 
         :param viewbox: pg.ViewBox to redraw
         :param slice_plane: OrthoSlice defining the slice to draw
         :param slice_vol: Index of the volume to use
+        :param fast: If True, the view is changing rapidly, e.g. while scrolling through
+                     slices, so a reduced resolution may be drawn. A redraw with 
+                     ``fast=False`` will follow when the view stops changing
         """
         pass
 
@@ -147,26 +151,42 @@ class ImageDataView(DataView):
             "cmap_range" : None,
             "z_value" : -1,
             "interp_order" : 0,
+            "pyramid" : True,
         }
-        self.redraw_options += ["visible", "roi_only", "z_value", "interp_order"]
+        self.redraw_options += ["visible", "roi_only", "z_value", "interp_order", "pyramid"]
         self.imgs = {}
         self.histogram = None
         self.mask = None
 
-    def redraw(self, viewbox, slice_plane, slice_vol):
+    def redraw(self, viewbox, slice_plane, slice_vol, fast=False):
         img = self._get_img(viewbox)
         self.update()
         if img.isVisible():
-            slicedata, slicemask, scale, offset = self.data.slice_data(slice_plane, vol=slice_vol, interp_order=self.get("interp_order"))
+            level = 0
+            if fast and self.get("pyramid"):
+                level = self._pyramid_level(viewbox, slice_plane)
+            slicedata, slicemask, scale, offset = self.data.slice_data(slice_plane, vol=slice_vol, interp_order=self.get("interp_order"), level=level)
             img.setTransform(QtGui.QTransform(scale[0, 0], scale[0, 1], scale[1, 0], scale[1, 1],
                                               offset[0], offset[1]))
             img.setImage(slicedata, autoLevels=False)
 
             if self.mask is not None and self.get("roi_only"):
-                maskdata, _, _, _ = self.mask.slice_data(slice_plane)
+                maskdata, _, _, _ = self.mask.slice_data(slice_plane, level=level)
                 img.mask = np.logical_and(maskdata, slicemask)
             else:
                 img.mask = slicemask
+
+    def _pyramid_level(self, viewbox, slice_plane):
+        """
+        :return: Level of the data's reduced resolution pyramid whose voxels best match 
+                 the size of a screen pixel in the view. 0 if the view is zoomed in enough
+                 that the full resolution data is required
+        """
+        pixel_size = min(viewbox.viewPixelSize())
+        voxel_size = min(self.data.grid.spacing) / max(slice_plane.spacing[:2])
+        if not np.isfinite(pixel_size) or pixel_size <= voxel_size:
+            return 0
+        return min(int(math.log(pixel_size / voxel_size, 2)), self.data.pyramid_levels - 1)
        
     def update(self):
         for img in self.imgs.values():
@@ -264,7 +284,7 @@ class RoiView(ImageDataView):
 
         self.ivm.sig_current_roi.connect(self._current_roi_changed)
 
-    def redraw(self, viewbox, slice_plane, slice_vol):
+    def redraw(self, viewbox, slice_plane, slice_vol, fast=False):
         img = self._get_img(viewbox)
         contours = self._get_contours(viewbox)
         self.update()
@@ -40,6 +40,7 @@ import numpy as np
 import pyqtgraph as pg
 from PIL import Image, ImageDraw
 
+from quantiphyse.data.qpdata import label_dtype
 from quantiphyse.utils import LogSource
 
 class PickMode(object):
@@ -269,7 +270,7 @@ class PolygonPicker(Picker):
         img = Image.new('L', (w, h), 0)
         ImageDraw.Draw(img).polygon(points, outline=label, fill=label)
 
-        ret = np.zeros(grid.shape, dtype=np.int)
+        ret = np.zeros(grid.shape, dtype=label_dtype(label))
         slice_mask = np.array(img)
         if gridx < gridy:
             slice_mask = slice_mask.T
@@ -388,7 +389,7 @@ class EllipsePicker(PolygonPicker):
         img = Image.new('L', (w, h), 0)
         ImageDraw.Draw(img).ellipse(points, outline=label, fill=label)
 
-        ret = np.zeros(grid.shape, dtype=np.int)
+        ret = np.zeros(grid.shape, dtype=label_dtype(label))
         slice_mask = np.array(img)
         if gridx < gridy:
             slice_mask = slice_mask.T
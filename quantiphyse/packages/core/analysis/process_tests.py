@@ -97,6 +97,55 @@ class AnalysisProcessTest(ProcessTest):
         self.assertAlmostEquals(data[3, 2], np.min(self.data_4d), delta=0.01)
         self.assertAlmostEquals(data[4, 2], np.max(self.data_4d), delta=0.01)
 
+    def testSummaryStatsPerVolume(self):
+        yaml = """
+  - DataStatistics:
+        data: data_4d
+        per-volume: True
+        output-name: testdata_stats
+
+  - SaveExtras: 
+        testdata_stats: testdata_stats.tsv
+"""
+        self.run_yaml(yaml)
+        self.assertEqual(self.status, Process.SUCCEEDED)
+        self.assertTrue("testdata_stats" in self.ivm.extras)
+
+        fname = os.path.join(self.output_dir, "case", "testdata_stats.tsv")
+        self.assertTrue(os.path.exists(fname))
+        df = pd.read_csv(fname, sep='\t')
+        data = df.values
+        nvols = self.data_4d.shape[3]
+        self.assertEquals(data.shape[0], 5)
+        self.assertEquals(data.shape[1], nvols+1)
+        for vol in range(nvols):
+            voldata = self.data_4d[..., vol]
+            self.assertAlmostEquals(data[0, 1+vol], np.mean(voldata), delta=0.01)
+            self.assertAlmostEquals(data[1, 1+vol], np.median(voldata), delta=0.01)
+            self.assertAlmostEquals(data[2, 1+vol], np.std(voldata), delta=0.01)
+            self.assertAlmostEquals(data[3, 1+vol], np.min(voldata), delta=0.01)
+            self.assertAlmostEquals(data[4, 1+vol], np.max(voldata), delta=0.01)
+
+    def testSummaryStatsVol(self):
+        yaml = """
+  - DataStatistics:
+        data: data_4d
+        vol: 2
+        output-name: testdata_stats
+
+  - SaveExtras: 
+        testdata_stats: testdata_stats.tsv
+"""
+        self.run_yaml(yaml)
+        self.assertEqual(self.status, Process.SUCCEEDED)
+
+        fname = os.path.join(self.output_dir, "case", "testdata_stats.tsv")
+        df = pd.read_csv(fname, sep='\t')
+        data = df.values
+        self.assertEquals(data.shape[1], 2)
+        self.assertAlmostEquals(data[0, 1], np.mean(self.data_4d[..., 2]), delta=0.01)
+        self.assertAlmostEquals(data[1, 1], np.median(self.data_4d[..., 2]), delta=0.01)
+
     def testSummaryStatsRoi(self):
         yaml = """
   - KMeans:
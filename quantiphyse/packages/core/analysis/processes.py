@@ -11,7 +11,8 @@ import scipy
 
 from PySide import QtGui
 
-from quantiphyse.data import NumpyData, OrthoSlice
+from quantiphyse.data import NumpyData, DataGrid, OrthoSlice
+from quantiphyse.data.regions import RegionIndex
 from quantiphyse.utils import QpException, table_to_extra, sf
 from quantiphyse.processes import Process
 
@@ -41,12 +42,12 @@ class CalcVolumesProcess(Process):
 
         if roi is not None:
             sizes = roi.grid.spacing
-            counts = np.bincount(roi.raw().flatten().astype(np.int))
+            index = roi.region_index()
             col_idx = 0
             for region, name in roi.regions.items():
                 if sel_region is None or region == sel_region:
-                    nvoxels = counts[region]
-                    vol = counts[region]*sizes[0]*sizes[1]*sizes[2]
+                    nvoxels = index.count(region)
+                    vol = nvoxels*sizes[0]*sizes[1]*sizes[2]
                     self.model.setHorizontalHeaderItem(col_idx, QtGui.QStandardItem(name))
                     self.model.setItem(0, col_idx, QtGui.QStandardItem(str(nvoxels)))
                     self.model.setItem(1, col_idx, QtGui.QStandardItem(str(vol)))
@@ -95,7 +96,9 @@ class DataStatisticsProcess(Process):
         
         no_extra = options.pop('no-extras', False)
         hist_bins = options.pop('hist-bins', 20)
-        hist_range = options.pop('hist-bins', None)
+        hist_range = options.pop('hist-range', None)
+        vol = options.pop('vol', None)
+        per_volume = options.pop('per-volume', False)
         
         self.model.clear()
         self.model.setVerticalHeaderItem(0, QtGui.QStandardItem("Mean"))
@@ -106,7 +109,8 @@ class DataStatisticsProcess(Process):
 
         col = 0
         for data in data_items:
-            stats1, roi_labels, _, _ = self.get_summary_stats(data, roi, hist_bins=hist_bins, hist_range=hist_range, slice_loc=sl)
+            stats1, roi_labels, _, _ = self.get_summary_stats(data, roi, hist_bins=hist_bins, hist_range=hist_range, slice_loc=sl,
+                                                              vol=vol, per_volume=per_volume)
             for ii in range(len(stats1['mean'])):
                 self.model.setHorizontalHeaderItem(col, QtGui.QStandardItem("%s\n%s" % (data.name, roi_labels[ii])))
                 self.model.setItem(0, col, QtGui.QStandardItem(sf(stats1['mean'][ii])))
@@ -119,58 +123,71 @@ class DataStatisticsProcess(Process):
         if not no_extra: 
             self.ivm.add_extra(output_name, table_to_extra(self.model, output_name))
 
-    def get_summary_stats(self, data, roi=None, hist_bins=20, hist_range=None, slice_loc=None):
+    def get_summary_stats(self, data, roi=None, hist_bins=20, hist_range=None, slice_loc=None, vol=None, per_volume=False):
         """
         Get summary statistics
 
+        Statistics for all regions are calculated together using the ROI region index
+
         :param data: QpData instance for the data to get stats from
         :param roi: Restrict data to within this roi
+        :param slice_loc: If specified, OrthoSlice to restrict data to
+        :param vol: If specified, only use data from this volume
+        :param per_volume: If True, calculate separate statistics for each volume of 4D data
 
-        :return: Sequence of summary stats dictionary, roi labels
+        :return: Sequence of summary stats dictionary, roi labels, histograms, histogram bin edges
         """
         # Checks if either ROI or data is None
         if roi is not None:
-            roi = roi.resample(data.grid)
+            if not roi.grid.matches(data.grid):
+                roi = roi.resample(data.grid)
         else:
-            roi = NumpyData(np.ones(data.grid.shape[:3]), data.grid, "temp", roi=True)
+            roi = NumpyData(np.ones(data.grid.shape[:3], dtype=np.uint8), data.grid, "temp", roi=True)
 
         if data is None:
             stat1 = {'mean': [0], 'median': [0], 'std': [0], 'max': [0], 'min': [0]}
             return stat1, list(roi.regions.keys()), np.array([0, 0]), np.array([0, 1])
 
-        stat1 = {'mean': [], 'median': [], 'std': [], 'max': [], 'min': []}
-        hist1 = []
-        hist1x = []
-
+        regions = roi.regions
         if slice_loc is None:
-            data_arr = data.raw()
-            roi_arr = roi.raw()
+            index = roi.region_index()
         else:
-            data_arr, _, _, _ = data.slice_data(slice_loc)
+            # The slice is treated as single-slice 3D data so it can be processed in the same way
+            data_arr, _, _, _ = data.slice_data(slice_loc, vol=vol if vol is not None else 0)
             roi_arr, _, _, _ = roi.slice_data(slice_loc)
+            slice_grid = DataGrid(list(roi_arr.shape) + [1], np.identity(4))
+            data = NumpyData(np.expand_dims(data_arr, 2), slice_grid, "slice")
+            index = RegionIndex(np.expand_dims(roi_arr, 2))
+            vol = None
 
-        regions = []
-        for region, name in roi.regions.items():
-            # get data for a single label of the roi
-            in_roi = data_arr[roi_arr == region]
-            if in_roi.size > 0:
-                mean, med, std = np.mean(in_roi), np.median(in_roi), np.std(in_roi)
-                mx, mn = np.max(in_roi), np.min(in_roi)
-            else:
-                mean, med, std, mx, mn = 0, 0, 0, 0, 0
+        stats = index.stats(data, vol=vol, per_volume=per_volume, hist_bins=hist_bins, hist_range=hist_range)
+        ncols = 1
+        if stats["mean"].ndim > 1:
+            ncols = stats["mean"].shape[1]
 
-            stat1['mean'].append(mean)
-            stat1['median'].append(med)
-            stat1['std'].append(std)
-            stat1['max'].append(mx)
-            stat1['min'].append(mn)
-            regions.append(name)
-
-            y, x = np.histogram(in_roi, bins=hist_bins, range=hist_range)
-            hist1.append(y)
-            hist1x.append(x)
-
-        return stat1, regions, hist1, hist1x
+        stat1 = {'mean': [], 'median': [], 'std': [], 'max': [], 'min': []}
+        hist1, hist1x, names = [], [], []
+        for region, name in regions.items():
+            pos = index.position(region)
+            for col in range(ncols):
+                if ncols > 1:
+                    names.append(("%s vol %i" % (name, col)).strip())
+                else:
+                    names.append(name)
+
+                if pos is None:
+                    for key in stat1:
+                        stat1[key].append(0)
+                    y, x = np.histogram([], bins=hist_bins, range=hist_range)
+                else:
+                    idx = (pos, col) if ncols > 1 else pos
+                    for key in stat1:
+                        stat1[key].append(stats[key][idx])
+                    y, x = stats["hist"][idx], stats["hist_edges"][idx]
+                hist1.append(y)
+                hist1x.append(x)
+
+        return stat1, names, hist1, hist1x
 
 class OverlayStatsProcess(DataStatisticsProcess):
     """
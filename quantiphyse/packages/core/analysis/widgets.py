@@ -124,21 +124,16 @@ class MultiVoxelAnalysis(QpWidget):
         self.ivl.set_picker(PickMode.MULTIPLE)
         self.ivl.picker.col = self.col
 
-    def _add_point(self, point, col):
+    def _add_point(self, point, col, sig):
         """
         Add a selected point of the specified colour
         """
-        data_name = self.options.option("data").value
-        if data_name in self.ivm.data:
-            data = self.ivm.data[data_name]
-            sig = data.timeseries(point, grid=self.ivl.grid)
-            if point in self.plots:
-                self.plot.remove(self.plots[point])
+        if point in self.plots:
+            self.plot.remove(self.plots[point])
 
-            self.plots[point] = self.plot.add_line(sig, line_col=col)
-            if not self.options.option("indiv").value:
-                self.plots[point].hide()
-            self._update_means()
+        self.plots[point] = self.plot.add_line(sig, line_col=col)
+        if not self.options.option("indiv").value:
+            self.plots[point].hide()
 
     def _update_means(self):
         for col in self.colors.values():
@@ -158,13 +153,21 @@ class MultiVoxelAnalysis(QpWidget):
         Point selection changed
         """
         # Add plots for points in the selection which we haven't plotted (or which have changed colour)
-        allpoints = []
+        allpoints, new_points = [], []
         for col, points in picker.selection().items():
             points = [tuple([int(p+0.5) for p in pos]) for pos in points]
             allpoints += points
             for point in points:
                 if point not in self.plots or self.plots[point].line_col != col:
-                    self._add_point(point, col)
+                    new_points.append((point, col))
+
+        data_name = self.options.option("data").value
+        if new_points and data_name in self.ivm.data:
+            # Sample the timeseries for all the new points in one go
+            sigs = self.ivm.data[data_name].sample([point for point, _ in new_points], grid=self.ivl.grid)
+            for (point, col), sig in zip(new_points, sigs):
+                self._add_point(point, col, sig)
+            self._update_means()
 
         # Remove plots for points no longer in the selection
         for point in list(self.plots.keys()):
@@ -185,6 +188,7 @@ class DataStatistics(QpWidget):
         """ Set up UI controls here so as not to delay startup"""
         self.process = DataStatisticsProcess(self.ivm)
         self.process_ss = DataStatisticsProcess(self.ivm)
+        self._stats_vol = None
         
         main_vbox = QtGui.QVBoxLayout()
 
@@ -221,6 +225,10 @@ class DataStatistics(QpWidget):
         self.copy_btn.clicked.connect(self.copy_stats)
         self.copy_btn.setVisible(False)
         hbox.addWidget(self.copy_btn)
+        self.current_vol = QtGui.QCheckBox("Current volume only")
+        self.current_vol.setToolTip("For 4D data, show statistics for the currently displayed volume only")
+        self.current_vol.stateChanged.connect(self.update_all)
+        hbox.addWidget(self.current_vol)
         hbox.addStretch(1)
         vbox.addLayout(hbox)
 
@@ -291,6 +299,10 @@ class DataStatistics(QpWidget):
         self.update_all()
 
     def focus_changed(self, _):
+        if self.stats_table.isVisible() and self.current_vol.isChecked():
+            # Only the volume affects the statistics so ignore other focus changes
+            if int(self.ivl.focus()[3]) != self._stats_vol:
+                self.update_stats()
         if self.stats_table_ss.isVisible():
             self.update_stats_current_slice()
 
@@ -333,7 +345,12 @@ class DataStatistics(QpWidget):
             self.butgenss.setText("Hide")
 
     def update_stats(self):
-        self.populate_stats_table(self.process, {})
+        options = {}
+        self._stats_vol = None
+        if self.current_vol.isChecked():
+            self._stats_vol = int(self.ivl.focus()[3])
+            options["vol"] = self._stats_vol
+        self.populate_stats_table(self.process, options)
 
     def update_stats_current_slice(self):
         if self.ivm.main is not None:
@@ -530,9 +547,10 @@ class VoxelAnalysis(QpWidget):
         self.ivl.sig_focus_changed.disconnect(self._update)
 
     def _update(self, pos=None):
+        sigs = self.ivm.timeseries(self.ivl.focus(), self.ivl.grid)
         self._update_table()
-        self._update_rms_table()
-        self._plot()
+        self._update_rms_table(sigs)
+        self._plot(sigs)
 
     def _update_table(self):
         """
@@ -546,28 +564,29 @@ class VoxelAnalysis(QpWidget):
                 self.values_table.setVerticalHeaderItem(ii, QtGui.QStandardItem(ovl))
                 self.values_table.setItem(ii, 0, QtGui.QStandardItem(sf(data_vals[ovl])))
 
-    def _update_rms_table(self):
+    def _update_rms_table(self, sigs):
         try:
             self.updating = True # Hack to prevent plot being refreshed during table update
             self.rms_table.clear()
             self.rms_table.setHorizontalHeaderItem(0, QtGui.QStandardItem("Name"))
             self.rms_table.setHorizontalHeaderItem(1, QtGui.QStandardItem("RMS (Position)"))
             idx = 0
-            pos = self.ivl.focus()
-            sigs = self.ivm.timeseries(pos, self.ivl.grid)
             max_length = max([0,] + [len(sig) for sig in sigs.values()])
 
             if not self.ivm.main:
                 return
 
-            main_curve = self.ivm.main.timeseries(pos, grid=self.ivl.grid)
+            if self.ivm.main.name in sigs:
+                main_curve = list(sigs[self.ivm.main.name])
+            else:
+                main_curve = self.ivm.main.timeseries(self.ivl.focus(), grid=self.ivl.grid)
             main_curve.extend([0] * max_length)
             main_curve = main_curve[:max_length]
 
             for name in sorted(sigs.keys()):
-                # Make sure data curve is correct length
-                data_curve = sigs[name]
-                data_curve.extend([0] * max_length)
+                # Make sure data curve is correct length. The curves are also used
+                # for the plot so they must not be modified
+                data_curve = list(sigs[name]) + [0] * max_length
                 data_curve = data_curve[:max_length]
 
                 data_rms = np.sqrt(np.mean(np.square([v1-v2 for v1, v2 in zip(main_curve, data_curve)])))
@@ -593,15 +612,18 @@ class VoxelAnalysis(QpWidget):
             self.data_enabled[item.text()] = item.checkState()
             self._plot()
 
-    def _plot(self):
+    def _plot(self, sigs=None):
         """
         Regenerate the plot
+
+        :param sigs: Timeseries signals at the focus position as returned by 
+                     ``ImageVolumeManagement.timeseries``. If not given they are retrieved
         """
         self.plot.clear() 
 
         # Get all timeseries signals
-        pos = self.ivl.focus()
-        sigs = self.ivm.timeseries(pos, self.ivl.grid)
+        if sigs is None:
+            sigs = self.ivm.timeseries(self.ivl.focus(), self.ivl.grid)
         if not sigs:
             return
             
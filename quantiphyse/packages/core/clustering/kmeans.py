@@ -11,6 +11,7 @@ import numpy as np
 import sklearn.cluster as cl
 
 from quantiphyse.data import NumpyData
+from quantiphyse.data.qpdata import label_dtype, working_dtype
 from quantiphyse.processes import Process, normalisation, PCA
 from quantiphyse.utils import QpException
 
@@ -30,8 +31,9 @@ class KMeansProcess(Process):
         n_clusters = options.pop('n-clusters', 5)
         invert_roi = options.pop('invert-roi', False)
         output_name = options.pop('output-name', data.name + '_clusters')
+        data, roi = self.crop_to_roi(options, data, roi, invert=invert_roi)
         
-        kmeans_data, mask = data.mask(roi, invert=invert_roi, output_flat=True, output_mask=True)
+        table = data.voxel_table(roi, invert=invert_roi)
         start1 = time.time()
 
         if data.nvols > 1:
@@ -45,20 +47,20 @@ class KMeansProcess(Process):
                 self.log("Using PCA dimensionality reduction")
                 pca = PCA(n_components=n_pca, norm_input=True, norm_type=norm_type,
                           norm_modes=norm_data)
-                kmeans_data = pca.get_training_features(kmeans_data)
+                kmeans_data = pca.get_training_features(table)
             else:
                 raise QpException("Unknown reduction method: %s" % reduction)
         else:
-            kmeans_data = kmeans_data[:, np.newaxis]
+            kmeans_data = table.values
 
         kmeans = cl.KMeans(init='k-means++', n_clusters=n_clusters, n_init=10, n_jobs=1)
         kmeans.fit(kmeans_data)
         
         self.log("Elapsed time: %s" % (time.time() - start1))
 
-        label_image = np.zeros(data.grid.shape, dtype=np.int)
-        label_image[mask] = kmeans.labels_ + 1
-        self.ivm.add(NumpyData(label_image, grid=data.grid, name=output_name, roi=True), make_current=True)
+        label_image = table.scatter(kmeans.labels_ + 1, dtype=label_dtype(n_clusters))
+        label_image, grid = self.uncrop(label_image, data)
+        self.ivm.add(NumpyData(label_image, grid=grid, name=output_name, roi=True), make_current=True)
 
 class MeanValuesProcess(Process):
     """
@@ -73,13 +75,20 @@ class MeanValuesProcess(Process):
         data = self.get_data(options)
         roi = self.get_roi(options, data.grid)
         output_name = options.pop('output-name', data.name + "_means")
-
-        in_data = data.raw()
-        out_data = np.zeros(in_data.shape)
-        for region in roi.regions:
-            if data.ndim > 3:
-                out_data[roi.raw() == region] = np.mean(in_data[roi.raw() == region], axis=0)
-            else:
-                out_data[roi.raw() == region] = np.mean(in_data[roi.raw() == region])
-
-        self.ivm.add(NumpyData(out_data, grid=data.grid, name=output_name), make_current=True)
+        data, roi = self.crop_to_roi(options, data, roi)
+
+        # Mean of each region found in one pass over the voxel table using the
+        # region label of each voxel
+        table = data.voxel_table(roi)
+        regions, region_idx = np.unique(table.labels, return_inverse=True)
+        counts = np.bincount(region_idx, minlength=len(regions))
+        means = np.zeros((len(regions), table.nvols), dtype=working_dtype())
+        for vol in range(table.nvols):
+            means[:, vol] = np.bincount(region_idx, weights=table.values[:, vol], minlength=len(regions)) / counts
+        voxel_means = means[region_idx]
+        if data.nvols == 1:
+            voxel_means = voxel_means[:, 0]
+        out_data = table.scatter(voxel_means, dtype=working_dtype())
+
+        out_data, grid = self.uncrop(out_data, data)
+        self.ivm.add(NumpyData(out_data, grid=grid, name=output_name), make_current=True)
@@ -144,5 +144,24 @@ class MeanValuesProcessTest(ProcessTest):
         self.assertEqual(self.status, Process.SUCCEEDED)
         self.assertTrue("data_roi_mean" in self.ivm.data)
 
+    def test3dCropToRoi(self):
+        yaml = """
+  - MeanValues:
+        data: data_3d
+        roi: mask
+        output-name: data_roi_mean
+
+  - MeanValues:
+        data: data_3d
+        roi: mask
+        crop-to-roi: True
+        output-name: data_roi_mean_crop
+"""
+        self.run_yaml(yaml)
+        self.assertEqual(self.status, Process.SUCCEEDED)
+        cropped = self.ivm.data["data_roi_mean_crop"]
+        self.assertTrue(cropped.grid.matches(self.ivm.data["data_3d"].grid))
+        self.assertTrue(np.allclose(cropped.raw(), self.ivm.data["data_roi_mean"].raw()))
+
 if __name__ == '__main__':
     unittest.main()
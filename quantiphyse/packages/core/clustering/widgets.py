@@ -242,13 +242,14 @@ PCA reduction is used on 4D data to extract representative curves
 
         roi = self.ivm.rois.get(self.output_name.text(), None)
         if roi is not None:
+            index = roi.region_index()
             col_idx = 0
             for region, name in roi.regions.items():
                 self.count_table.setHorizontalHeaderItem(col_idx, QtGui.QStandardItem(name))
 
                 # Volume count
-                voxel_count = np.sum(roi.raw() == region)
-                self.count_table.setItem(0, col_idx, QtGui.QStandardItem(str(np.around(voxel_count))))
+                voxel_count = index.count(region)
+                self.count_table.setItem(0, col_idx, QtGui.QStandardItem(str(voxel_count)))
                 col_idx += 1
 
     def update_plot(self):
@@ -310,10 +311,9 @@ PCA reduction is used on 4D data to extract representative curves
         Returns:
         """
         self.curves = {}
+        table = data.voxel_table(roi)
         for region in roi.regions:
-            roi_data = data.mask(roi, region=region, output_flat=True)
-            mean = np.median(roi_data, axis=0)
-            self.curves[region] = mean
+            self.curves[region] = np.median(table.values[table.labels == region], axis=0)
 
     def _merge(self, m1, m2):
         roi = self.ivm.rois.get(self.output_name.text(), None)
@@ -4,6 +4,9 @@ Quantiphyse - Processes for the data manipulation package
 Copyright (c) 2013-2018 University of Oxford
 """
 
+import numpy as np
+
+from quantiphyse.data import NumpyData
 from quantiphyse.utils import QpException
 
 from quantiphyse.processes import Process
@@ -31,6 +34,9 @@ class ResampleProcess(Process):
             raise QpException("Data item '%s' not found" % grid_data)
         
         grid = self.ivm.data[grid_data].grid
-        output_data = data.resample(grid, order=order)
-        output_data.name = output_name
+        resampled = data.resample(grid, order=order)
+        # Resampled array may be shared with the resampling cache so copy it as the 
+        # output is a new data item which may be modified
+        output_data = NumpyData(np.copy(resampled.raw()), grid=grid, name=output_name, 
+                                roi=resampled.roi, metadata=resampled.metadata)
         self.ivm.add(output_data, make_current=True, roi=data.roi and order == 0)
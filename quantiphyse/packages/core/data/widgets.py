@@ -166,6 +166,7 @@ class OrientDataWidget(QpWidget):
         affine[:3, 3] += translation
         self.debug("Final affine\n%s", affine)
         self.gridview.data.grid.affine = affine
+        self.gridview.data.mark_dirty()
         self.gridview.update()
         # HACK
         if self.gridview.data == self.ivm.current_data:
@@ -256,6 +257,7 @@ class GridView(QtGui.QWidget):
             if self.origin.valid():
                 affine[:3, 3] = [x[0] for x in self.origin.values()]
             self.data.grid.affine = affine
+            self.data.mark_dirty()
             # HACK
             if self.data == self.ivm.current_data:
                 self.ivm.sig_current_data.emit(self.ivm.current_data)
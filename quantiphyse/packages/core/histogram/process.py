@@ -5,7 +5,9 @@ Copyright (c) 2013-2018 University of Oxford
 """
 import six
 
+from quantiphyse.data import NumpyData
 from quantiphyse.data.extras import MatrixExtra
+from quantiphyse.data.blocks import RunningStats
 from quantiphyse.utils import QpException
 from quantiphyse.processes import Process
 
@@ -44,28 +46,39 @@ class HistogramProcess(Process):
 
         yvals, col_headers = {}, ["left", "right", "centre",]
         for data in data_items:
-            if vol is not None:
-                rawdata = data.volume(vol)
-            else:
-                rawdata = data.raw()
+            # Data is processed in blocks so the whole data set is not required in memory
             hrange = [dmin, dmax]
-            if dmin is None: hrange[0] = np.min(rawdata)
-            if dmax is None: hrange[1] = np.max(rawdata)
+            if dmin is None or dmax is None:
+                stats = RunningStats()
+                for block in data.blocks(by="slab", vol=vol):
+                    stats.update(block.data)
+                if dmin is None: hrange[0] = stats.min
+                if dmax is None: hrange[1] = stats.max
 
             if roi is None:
-                roi_fordata = np.ones(data.grid.shape)
+                roi_fordata = NumpyData(np.ones(data.grid.shape, dtype=np.int8), grid=data.grid, name="dummy_roi", roi=True)
                 regions = {1 : ""}
             else:
-                roi_fordata = roi.resample(data.grid).raw()
+                roi_fordata = roi
+                if not roi.grid.matches(data.grid):
+                    roi_fordata = roi.resample(data.grid)
                 regions = roi.regions
 
+            index = roi_fordata.region_index()
             for region, region_name in regions.items():
                 if sel_region is not None and region != sel_region:
                     self.debug("Ignoring region %i", region)
                     continue
 
-                region_data = rawdata[roi_fordata == region]
-                data_vals, edges = np.histogram(region_data, bins=bins, range=hrange, density=prob)
+                counts, edges = np.histogram([], bins=bins, range=hrange)
+                for region_data in index.values(data, region, vol=vol):
+                    counts += np.histogram(region_data, bins=bins, range=hrange)[0]
+                
+                if prob:
+                    # Equivalent to the density option of np.histogram
+                    data_vals = counts / float(np.sum(counts)) / np.diff(edges)
+                else:
+                    data_vals = counts
                     
                 if region_name:
                     name = "%s\n%s" % (data.name, region_name)
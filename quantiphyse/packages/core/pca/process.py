@@ -38,7 +38,7 @@ class PcaProcess(Process):
 
         pca = PcaFeatReduce(n_components=n_components, norm_input=norm_input, norm_type=norm_type, norm_modes=norm_output)
         
-        feature_images = pca.get_training_features(data.raw(), roi.raw(), feature_volume=True)
+        feature_images = pca.get_training_features(data.voxel_table(roi), feature_volume=True)
         for comp_idx in range(n_components):
             name = "%s%i" % (output_name, comp_idx)
             self.ivm.add(feature_images[:, :, :, comp_idx], grid=data.grid, name=name, make_current=(comp_idx == 0))
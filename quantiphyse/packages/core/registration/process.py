@@ -26,6 +26,7 @@ import six
 import numpy as np
 
 from quantiphyse.data import NumpyData, QpData
+from quantiphyse.data.qpdata import as_labels
 from quantiphyse.data.extras import Extra
 from quantiphyse.utils import get_plugins, set_local_file_path, QpException
 from quantiphyse.processes import Process
@@ -48,7 +49,7 @@ def _normalize_output(reg_data, output_data, output_suffix):
     if reg_data.roi:
         # This is not correct for multi-level ROIs - this would basically require support
         # from within the registration algorithm for roi (integer only) data
-        data = np.rint(output_data.raw()).astype(np.int)
+        data = as_labels(np.rint(output_data.raw()))
         output_data = NumpyData(data, grid=output_data.grid, name=output_data.name, roi=True)
     output_data.name = reg_data.name + output_suffix
     return output_data
@@ -8,6 +8,7 @@ from PySide import QtGui
 import numpy as np
 
 from quantiphyse.data import NumpyData
+from quantiphyse.data.qpdata import working_zeros
 from quantiphyse.utils import LogSource, QpException
 
 class RegMethod(LogSource):
@@ -107,7 +108,7 @@ class RegMethod(LogSource):
             output_space = ref_data
         else:
             output_space = reg_data
-        out_data = np.zeros(list(output_space.grid.shape) + [reg_data.nvols])
+        out_data = working_zeros(list(output_space.grid.shape) + [reg_data.nvols])
 
         transforms = []
         log = "Default 4D registration using multiple 3d registrations\n"
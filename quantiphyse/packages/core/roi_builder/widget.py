@@ -15,6 +15,7 @@ import numpy as np
 from PySide import QtGui
 
 from quantiphyse.data import NumpyData
+from quantiphyse.data.qpdata import label_dtype
 from quantiphyse.gui.options import OptionBox, DataOption, NumericOption, TextOption
 from quantiphyse.gui.widgets import QpWidget, TitleWidget
 from quantiphyse.gui.pickers import PickMode
@@ -128,6 +129,11 @@ class RoiBuilderWidget(QpWidget):
         """
         label = self.options.option("label").value
         self.debug("label=%i", label)
+        if mode == self.ADD:
+            # The ROI data type may need to be enlarged to hold the label
+            roi = self.ivm.data[self.roiname]
+            roi.ensure_label(label)
+            self.roidata = roi.raw()
 
         # For undo functionality: selection is an object specifying which
         # points or ROI region were selected, data_orig is a corresponding
@@ -179,23 +185,11 @@ class RoiBuilderWidget(QpWidget):
         self._history.append((selection, data_orig))
         self._undo_btn.setEnabled(True)
         
-        # Update the ROI - note that the regions may have been affected so make
-        # sure they are regenerated
-        self._update_regions()
+        # Update the ROI - this regenerates the regions which may have been affected
+        self.ivm.data[self.roiname].mark_dirty()
         self.ivl.redraw()
         self.debug("Now have %i nonzero", np.count_nonzero(self.roidata))
 
-    def _update_regions(self):
-        """
-        ROI regions may have been created or added so regenerate them but put 
-        back existing label names
-        """
-        current_regions = self.ivm.data[self.roiname].metadata.pop("roi_regions", {})
-        new_regions = self.ivm.data[self.roiname].regions
-        for label, desc in current_regions.items():
-            if label in new_regions:
-                new_regions[label] = desc
-        
     def undo(self):
         """
         Undo the last change
@@ -219,7 +213,7 @@ class RoiBuilderWidget(QpWidget):
             for point, orig_value in zip(selection, data_orig):
                 self.roidata[point[0], point[1], point[2]] = orig_value
 
-        self._update_regions()
+        self.ivm.data[self.roiname].mark_dirty()
         self.ivl.redraw()
         self.debug("Now have %i nonzero", np.count_nonzero(self.roidata))
         self._undo_btn.setEnabled(len(self._history) > 0)
@@ -282,7 +276,7 @@ class RoiBuilderWidget(QpWidget):
         if ok:
             roiname = optbox.option("name").value
             grid = self.ivm.data[optbox.option("grid").value].grid
-            roidata = np.zeros(grid.shape, dtype=np.int)
+            roidata = np.zeros(grid.shape, dtype=label_dtype(1))
             self.ivm.add(NumpyData(roidata, grid=grid, roi=True, name=roiname), make_current=True)
 
             # Throw away old history. FIXME is this right, should we keep existing data and history?
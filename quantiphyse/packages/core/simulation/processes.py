@@ -9,6 +9,7 @@ import numpy as np
 import scipy.ndimage.interpolation
 
 from quantiphyse.data import DataGrid
+from quantiphyse.data.qpdata import working_dtype, working_zeros
 from quantiphyse.utils import QpException
 from quantiphyse.processes import Process
 
@@ -30,7 +31,7 @@ class AddNoiseProcess(Process):
         noise = np.random.normal(loc=0, scale=std, size=list(data.grid.shape) + [data.nvols,])
         if data.nvols == 1: 
             noise = np.squeeze(noise, -1)
-        noisy_data = data.raw() + noise
+        noisy_data = np.add(data.raw(), noise, dtype=working_dtype())
         self.ivm.add(noisy_data, grid=data.grid, name=output_name, make_current=True)
 
 class SimMotionProcess(Process):
@@ -66,7 +67,7 @@ class SimMotionProcess(Process):
             output_affine[:3, 3] = output_origin
             output_grid = DataGrid(output_shape, output_affine)
 
-        moving_data = np.zeros(list(output_shape) + [data.nvols,])
+        moving_data = working_zeros(list(output_shape) + [data.nvols,])
         for vol in range(data.nvols):
             voldata = data.volume(vol)
             if padding > 0:
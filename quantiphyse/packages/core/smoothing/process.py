@@ -33,9 +33,9 @@ class SmoothingProcess(Process):
         else:
             sigmas = [float(sig) / size for sig, size in zip(sigma, data.grid.spacing)]
 
-        # Smooth multiple volumes independently
-        if data.nvols > 1:
-            sigmas += [0, ]
+        # Smooth multiple volumes independently, so only one volume needs to be in memory
+        def _smooth(voldata):
+            return scipy.ndimage.filters.gaussian_filter(voldata, sigmas, order=order, mode=mode)
 
-        output = scipy.ndimage.filters.gaussian_filter(data.raw(), sigmas, order=order, mode=mode)
+        output = data.map_blocks(_smooth, by="volume")
         self.ivm.add(NumpyData(output, grid=data.grid, name=output_name), make_current=True)
@@ -10,18 +10,11 @@ import numpy as np
 from sklearn.decomposition import PCA
 from scipy.ndimage.filters import gaussian_filter1d
 
+from quantiphyse.data import VoxelTable
+from quantiphyse.data.qpdata import working_dtype
 from quantiphyse.utils import QpException, LogSource
 from . import normalisation as norm
 
-def _flat_data_to_image(data, roi):
-    # return features in image format
-    image_shape = list(roi.shape)
-    if data.ndim == 2:
-        image_shape.append(data.shape[1])
-    image = np.zeros(image_shape)
-    image[roi] = data
-    return image
-
 class PcaFeatReduce(LogSource):
     """
     Extract PCA features from 4D image data
@@ -46,8 +39,8 @@ class PcaFeatReduce(LogSource):
         """
         Train PCA reduction on data and return features for each voxel
 
-        :param data: 4D data set
-        :param roi: Optional 3D ROI
+        :param data: 4D data set as a Numpy array, or :class:`VoxelTable` of the voxels to use
+        :param roi: Optional 3D ROI. Not used if ``data`` is a :class:`VoxelTable`
         :param smooth_timeseries: Optional sigma for 1D Gaussian smoothing of each voxel timeseries
         :param feature_volume: determines whether the features are returned as a list or an image
 
@@ -56,7 +49,7 @@ class PcaFeatReduce(LogSource):
                  Otherwise, 2D array whose first dimension is unmasked voxels and 2nd dimension
                  is the PCA components
         """
-        data_inmask, roi = self._mask(data, roi, smooth_timeseries)
+        data_inmask, table = self._mask(data, roi, smooth_timeseries)
 
         self.debug("Using PCA dimensionality reduction")
         reduced_data = self.pca.fit_transform(data_inmask)
@@ -69,14 +62,14 @@ class PcaFeatReduce(LogSource):
         if not feature_volume:
             return reduced_data
 
-        return _flat_data_to_image(reduced_data, roi)
+        return table.scatter(reduced_data, dtype=working_dtype())
 
     def get_projected_test_features(self, data, roi=None, smooth_timeseries=None, feature_volume=False):
         """
         Return features for each voxel from previously trained PCA modes
 
-        :param data: 4D data set
-        :param roi: Optional 3D ROI
+        :param data: 4D data set as a Numpy array, or :class:`VoxelTable` of the voxels to use
+        :param roi: Optional 3D ROI. Not used if ``data`` is a :class:`VoxelTable`
         :param feature_volume: determines whether the features are returned as a list or an image
 
         :return: If ``feature_volume``, 4D array with the same 3d dimensions as data and 
@@ -84,7 +77,7 @@ class PcaFeatReduce(LogSource):
                  Otherwise, 2D array whose first dimension is unmasked voxels and 2nd dimension
                  is the PCA components
         """
-        data_inmask, roi = self._mask(data, roi, smooth_timeseries)
+        data_inmask, table = self._mask(data, roi, smooth_timeseries)
         
         #Projecting the data using training set PCA
         if data_inmask.shape[1] != self.pca.mean_.shape[0]:
@@ -100,7 +93,7 @@ class PcaFeatReduce(LogSource):
         if not feature_volume:
             return reduced_data
         
-        return _flat_data_to_image(reduced_data, roi)
+        return table.scatter(reduced_data, dtype=working_dtype())
 
     def explained_variance(self, cumulative=False):
         """
@@ -132,15 +125,15 @@ class PcaFeatReduce(LogSource):
         return self.pca.mean_
 
     def _mask(self, data, roi, smooth_timeseries):
-        if roi is None:
-            roi = np.ones(data.shape[0:-1], dtype=bool)
+        if isinstance(data, VoxelTable):
+            table = data
         else:
-            roi = np.array(roi, dtype=np.bool)
-        data_inmask = data[roi]
+            table = VoxelTable(data, None if roi is None else np.asarray(roi) != 0)
+        data_inmask = table.values
 
         if self.norm_input:
             data_inmask = norm.normalise(data_inmask, self.norm_type)
 
         if smooth_timeseries is not None:
             data_inmask = gaussian_filter1d(data_inmask, sigma=smooth_timeseries, axis=-1)
-        return data_inmask, roi
+        return data_inmask, table
@@ -5,13 +5,51 @@ Copyright (c) 2013-2018 University of Oxford
 """
 
 import os
+import traceback
+from multiprocessing.pool import ThreadPool
 
 from quantiphyse.utils import QpException
-from quantiphyse.data import load, save
+from quantiphyse.data import load, save, save_session, load_session
 
 from .process import Process
 
-__all__ = ["LoadProcess", "LoadDataProcess", "LoadRoisProcess", "SaveProcess", "SaveAllExceptProcess", "SaveDeleteProcess", "SaveArtifactsProcess"]
+__all__ = ["LoadProcess", "LoadDataProcess", "LoadRoisProcess", "SaveProcess", "SaveAllExceptProcess", "SaveDeleteProcess", "SaveArtifactsProcess",
+           "SaveSessionProcess", "LoadSessionProcess"]
+
+#: Default number of data items saved at the same time by the save processes
+SAVE_THREADS = 4
+
+def _save_items(items, outdir, threads=None):
+    """
+    Save multiple data items concurrently
+
+    Most of the time taken to save large data is spent in compression and file
+    writes, which release the GIL, so items can usefully be saved in threads
+
+    :param items: Sequence of tuples of (QpData, file name, output grid or None)
+    :param outdir: Output directory for relative file names
+    :param threads: Maximum number of items to save at once, defaults to ``SAVE_THREADS``
+    :return: Sequence of tuples of (exception, formatted traceback) for each item, 
+             with (None, None) for items which were saved successfully
+    """
+    def _save(item):
+        qpdata, fname, grid = item
+        try:
+            save(qpdata, fname, grid=grid, outdir=outdir)
+            return None, None
+        except Exception as exc:
+            return exc, traceback.format_exc()
+
+    if threads is None:
+        threads = SAVE_THREADS
+    if threads <= 1 or len(items) <= 1:
+        return [_save(item) for item in items]
+
+    pool = ThreadPool(min(threads, len(items)))
+    try:
+        return pool.map(_save, items)
+    finally:
+        pool.close()
 
 class LoadProcess(Process):
     """
@@ -25,22 +63,24 @@ class LoadProcess(Process):
         data = options.pop('data', {})
         # Force 3D data to be multiple 2D volumes 
         force_mv = options.pop('force-multivol', False)
+        # Memory mapping policy: True, False or 'auto'
+        mmap = options.pop('mmap', "auto")
 
         for fname, name in list(data.items()) + list(rois.items()):
-            qpdata = self._load_file(fname, name)
+            qpdata = self._load_file(fname, name, mmap=mmap)
             if qpdata is not None: 
                 if force_mv and qpdata.nvols == 1 and qpdata.grid.shape[2] > 1: 
                     qpdata.set_2dt()
                 qpdata.roi = fname in rois
                 self.ivm.add(qpdata, make_current=True)
 
-    def _load_file(self, fname, name):
+    def _load_file(self, fname, name, mmap="auto"):
         filepath = self._get_filepath(fname)
         if name is None:
             name = self.ivm.suggest_name(os.path.split(fname)[1].split(".", 1)[0])
         self.debug("  - Loading data '%s' from %s" % (name, filepath))
         try:
-            data = load(filepath)
+            data = load(filepath, mmap=mmap)
             data.name = name
             return data
         except QpException as exc:
@@ -91,16 +131,24 @@ class SaveProcess(Process):
             else:
                 output_grid = output_grid_data.grid
 
+        # Number of data items to save at the same time. Not a valid data name so will not clash
+        threads = options.pop("save-threads", None)
+
+        names, items = [], []
         for name in list(options.keys()):
-            try:
-                fname = options.pop(name, name)
-                qpdata = self.ivm.data.get(name, None)
-                if qpdata is not None:
-                    save(qpdata, fname, grid=output_grid, outdir=self.outdir)
-                else:
-                    self.warn("Failed to save %s - no such data or ROI found" % name)
-            except QpException as exc:
+            fname = options.pop(name, name)
+            qpdata = self.ivm.data.get(name, None)
+            if qpdata is not None:
+                names.append(name)
+                items.append((qpdata, fname, output_grid))
+            else:
+                self.warn("Failed to save %s - no such data or ROI found" % name)
+
+        for name, (exc, _) in zip(names, _save_items(items, self.outdir, threads)):
+            if isinstance(exc, QpException):
                 self.warn("Failed to save %s: %s" % (name, str(exc)))
+            elif exc is not None:
+                raise exc
 
 class SaveAllExceptProcess(Process):
     """
@@ -110,19 +158,18 @@ class SaveAllExceptProcess(Process):
         Process.__init__(self, ivm, **kwargs)
 
     def run(self, options):
+        # Number of data items to save at the same time. Not a valid data name so will not clash
+        threads = options.pop("save-threads", None)
         exceptions = list(options.keys())
         for k in exceptions: options.pop(k)
 
-        for name, qpdata in self.ivm.data.items():
-            if name in exceptions: 
-                continue
-            try:
-                save(qpdata, name, outdir=self.outdir)
-            except QpException as exc:
+        names = [name for name in self.ivm.data if name not in exceptions]
+        items = [(self.ivm.data[name], name, None) for name in names]
+        for name, (exc, trace) in zip(names, _save_items(items, self.outdir, threads)):
+            if isinstance(exc, QpException):
                 self.warn("Failed to save %s: %s" % (name, str(exc)))
-            except:
-                import traceback
-                traceback.print_exc()
+            elif exc is not None:
+                print(trace)
 
 class SaveDeleteProcess(SaveProcess):
     """
@@ -164,3 +211,33 @@ class SaveArtifactsProcess(Process):
             if not os.path.exists(dirname): os.makedirs(dirname)
             with open(fname, "w") as text_file:
                 text_file.write(text)
+
+class SaveSessionProcess(Process):
+    """
+    Save all data, extras and selections to a session directory
+    """
+    def __init__(self, ivm, **kwargs):
+        Process.__init__(self, ivm, **kwargs)
+
+    def run(self, options):
+        path = options.pop("session", "session.qps")
+        if not os.path.isabs(path):
+            path = os.path.join(self.outdir, path)
+        self.debug("Saving session to %s" % path)
+        save_session(self.ivm, path)
+
+class LoadSessionProcess(Process):
+    """
+    Restore a saved session, replacing all current data
+    """
+    def __init__(self, ivm, **kwargs):
+        Process.__init__(self, ivm, **kwargs)
+
+    def run(self, options):
+        path = options.pop("session", None)
+        if path is None:
+            raise QpException("Session directory must be given")
+        if not os.path.isabs(path):
+            path = os.path.join(self.indir, path)
+        self.debug("Loading session from %s" % path)
+        load_session(path, self.ivm)
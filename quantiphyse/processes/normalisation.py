@@ -8,59 +8,116 @@ from __future__ import division, print_function
 
 import numpy as np
 
-def norm_percentile(data, percentile=90):
+from quantiphyse.data import QpData
+from quantiphyse.data.qpdata import working_dtype
+from quantiphyse.data.blocks import BLOCK_VALUES, percentile as block_percentile
+
+def _nvols(data):
+    if isinstance(data, QpData):
+        return data.nvols
+    else:
+        return data.shape[-1]
+
+def _voxel_blocks(data):
+    """
+    Generate blocks of the data as 2D arrays of voxels x volumes
+
+    This means the functions below can work on Numpy arrays and QpData
+    instances without needing the whole data in memory at once
+    """
+    nvols = _nvols(data)
+    if isinstance(data, QpData):
+        for block in data.blocks(by="slab"):
+            yield block.data.reshape(-1, nvols)
+    else:
+        flat = data.reshape(-1, nvols)
+        rows = max(1, BLOCK_VALUES // nvols)
+        for start in range(0, flat.shape[0], rows):
+            yield flat[start:start+rows]
+
+def _map_voxels(data, func, output=None):
+    """
+    Apply a function to 2D blocks of voxels x volumes
+
+    :param output: Optional preallocated array (e.g. a memory map) for the output
+    :return: Output array with the same shape as the data
+    """
+    nvols = _nvols(data)
+    if isinstance(data, QpData):
+        def _func(block):
+            return func(block.reshape(-1, nvols)).reshape(block.shape)
+        return data.map_blocks(_func, output=output, by="slab")
+    else:
+        if output is None:
+            output = np.empty(data.shape, dtype=np.result_type(data.dtype, working_dtype()))
+        flat_out = output.reshape(-1, nvols)
+        rows = max(1, BLOCK_VALUES // nvols)
+        for start, block in zip(range(0, flat_out.shape[0], rows), _voxel_blocks(data)):
+            flat_out[start:start+rows] = func(block)
+        return output
+
+def norm_percentile(data, percentile=90, output=None):
     """
     Normalise the data by dividing by a given percentile
 
-    :param data: Numpy array whose last dimension is assumed to be 
-                 the volume sequence
+    :param data: Numpy array or QpData instance whose last dimension is assumed
+                 to be the volume sequence
+    :param output: Optional preallocated output array
     """
-    norm = np.percentile(data, percentile)
-    return data / norm
+    norm = block_percentile(lambda: _voxel_blocks(data), percentile)
+    return _map_voxels(data, lambda block: block / norm, output)
 
-def norm_median(data, volume_idx=None):
+def norm_median(data, volume_idx=None, output=None):
     """
     Normalise the data by dividing by the median of a given volume
     
-    :param data: Numpy array whose last dimension is assumed to be 
-                 the volume sequence
+    :param data: Numpy array or QpData instance whose last dimension is assumed
+                 to be the volume sequence
+    :param output: Optional preallocated output array
     """
     if volume_idx is None: 
-        volume_idx = data.shape[-1] / 2
-    return data / np.median(data[:, volume_idx])
+        volume_idx = _nvols(data) // 2
+    median = block_percentile(lambda: (block[:, volume_idx] for block in _voxel_blocks(data)), 50)
+    return _map_voxels(data, lambda block: block / median, output)
 
-def norm_indiv(data):
+def norm_indiv(data, output=None):
     """
     Scale each volume individually so it lies between 0 and 1
     
-    :param data: Numpy array whose last dimension is assumed to be 
-                 the volume sequence
+    :param data: Numpy array or QpData instance whose last dimension is assumed
+                 to be the volume sequence
+    :param output: Optional preallocated output array
     """
-    data = data - np.min(data, axis=0)
-    return data / (np.max(data, axis=0) + 0.001)
+    vol_min, vol_max = None, None
+    for block in _voxel_blocks(data):
+        if block.shape[0] > 0:
+            block_min, block_max = np.min(block, axis=0), np.max(block, axis=0)
+            vol_min = block_min if vol_min is None else np.minimum(vol_min, block_min)
+            vol_max = block_max if vol_max is None else np.maximum(vol_max, block_max)
+    return _map_voxels(data, lambda block: (block - vol_min) / (vol_max - vol_min + 0.001), output)
 
-def norm_sigenh(data, nvols=3):
+def norm_sigenh(data, nvols=3, output=None):
     """
     Scale each data point by dividing by a 'baseline' value and then subtracting 1
 
     This results in 'signal enhancement' curves, starting at 0
     
-    :param data: Numpy array whose last dimension is assumed to be 
-                 the volume sequence
+    :param data: Numpy array or QpData instance whose last dimension is assumed
+                 to be the volume sequence
+    :param output: Optional preallocated output array
     """
-    data_nvols = data.shape[-1]
-    tile_shape = [1, ] * data.ndim
-    tile_shape[-1] = nvols
-
-    baseline = np.mean(data[..., :min(nvols, data_nvols)], axis=-1)
-    baseline_expanded = np.expand_dims(baseline, axis=-1)
-    return data / (baseline_expanded + 0.001) - 1
+    def _sigenh(block):
+        baseline = np.mean(block[:, :min(nvols, block.shape[-1])], axis=-1)
+        return block / (np.expand_dims(baseline, axis=-1) + 0.001) - 1
+    return _map_voxels(data, _sigenh, output)
 
 def normalise(data, method, **kwargs):
     """
     Normalise data using named method
 
-    :param data: Numpy array containing data to be normalised
+    :param data: Numpy array or QpData instance containing data to be normalised.
+                 The data is processed in blocks so QpData instances do not need
+                 to be loaded into memory
     :param method: One of ``perc``, ``median``, ``indiv``, or ``sigenh``
     :return: Normalised data as matching Numpy array
     """
@@ -13,9 +13,8 @@ Copyright (c) 2013-2018 University of Oxford
 """
 
 import os
-import multiprocessing
-import multiprocessing.pool
 import threading
+import time
 import traceback
 import logging
 import re
@@ -25,7 +24,13 @@ import numpy as np
 from PySide import QtCore, QtGui
 
 from quantiphyse.data import NumpyData, save
-from quantiphyse.utils import LogSource, QpException, get_plugins, set_local_file_path
+from quantiphyse.data.concat import ConcatData
+from quantiphyse.data.views import CropData
+from quantiphyse.data.qpdata import working_dtype
+from quantiphyse.utils import LogSource, QpException, ifnone
+
+from .workers import get_pool
+from .transport import ArrayTransport, run_worker, chunk_slices, weighted_chunk_slices
 
 #: Axis to split along when splitting up data sets for multiprocessing
 #: Could be 0, 1 or 2, but 0 is probably optimal for Numpy arrays which are column-major by default
@@ -36,15 +41,6 @@ MULTIPROC = True
 
 LOG = logging.getLogger(__name__)
 
-def _worker_initialize():
-    """
-    Initializer function for multiprocessing workers.
-    
-    This makes sure plugins are loaded and paths to local files are set
-    """
-    set_local_file_path()
-    get_plugins()
-
 class Process(QtCore.QObject, LogSource):
     """
     A data processing task
@@ -62,6 +58,8 @@ class Process(QtCore.QObject, LogSource):
       data - The name of the main input data set
       roi - The name of the main input ROI if applicable
       output-name - The name of the output data set or ROI 
+      crop-to-roi - If True, processes which support it only read and process data
+                    within the bounding box of the ROI. See ``crop_to_roi``
 
     Processes are implemented by subclassing Process and overriding ``run``. 'Fast' 
     processes such as loading/saving data and very simple image processing tasks 
@@ -72,6 +70,9 @@ class Process(QtCore.QObject, LogSource):
     Processes which may take time can be run as background processes. To do this, the
     ``run()`` method should end with a call to ``start_bg`` which will start the background
     workers. This method supports simple parallel execution of suitable data processing tasks.
+    Data can be split into more chunks than there are workers, in which case chunks are
+    started as workers become free. Chunk sizes can be balanced using an ROI so that each
+    contains a similar number of voxels to process.
 
     Background processes may override the ``finished()`` method to do any necessary post-processing
     after all workers are completed. This typically consists of getting the output back from
@@ -160,6 +161,11 @@ class Process(QtCore.QObject, LogSource):
         self._pool = None
         self._worker_output = []
         self._queue = None
+        self._transport = None
+        self._pending = []
+        self._chunks = None
+        self._chunk_weights = []
+        self._dispatch_lock = threading.Lock()
 
     def execute(self, options):
         """
@@ -231,23 +237,10 @@ class Process(QtCore.QObject, LogSource):
                 if name not in self.ivm.data:
                     raise QpException("Data not found: %s" % name)
 
-            multi_data = [self.ivm.data[name] for name in data_name]
-            nvols = sum([d.nvols for d in multi_data])
-            self.debug("Multivol: nvols=%i", nvols)
-            grid = None
-            num_vols = 0
-            for data_item in multi_data:
-                if grid is None:
-                    grid = data_item.grid
-                    data = np.zeros(list(grid.shape) + [nvols,])
-                data_item = data_item.resample(grid)
-                if data_item.nvols == 1:
-                    rawdata = np.expand_dims(data_item.raw(), 3)
-                else:
-                    rawdata = data_item.raw()
-                data[..., num_vols:num_vols+data_item.nvols] = rawdata
-                num_vols += data_item.nvols
-            data = NumpyData(data, grid=grid, name="multi_data")
+            # Volumes are read and resampled from the items when required rather than
+            # creating the concatenated data up front
+            data = ConcatData([self.ivm.data[name] for name in data_name], name="multi_data")
+            self.debug("Multivol: nvols=%i", data.nvols)
         else:
             if data_name in self.ivm.data:
                 data = self.ivm.data[data_name]
@@ -273,7 +266,7 @@ class Process(QtCore.QObject, LogSource):
             if use_current and self.ivm.current_roi is not None:
                 roidata = self.ivm.current_roi
             elif grid is not None:
-                roidata = NumpyData(np.ones(grid.shape[:3]), grid=grid, name="dummy_roi", roi=True)
+                roidata = NumpyData(np.ones(grid.shape[:3], dtype=np.uint8), grid=grid, name="dummy_roi", roi=True)
             else:
                 return None
         else:
@@ -286,6 +279,42 @@ class Process(QtCore.QObject, LogSource):
             roidata = roidata.resample(grid)
         return roidata
 
+    def crop_to_roi(self, options, data, roi, invert=False):
+        """
+        Standard method to restrict processing to the bounding box of an ROI
+
+        If the ``crop-to-roi`` option is True, the data and ROI are replaced with views
+        covering only the bounding box of the ROI, so the process only reads the voxels
+        within it. Output defined on the cropped grid can be put back onto the original
+        grid using ``uncrop``.
+
+        :param options: Dictionary of options - ``crop-to-roi`` will be consumed if present
+        :param data: QpData instance
+        :param roi: ROI QpData instance on the same grid as ``data``, or None
+        :param invert: If True, the process uses voxels outside the ROI so it is not cropped
+        :return: Tuple of (data, roi)
+        """
+        crop = options.pop("crop-to-roi", False)
+        if not crop or invert or roi is None or not np.any(roi.raw()):
+            return data, roi
+
+        bbox = roi.get_bounding_box(3)
+        self.debug("Cropping to ROI bounding box: %s", bbox)
+        return CropData(data, bbox, name=data.name), CropData(roi, bbox, name=roi.name)
+
+    def uncrop(self, output, data):
+        """
+        Put output from a process onto the grid of the original data
+
+        :param output: Numpy array defined on the grid of ``data``
+        :param data: QpData instance, which may have been returned by ``crop_to_roi``
+        :return: Tuple of (Numpy array, DataGrid)
+        """
+        if isinstance(data, CropData):
+            return data.uncrop(output), data.parent.grid
+        else:
+            return output, data.grid
+
     def run(self, options):
         """ 
         Override to run the process 
@@ -324,7 +353,29 @@ class Process(QtCore.QObject, LogSource):
         """
         return []
 
-    def start_bg(self, args, n_workers=1):
+    def shared_array(self, shape, dtype=None):
+        """
+        Create an output array which background workers can write to directly
+
+        When the array is passed to ``start_bg``, each worker receives the part of it
+        corresponding to its chunk of the input data, in the same way as other arrays.
+        Anything the workers write to their part is visible in the returned array when
+        the process finishes, so it does not need to be returned by the workers and
+        recombined.
+
+        :param shape: Array shape
+        :param dtype: Data type. Defaults to the working data type
+        :return: Numpy array, initialized to zero
+        """
+        if dtype is None:
+            dtype = working_dtype()
+        if not self._multiproc:
+            return np.zeros(shape, dtype=dtype)
+        if self._transport is None:
+            self._transport = ArrayTransport()
+        return self._transport.empty(shape, dtype)
+
+    def start_bg(self, args, n_workers=1, n_chunks=None, roi=None):
         """
         Start a set of background workers
         
@@ -332,29 +383,52 @@ class Process(QtCore.QObject, LogSource):
         worker run function.
 
         :param args: Sequence of arguments to the worker run function. All must be pickleable objects
+        :param n_workers: Maximum number of chunks to process at the same time
+        :param n_chunks: Number of chunks to split the data into, each processed by a separate
+                         call to the worker function. Defaults to ``n_workers``. Using more
+                         chunks than workers helps to balance the load when some chunks take
+                         longer than others, since chunks are started as workers become free
+        :param roi: Optional Numpy array with the same extent as the data along ``SPLIT_AXIS``.
+                    If given, chunk sizes are chosen so that each contains a similar number of
+                    non-zero voxels in the ROI rather than a similar number of slices
         """
+        if n_chunks is None:
+            n_chunks = n_workers
+
         # Only for background processes
-        self._pool, self._queue = self._init_multiproc(n_workers)
+        self._pool, self._queue = self._init_multiproc(n_chunks)
+        if self._multiproc and self._transport is None:
+            self._transport = ArrayTransport()
         
-        worker_args = self.split_args(n_workers, args)
-        self._worker_output = [None, ] * n_workers
+        self._chunks = self._chunk_slices(args, n_chunks, roi)
+        if self._chunks is not None:
+            n_chunks = len(self._chunks)
+        worker_args = self.split_args(n_chunks, args, self._chunks)
+        self._worker_output = [None, ] * len(worker_args)
         self.status = Process.RUNNING
 
         if self._multiproc:
-            self._workers = []
-            for i in range(n_workers):
-                self.debug("Starting task %i/%s...", i+1, n_workers)
-                proc = self._pool.apply_async(self._worker_fn, worker_args[i], callback=self._worker_finished_cb)
-                self._workers.append(proc)
+            self._workers = [None, ] * len(worker_args)
+            self._pending = list(enumerate(worker_args))
+            for _ in range(min(n_workers, len(worker_args))):
+                self._start_next_chunk()
             
             if self._sync:
                 self.debug("Running background task synchronously")
-                for i in range(n_workers):
-                    self._workers[i].get()
+                # Chunks are started as others finish, so wait until the process is no longer running
+                pool = self._pool
+                while self.status == Process.RUNNING and not pool.terminated:
+                    running = [proc for proc in list(self._workers) if proc is not None]
+                    if running:
+                        running[0].wait(0.1)
+                    else:
+                        time.sleep(0.1)
+                if self.status == Process.RUNNING and pool.terminated:
+                    self._workers_terminated()
             else:
                 self._restart_timer()
         else:
-            for i in range(n_workers):
+            for i in range(len(worker_args)):
                 result = self._worker_fn(*worker_args[i])
                 self.timeout(self._queue)
                 if QtGui.qApp is not None: QtGui.qApp.processEvents()
@@ -362,12 +436,52 @@ class Process(QtCore.QObject, LogSource):
                 if self.status != Process.RUNNING: 
                     break
 
+    def _chunk_slices(self, args, n_chunks, roi):
+        """
+        :return: Sequence of slices along ``SPLIT_AXIS`` for each chunk, or None if no
+                 data is being split
+        """
+        size = None
+        for arg in args:
+            if isinstance(arg, np.ndarray) and arg.ndim > SPLIT_AXIS:
+                size = arg.shape[SPLIT_AXIS]
+                break
+        if size is None:
+            self._chunk_weights = [1, ] * n_chunks
+            return None
+
+        if roi is not None:
+            roi = np.asarray(roi)
+            if roi.ndim <= SPLIT_AXIS or roi.shape[SPLIT_AXIS] != size:
+                raise QpException("ROI used to balance chunks does not match the shape of the data")
+            axes = tuple([axis for axis in range(roi.ndim) if axis != SPLIT_AXIS])
+            weights = np.sum(roi != 0, axis=axes)
+            chunks = weighted_chunk_slices(weights, n_chunks)
+            self._chunk_weights = [weights[chunk].sum() for chunk in chunks]
+        else:
+            chunks = chunk_slices(size, n_chunks)
+            self._chunk_weights = [chunk.stop - chunk.start for chunk in chunks]
+        return chunks
+
+    def _start_next_chunk(self):
+        """
+        Start a worker for the next chunk which has not been started, if any
+        """
+        with self._dispatch_lock:
+            if not self._pending or self.status != Process.RUNNING:
+                return
+            worker_id, args = self._pending.pop(0)
+            self.debug("Starting task %i/%s...", worker_id+1, len(self._workers))
+            self._workers[worker_id] = self._pool.apply_async(run_worker, [self._transport, self._worker_fn] + args,
+                                                              callback=self._worker_finished_cb, channel=self._queue)
+
     def _init_multiproc(self, num_tasks):
         if self._multiproc:
-            LOG.debug("Initializing multiprocessing")
-            queue = multiprocessing.Manager().Queue()
-            pool_size = min(num_tasks, multiprocessing.cpu_count())
-            pool = multiprocessing.Pool(pool_size, initializer=_worker_initialize)
+            # Workers are shared with other processes. Tasks beyond the size of the
+            # pool are queued until a worker is free
+            LOG.debug("Using shared worker pool for %i tasks", num_tasks)
+            pool = get_pool()
+            queue = pool.channel()
         else:
             LOG.debug("Not using multiprocessing")
             queue = singleproc_queue.Queue()
@@ -381,14 +495,10 @@ class Process(QtCore.QObject, LogSource):
         if self.status == Process.RUNNING:
             self.status = Process.CANCELLED
             if self._multiproc:
-                # FIXME this does not work. Not incredibly harmful because
-                # with status set to CANCELLED results are ignored anyway.
-                # But workers will continue to work. Maybe look into
-                # abortable_worker solution?
-                pass
-                #for p in self._workers:
-                #    p.terminate()
-                #    p.join(timeout=1.0)
+                # Workers stop when they next report progress. Any which are still
+                # running after a short time are terminated by the pool
+                if self._pool is not None:
+                    self._pool.cancel(self._queue)
             else:
                 # Just setting the status is enough - no more workers
                 # will be started
@@ -421,7 +531,7 @@ class Process(QtCore.QObject, LogSource):
         """
         pass
     
-    def split_args(self, n_workers, args):
+    def split_args(self, n_workers, args, chunks=None):
         """
         Split input arguments into chunks for running in parallel
         
@@ -432,14 +542,21 @@ class Process(QtCore.QObject, LogSource):
         
         :param args: Sequence of arguments to the worker run function. All must be pickleable objects.
                      By default Numpy arrays will be split along SPLIT_AXIS and a chunk passed to each
-                     worker.
-        :param n_workers: Number of parallel worker processes to use
+                     worker. Large arrays are passed to worker processes in shared memory rather
+                     than being copied.
+        :param n_workers: Number of chunks to split the data into
+        :param chunks: Optional sequence of ``n_workers`` slices along ``SPLIT_AXIS`` defining
+                       the chunks. If not given, the data is split into equal chunks
         """
         # First argument is worker ID, second is queue
         split_args = [list(range(n_workers)), [self._queue,] * n_workers]
 
         for arg in args:
-            if isinstance(arg, (np.ndarray, np.generic)):
+            if isinstance(arg, np.ndarray) and self._transport is not None:
+                split_args.append(self._transport.split(arg, ifnone(chunks, n_workers), SPLIT_AXIS))
+            elif isinstance(arg, np.ndarray) and chunks is not None:
+                split_args.append([arg[tuple([slice(None)] * SPLIT_AXIS + [chunk])] for chunk in chunks])
+            elif isinstance(arg, (np.ndarray, np.generic)):
                 split_args.append(np.array_split(arg, n_workers, SPLIT_AXIS))
             else:
                 split_args.append([arg,] * n_workers)
@@ -454,6 +571,9 @@ class Process(QtCore.QObject, LogSource):
         This implementation assumes data contains Numpy arrays and returns
         a new Numpy array concatenated along SPLIT_AXIS. However this method
         could be overridden, especially if split_data has been overridden.
+
+        Missing items are filled with zeros. Processes which know the shape of their
+        output in advance can avoid recombining data by using ``shared_array``
         """
         shape = None
         for data_item in data_list:
@@ -463,15 +583,29 @@ class Process(QtCore.QObject, LogSource):
             raise RuntimeError("No data to re-combine")
         else:
             self.debug("Recombining data with shape: %s", shape)
-        empty = np.zeros(shape)
-        real_data = []
-        for data_item in data_list:
-            if data_item is None:
-                real_data.append(empty)
-            else:
-                real_data.append(data_item)
-        
-        return np.concatenate(real_data, SPLIT_AXIS)
+
+        # Copy each item directly into the output, which may be memory mapped from
+        # a worker process, rather than building a list of items to concatenate
+        items = [item for item in data_list if item is not None]
+        dtype = np.result_type(*items)
+        if self._chunks is not None and len(self._chunks) == len(data_list):
+            sizes = [chunk.stop - chunk.start for chunk in self._chunks]
+        else:
+            sizes = [shape[SPLIT_AXIS] if item is None else item.shape[SPLIT_AXIS] for item in data_list]
+        output_shape = list(shape)
+        output_shape[SPLIT_AXIS] = sum(sizes)
+        if len(items) < len(data_list):
+            output = np.zeros(output_shape, dtype=dtype)
+        else:
+            output = np.empty(output_shape, dtype=dtype)
+        start = 0
+        for data_item, size in zip(data_list, sizes):
+            if data_item is not None:
+                index = [slice(None)] * len(shape)
+                index[SPLIT_AXIS] = slice(start, start+size)
+                output[tuple(index)] = data_item
+            start += size
+        return output
 
     def save_output(self, save_folder):
         """
@@ -513,9 +647,13 @@ class Process(QtCore.QObject, LogSource):
         # Get rid of all references to multprocessing workers and their output
         # this is necessary to avoid memory and process leakage
         if self._pool is not None:
-            self._pool.close()
+            self._pool.release(self._queue)
+        if self._transport is not None:
+            self._transport.close()
         self._pool = None
+        self._transport = None
         self._workers = []
+        self._pending = []
         self._queue = None
         self._worker_output = []
         self.debug("Emitting sig_finished")
@@ -530,12 +668,26 @@ class Process(QtCore.QObject, LogSource):
     def _timer_cb(self):
         if self.status == Process.RUNNING:
             self.timeout(self._queue)
-            self._restart_timer()
+            if self._pool is not None and self._pool.terminated:
+                self._workers_terminated()
+            else:
+                self._restart_timer()
+
+    def _workers_terminated(self):
+        """
+        Fail the process because the pool was terminated while its workers were running,
+        e.g. because another process was cancelled
+        """
+        self.status = Process.FAILED
+        self.exception = QpException("Worker processes were terminated before the process completed")
+        self.metaObject().invokeMethod(self, "_complete", QtCore.Qt.QueuedConnection)
 
     def _worker_finished_cb(self, result):
         worker_id, success, output = result
         self.debug("Process worker finished: id=%i, status=%s", worker_id, str(success))
-        self._workers[worker_id] = None
+        if worker_id < len(self._workers):
+            # Worker list is cleared when the process completes, e.g. if it is cancelled
+            self._workers[worker_id] = None
 
         if self.status in (Process.FAILED, Process.CANCELLED):
             # If one process has already failed or been cancelled, ignore results of others
@@ -544,15 +696,27 @@ class Process(QtCore.QObject, LogSource):
         elif success:
             if worker_id < len(self._worker_output):
                 self._worker_output[worker_id] = output
-                if None not in self._worker_output:
+                if all([item is not None for item in self._worker_output]):
                     self.status = Process.SUCCEEDED
+                elif len(self._worker_output) > 1:
+                    # Report progress by the amount of work in the chunks completed so far
+                    total = float(sum(self._chunk_weights))
+                    done = sum([weight for weight, item in zip(self._chunk_weights, self._worker_output) if item is not None])
+                    if total > 0:
+                        self.sig_progress.emit(done / total)
         else:
-            # If one process fails, they all fail. Output is just the first exception to be caught
-            # FIXME cancel other workers?
+            # If one process fails, they all fail. Output is just the first exception to be caught.
+            # Other workers are asked to stop but are not terminated as they are not using
+            # excessive time
             self.status = Process.FAILED
             self.exception = output
+            if self._pool is not None:
+                self._pool.cancel(self._queue, force=False)
 
-        if self.status != Process.RUNNING:
+        if self.status == Process.RUNNING:
+            if self._multiproc:
+                self._start_next_chunk()
+        else:
             # Need to use invokeMethod here because the process callback is in a 
             # different thread and the IVM (called by _complete) is not threadsafe
             self.metaObject().invokeMethod(self, "_complete", QtCore.Qt.QueuedConnection)
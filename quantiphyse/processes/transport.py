@@ -0,0 +1,225 @@
+"""
+Quantiphyse - File backed shared memory transport for arrays passed to and from workers
+
+Arrays passed to worker processes are normally pickled and sent through a pipe, and
+so are the results sent back. For large data this means several copies of the data
+in flight. Instead, large arrays are placed in memory mapped ``.npy`` files in a
+temporary directory and only a small :class:`SharedArray` descriptor is pickled. When
+a descriptor is unpickled it opens the file as a memory map, so worker functions see
+an ordinary Numpy array and do not need to be aware of the transport.
+
+Since the data lives in the page cache rather than in each process, writes to a
+shared output array by a worker are immediately visible in the main process.
+
+Copyright (c) 2013-2018 University of Oxford
+"""
+from __future__ import division, print_function
+
+import os
+import shutil
+import tempfile
+import logging
+
+import numpy as np
+
+LOG = logging.getLogger(__name__)
+
+#: Arrays smaller than this number of bytes are pickled as normal
+SHARED_MIN_BYTES = 1024 * 1024
+
+def _open_shared(fname, index, mode):
+    arr = np.load(fname, mmap_mode=mode)
+    if index is not None:
+        arr = arr[index]
+    return arr
+
+def chunk_slices(size, n_chunks):
+    """
+    :return: Sequence of slices dividing an axis into chunks in the same way as ``np.array_split``
+    """
+    base, extra = divmod(size, n_chunks)
+    slices, start = [], 0
+    for chunk in range(n_chunks):
+        stop = start + base + (1 if chunk < extra else 0)
+        slices.append(slice(start, stop))
+        start = stop
+    return slices
+
+def weighted_chunk_slices(weights, n_chunks):
+    """
+    Divide an axis into contiguous chunks with approximately equal total weight
+
+    This is used to balance work between chunks when the cost of processing each
+    index along the axis varies, e.g. when only voxels within an ROI are processed.
+
+    :param weights: Sequence of non-negative weights, one for each index along the axis
+    :param n_chunks: Number of chunks. This is limited to the length of the axis
+    :return: Sequence of non-empty slices covering the axis. If all weights are zero
+             the axis is divided as in ``chunk_slices``
+    """
+    weights = np.asarray(weights, dtype=np.float64)
+    size = len(weights)
+    n_chunks = max(1, min(n_chunks, size))
+    total = weights.sum()
+    if total <= 0:
+        return chunk_slices(size, n_chunks)
+
+    cumulative = np.cumsum(weights)
+    bounds = [0]
+    for chunk in range(1, n_chunks):
+        # Chunk ends at whichever boundary gives a cumulative weight closest to its share,
+        # leaving at least one index for each remaining chunk
+        target = total * chunk / n_chunks
+        idx = int(np.searchsorted(cumulative, target, side="left"))
+        if idx > 0 and target - cumulative[idx-1] < cumulative[idx] - target:
+            stop = idx
+        else:
+            stop = idx + 1
+        stop = max(bounds[-1] + 1, min(stop, size - n_chunks + chunk))
+        bounds.append(stop)
+    bounds.append(size)
+    return [slice(start, stop) for start, stop in zip(bounds[:-1], bounds[1:])]
+
+class SharedArray(object):
+    """
+    Descriptor for all or part of an array stored in a shared ``.npy`` file
+
+    When pickled and unpickled, e.g. when passed to a worker process, the result is
+    a Numpy memory map of the array rather than the descriptor
+    """
+    def __init__(self, fname, index=None, mode="c"):
+        """
+        :param fname: ``.npy`` file name
+        :param index: Optional index into the array, e.g. a tuple of slices
+        :param mode: Memory map mode - ``c`` (copy on write) for inputs, ``r+`` for output
+                     arrays which workers write to
+        """
+        self.fname = fname
+        self.index = index
+        self.mode = mode
+
+    def __reduce__(self):
+        return (_open_shared, (self.fname, self.index, self.mode))
+
+    def open(self):
+        """
+        :return: Numpy memory map of the array
+        """
+        return _open_shared(self.fname, self.index, self.mode)
+
+class ArrayTransport(object):
+    """
+    Temporary directory containing the shared arrays for one run of a process
+    """
+    def __init__(self, min_bytes=None):
+        """
+        :param min_bytes: Arrays smaller than this are not shared. Defaults to ``SHARED_MIN_BYTES``
+        """
+        self.min_bytes = SHARED_MIN_BYTES if min_bytes is None else min_bytes
+        self.path = tempfile.mkdtemp(prefix="qp_shared_")
+        # Shapes of the arrays created by ``empty``, by file name
+        self._outputs = {}
+
+    def owns(self, arr):
+        """
+        :return: True if ``arr`` is a memory map of a file in this transport
+        """
+        fname = getattr(arr, "filename", None)
+        return fname is not None and os.path.dirname(os.path.abspath(fname)) == os.path.abspath(self.path)
+
+    def empty(self, shape, dtype):
+        """
+        Create a new shared array which worker processes can write to
+
+        :return: Writeable Numpy memory map, initialized to zero
+        """
+        arr = self._create(shape, dtype)
+        self._outputs[arr.filename] = list(arr.shape)
+        return arr
+
+    def share(self, arr):
+        """
+        Copy an array into a shared file
+
+        :return: Numpy memory map of the shared copy, or the array itself if it is
+                 too small to be worth sharing or is already shared
+        """
+        if not isinstance(arr, np.ndarray) or arr.nbytes < self.min_bytes or self.owns(arr):
+            return arr
+        shared = self._create(arr.shape, arr.dtype)
+        shared[...] = arr
+        shared.flush()
+        return shared
+
+    def split(self, arr, chunks, axis):
+        """
+        Split an array into chunks for workers
+
+        :param chunks: Number of equal chunks, or sequence of slices along ``axis``
+                       defining each chunk, e.g. from ``weighted_chunk_slices``
+        :return: Sequence of items, one for each chunk. If the array is shared, these are
+                 :class:`SharedArray` descriptors. Arrays created by ``empty`` are
+                 shared writeable, so workers can write their output directly into them
+        """
+        if isinstance(chunks, (int, np.integer)):
+            chunks = chunk_slices(arr.shape[axis], chunks)
+        indexes = [tuple([slice(None)] * axis + [chunk]) for chunk in chunks]
+
+        if self.owns(arr) and arr.filename in self._outputs:
+            if list(arr.shape) != self._outputs[arr.filename]:
+                raise ValueError("Only complete shared output arrays can be split between workers")
+            shared, mode = arr, "r+"
+        else:
+            shared, mode = self.share(arr), "c"
+            if not self.owns(shared):
+                return [arr[index] for index in indexes]
+
+        return [SharedArray(shared.filename, index, mode) for index in indexes]
+
+    def share_output(self, output, worker_id):
+        """
+        Share large arrays in a worker's output so they are not pickled back to
+        the main process
+
+        :param output: Worker output object. Arrays and arrays within a list or tuple
+                       are shared
+        :return: Output with shared arrays replaced by :class:`SharedArray` descriptors
+        """
+        if isinstance(output, np.ndarray):
+            if output.nbytes < self.min_bytes:
+                return output
+            fd, fname = tempfile.mkstemp(prefix="result_%i_" % worker_id, suffix=".npy", dir=self.path)
+            with os.fdopen(fd, "wb") as result_file:
+                np.save(result_file, output)
+            return SharedArray(fname)
+        elif isinstance(output, (list, tuple)):
+            return type(output)([self.share_output(item, worker_id) for item in output])
+        else:
+            return output
+
+    def close(self):
+        """
+        Remove the shared files
+
+        Arrays which are still memory mapped remain usable on systems which allow open
+        files to be removed. Elsewhere the files are left for the system to clean up
+        """
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def _create(self, shape, dtype):
+        fd, fname = tempfile.mkstemp(prefix="array_", suffix=".npy", dir=self.path)
+        os.close(fd)
+        return np.lib.format.open_memmap(fname, mode="w+", dtype=dtype, shape=tuple(shape))
+
+def run_worker(transport, worker_fn, *args):
+    """
+    Run a worker function in a worker process, sharing large arrays in its output
+
+    :param transport: :class:`ArrayTransport`
+    :param worker_fn: Worker function, as given to the :class:`Process`
+    :param args: Arguments to the worker function
+    """
+    worker_id, success, output = worker_fn(*args)
+    if success:
+        output = transport.share_output(output, worker_id)
+    return worker_id, success, output
@@ -0,0 +1,352 @@
+"""
+Quantiphyse - Shared pool of worker processes for background processes
+
+Starting worker processes and loading plugins in each of them is slow compared to
+many processing tasks, so a single pool is created when first needed and reused
+by all processes until the application exits.
+
+Workers report progress through a single queue which is shared by all tasks. Each
+process gets its own :class:`ProgressChannel` which tags messages so they can be
+routed back to it.
+
+Channels are also used to cancel tasks. Cancelling a channel sets a flag in memory
+shared with the workers, and the next time a worker reports progress on the channel
+:class:`TaskCancelled` is raised so the worker function stops. Workers may also poll
+``cancelled()`` directly. Tasks which have not stopped after ``CANCEL_TIMEOUT`` seconds
+are stopped by terminating the pool, which is replaced when next needed.
+
+Copyright (c) 2013-2018 University of Oxford
+"""
+from __future__ import division, print_function
+
+import atexit
+import ctypes
+import itertools
+import logging
+import multiprocessing
+import multiprocessing.pool
+import threading
+
+from six.moves import queue as singleproc_queue
+
+from quantiphyse.utils import get_plugins, set_local_file_path
+
+LOG = logging.getLogger(__name__)
+
+#: Number of worker processes in the shared pool. If None, the number of processors is used
+POOL_SIZE = None
+
+#: Time in seconds to wait for workers to finish their current tasks on shutdown
+SHUTDOWN_TIMEOUT = 5
+
+#: Time in seconds cancelled tasks are given to stop before their workers are terminated
+CANCEL_TIMEOUT = 1
+
+#: Maximum number of progress channels which can be in use at once
+MAX_CHANNELS = 1024
+
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+# Progress queue and cancel flags in worker processes, set when the worker starts
+_WORKER_PROGRESS = None
+_WORKER_CANCEL_FLAGS = None
+
+def _worker_initialize(progress_queue, cancel_flags):
+    """
+    Initializer function for multiprocessing workers.
+
+    This makes sure plugins are loaded and paths to local files are set
+    """
+    global _WORKER_PROGRESS, _WORKER_CANCEL_FLAGS
+    _WORKER_PROGRESS = progress_queue
+    _WORKER_CANCEL_FLAGS = cancel_flags
+    set_local_file_path()
+    get_plugins()
+
+class TaskCancelled(Exception):
+    """
+    Raised in a worker process when it reports progress on a cancelled channel
+    """
+    pass
+
+class ProgressChannel(object):
+    """
+    Queue-like object used by workers to report progress to a process
+
+    Workers call ``put``, the process reads the messages in the main process using
+    ``empty`` and ``get``. Only the channel ID and the index of its cancel flag
+    are sent to the worker processes.
+    """
+    def __init__(self, channel_id, slot, cancel_flags):
+        self.channel_id = channel_id
+        self.slot = slot
+        self._cancel_flags = cancel_flags
+        self._local = singleproc_queue.Queue()
+
+    def __getstate__(self):
+        return {"channel_id" : self.channel_id, "slot" : self.slot, "_cancel_flags" : None, "_local" : None}
+
+    def cancelled(self):
+        """
+        :return: True if tasks using this channel have been cancelled
+        """
+        flags = self._cancel_flags if self._cancel_flags is not None else _WORKER_CANCEL_FLAGS
+        return flags is not None and bool(flags[self.slot])
+
+    def put(self, item):
+        """
+        Send a progress message to the process
+
+        :raises TaskCancelled: If called in a worker process after the channel has been cancelled
+        """
+        if self._local is None and self.cancelled():
+            raise TaskCancelled("Task cancelled")
+        if self._local is not None:
+            self._local.put(item)
+        elif _WORKER_PROGRESS is not None:
+            _WORKER_PROGRESS.put((self.channel_id, item))
+
+    def empty(self):
+        """
+        :return: True if there are no unread messages
+        """
+        return self._local.empty()
+
+    def get(self, block=True, timeout=None):
+        """
+        :return: Next progress message
+        """
+        return self._local.get(block, timeout)
+
+class _SafeCallback(object):
+    """
+    Wrapper for task callbacks which logs exceptions
+
+    Callbacks run in the pool's result handler thread, which stops if a callback
+    raises an exception. No further results are then received from the pool
+    """
+    def __init__(self, callback):
+        self._callback = callback
+
+    def __call__(self, result):
+        try:
+            self._callback(result)
+        except Exception:
+            LOG.exception("Error in worker task callback")
+
+class WorkerPool(object):
+    """
+    Pool of worker processes with a shared progress queue
+    """
+
+    def __init__(self, size):
+        """
+        :param size: Number of worker processes
+        """
+        LOG.debug("Starting worker pool with %i processes", size)
+        self.size = size
+        self.terminated = False
+        self._progress = multiprocessing.Queue()
+        self._cancel_flags = multiprocessing.Array(ctypes.c_byte, MAX_CHANNELS, lock=False)
+        self._pool = multiprocessing.Pool(size, initializer=_worker_initialize,
+                                          initargs=(self._progress, self._cancel_flags))
+        self._channels = {}
+        self._channel_ids = itertools.count()
+        self._free_slots = list(range(MAX_CHANNELS))
+        # Tasks started for each channel, and released channels whose tasks may still be running
+        self._tasks = {}
+        self._released = {}
+        self._lock = threading.Lock()
+        self._dispatcher = threading.Thread(target=self._dispatch)
+        self._dispatcher.daemon = True
+        self._dispatcher.start()
+
+    def channel(self):
+        """
+        :return: New :class:`ProgressChannel` for a process. It should be passed to
+                 ``release`` when the process is complete
+        """
+        with self._lock:
+            self._reap()
+            if not self._free_slots:
+                raise RuntimeError("Too many progress channels in use")
+            slot = self._free_slots.pop()
+            self._cancel_flags[slot] = 0
+            channel = ProgressChannel(next(self._channel_ids), slot, self._cancel_flags)
+            self._channels[channel.channel_id] = channel
+            self._tasks[channel.channel_id] = []
+        return channel
+
+    def release(self, channel):
+        """
+        Stop routing progress messages to a channel
+
+        The channel's cancel flag is not reused until all tasks started for it have finished
+        """
+        with self._lock:
+            if self._channels.pop(channel.channel_id, None) is not None:
+                self._released[channel.channel_id] = channel.slot
+
+    def apply_async(self, func, args=(), callback=None, channel=None):
+        """
+        Run a function in a worker process, as ``multiprocessing.Pool.apply_async``
+
+        :param channel: Optional :class:`ProgressChannel` used by the task. If given,
+                        the task can be cancelled using ``cancel``
+        """
+        if callback is not None:
+            callback = _SafeCallback(callback)
+        result = self._pool.apply_async(func, args, callback=callback)
+        if channel is not None:
+            with self._lock:
+                self._tasks.setdefault(channel.channel_id, []).append(result)
+        return result
+
+    def running(self, channel):
+        """
+        :return: True if any tasks started for the channel have not finished
+        """
+        with self._lock:
+            tasks = list(self._tasks.get(channel.channel_id, []))
+        return not all([task.ready() for task in tasks])
+
+    def cancel(self, channel, force=True):
+        """
+        Cancel the tasks using a channel
+
+        Workers stop the next time they report progress or check ``cancelled()``.
+
+        :param force: If True and the tasks are still running after ``CANCEL_TIMEOUT`` seconds,
+                      the pool is terminated. Any other tasks running in the pool are lost and
+                      a new pool is started when next required
+        """
+        self._cancel_flags[channel.slot] = 1
+        if force and self.running(channel):
+            timer = threading.Timer(CANCEL_TIMEOUT, self._enforce_cancel, [channel])
+            timer.daemon = True
+            timer.start()
+
+    def healthy(self):
+        """
+        :return: True if the pool is accepting tasks and all its worker processes are alive
+        """
+        if self.terminated:
+            return False
+        if getattr(self._pool, "_state", multiprocessing.pool.RUN) != multiprocessing.pool.RUN:
+            return False
+        if not self._dispatcher.is_alive():
+            return False
+        return all([proc.is_alive() for proc in getattr(self._pool, "_pool", [])])
+
+    def shutdown(self, wait=True):
+        """
+        Stop the worker processes
+
+        :param wait: If True, allow tasks which have already been started to finish, up to
+                     ``SHUTDOWN_TIMEOUT`` seconds. Otherwise, workers are terminated immediately
+        """
+        LOG.debug("Shutting down worker pool")
+        self.terminated = True
+        if wait:
+            self._pool.close()
+            joiner = threading.Thread(target=self._pool.join)
+            joiner.daemon = True
+            joiner.start()
+            joiner.join(SHUTDOWN_TIMEOUT)
+        self._pool.terminate()
+        self._progress.put(None)
+        self._dispatcher.join(SHUTDOWN_TIMEOUT)
+        self._progress.close()
+
+    def _enforce_cancel(self, channel):
+        """
+        Terminate the pool if cancelled tasks have not stopped
+        """
+        if not self.terminated and self.running(channel):
+            LOG.warn("Cancelled tasks did not stop after %.1fs - terminating worker processes", CANCEL_TIMEOUT)
+            discard_pool(self)
+
+    def _reap(self):
+        """
+        Free the cancel flags of released channels whose tasks have all finished
+        """
+        for channel_id, slot in list(self._released.items()):
+            if all([task.ready() for task in self._tasks.get(channel_id, [])]):
+                del self._released[channel_id]
+                self._tasks.pop(channel_id, None)
+                self._free_slots.append(slot)
+
+    def _dispatch(self):
+        """
+        Route progress messages from the workers to their channels
+        """
+        while True:
+            try:
+                msg = self._progress.get()
+            except (EOFError, OSError):
+                break
+            if msg is None:
+                break
+            channel_id, item = msg
+            with self._lock:
+                channel = self._channels.get(channel_id, None)
+            if channel is not None:
+                channel._local.put(item)
+
+def get_pool():
+    """
+    Get the shared worker pool, starting it if it is not already running
+
+    If the pool is not healthy, e.g. because a worker process has been killed, it is
+    replaced with a new pool. The pool is also replaced if ``POOL_SIZE`` has changed.
+
+    :return: :class:`WorkerPool`
+    """
+    global _POOL
+    size = POOL_SIZE
+    if size is None:
+        size = multiprocessing.cpu_count()
+
+    with _POOL_LOCK:
+        if _POOL is not None and not _POOL.healthy():
+            LOG.warn("Worker pool is not healthy - restarting")
+            _POOL.shutdown(wait=False)
+            _POOL = None
+        elif _POOL is not None and _POOL.size != size:
+            LOG.debug("Worker pool size changed from %i to %i", _POOL.size, size)
+            _POOL.shutdown()
+            _POOL = None
+        if _POOL is None:
+            _POOL = WorkerPool(size)
+        return _POOL
+
+def discard_pool(pool):
+    """
+    Terminate a worker pool immediately. If it is the shared pool, a new pool
+    will be started when next required
+
+    :param pool: :class:`WorkerPool`
+    """
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is pool:
+            _POOL = None
+    pool.shutdown(wait=False)
+
+def shutdown_pool(wait=True):
+    """
+    Stop the shared worker pool if it is running
+
+    The pool is restarted if it is needed again. This is called automatically,
+    without waiting for running tasks, when the application exits.
+
+    :param wait: If True, allow running tasks to finish, up to ``SHUTDOWN_TIMEOUT`` seconds
+    """
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is not None:
+            _POOL.shutdown(wait)
+            _POOL = None
+
+atexit.register(shutdown_pool, False)
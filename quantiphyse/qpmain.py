@@ -21,6 +21,7 @@ import pyqtgraph as pg
 from quantiphyse.test import run_tests
 from quantiphyse.utils import QpException, set_local_file_path
 from quantiphyse.utils.batch import BatchScript
+from quantiphyse.processes import workers
 from quantiphyse.utils.logger import set_base_log_level
 from quantiphyse.utils.local import get_icon
 from quantiphyse.gui import MainWindow, Register
@@ -63,6 +64,7 @@ def main():
     parser.add_argument('--test-fast', help='Run only fast tests', action="store_true")
     parser.add_argument('--qv', help='Activate quick-view mode', action="store_true")
     parser.add_argument('--register', help='Force display of registration dialog', action="store_true")
+    parser.add_argument('--workers', help='Number of worker processes for background processing (default=number of processors)', default=None, type=int)
     args = parser.parse_args()
 
     # OS specific changes
@@ -85,6 +87,9 @@ def main():
     if args.register:
         QtCore.QSettings().setValue("license_accepted", 0)
 
+    if args.workers is not None:
+        workers.POOL_SIZE = max(1, args.workers)
+
     # Set the local file path, used for finding icons, plugins, etc
     set_local_file_path()
     QtGui.QApplication.setWindowIcon(QtGui.QIcon(get_icon("main_icon.png")))
@@ -0,0 +1,120 @@
+"""
+Quantiphyse - tests for block-wise processing
+
+Copyright (c) 2013-2018 University of Oxford
+"""
+
+import os
+import unittest
+import tempfile
+
+import numpy as np
+
+from quantiphyse.data import NumpyData, DataGrid
+from quantiphyse.data.blocks import RunningStats, percentile
+
+GRIDSIZE = 5
+NVOLS = 4
+
+class BlocksTest(unittest.TestCase):
+    """ Tests for block iteration of QpData and block statistics """
+
+    def setUp(self):
+        self.shape = [GRIDSIZE, GRIDSIZE+1, GRIDSIZE+2]
+        self.grid = DataGrid(self.shape, np.identity(4))
+        self.floats4d = np.random.rand(*(self.shape + [NVOLS,])).astype(np.float32)
+        self.qpd = NumpyData(self.floats4d, grid=self.grid, name="test")
+
+    def testVolumeBlocks(self):
+        blocks = list(self.qpd.blocks(by="volume"))
+        self.assertEqual(len(blocks), NVOLS)
+        for idx, block in enumerate(blocks):
+            self.assertEqual(block.vol, idx)
+            self.assertTrue(np.all(block.data == self.floats4d[..., idx]))
+            self.assertTrue(np.all(self.floats4d[block.slices] == block.core))
+
+    def testSlabBlocks(self):
+        for axis in range(3):
+            blocks = list(self.qpd.blocks(by="slab", axis=axis, size=2))
+            self.assertEqual(len(blocks), (self.shape[axis] + 1) // 2)
+            for block in blocks:
+                self.assertEqual(block.data.shape[3], NVOLS)
+                self.assertTrue(np.all(self.floats4d[block.slices] == block.core))
+
+    def testSlabBlocksHalo(self):
+        blocks = list(self.qpd.blocks(by="slab", axis=2, size=3, halo=1))
+        self.assertEqual(blocks[0].data.shape[2], 4)
+        self.assertEqual(blocks[1].data.shape[2], 5)
+        self.assertEqual(blocks[2].data.shape[2], 2)
+        for block in blocks:
+            self.assertTrue(np.all(self.floats4d[block.slices] == block.core))
+
+    def testSlabBlocksVol(self):
+        blocks = list(self.qpd.blocks(by="slab", axis=0, size=2, vol=2))
+        for block in blocks:
+            self.assertEqual(block.data.ndim, 3)
+            self.assertTrue(np.all(self.floats4d[..., 2][block.slices[:3]] == block.core))
+
+    def testRoiBlocks(self):
+        roi = np.zeros(self.shape, dtype=np.int32)
+        roi[1:3, 2:4, 3:5] = 1
+        roi = NumpyData(roi, grid=self.grid, name="roi", roi=True)
+        blocks = list(self.qpd.blocks(by="roi", roi=roi, halo=1))
+        self.assertEqual(len(blocks), NVOLS)
+        for block in blocks:
+            self.assertEqual(list(block.data.shape), [4, 4, 4])
+            self.assertEqual(list(block.core.shape), [2, 2, 2])
+            self.assertTrue(np.all(self.floats4d[1:3, 2:4, 3:5, block.vol] == block.core))
+
+    def testRoiBlocksEmpty(self):
+        roi = NumpyData(np.zeros(self.shape, dtype=np.int32), grid=self.grid, name="roi", roi=True)
+        self.assertEqual(len(list(self.qpd.blocks(by="roi", roi=roi))), 0)
+
+    def testMapBlocks(self):
+        output = self.qpd.map_blocks(lambda block: block * 2, by="slab", size=2)
+        self.assertTrue(np.allclose(output, self.floats4d * 2))
+
+    def testMapBlocksHalo(self):
+        def _add_previous(block):
+            output = block.copy()
+            output[1:] += block[:-1]
+            return output
+        output = self.qpd.map_blocks(_add_previous, by="slab", axis=0, size=1, halo=1)
+        expected = self.floats4d.copy()
+        expected[1:] += self.floats4d[:-1]
+        self.assertTrue(np.allclose(output, expected))
+
+    def testMapBlocksMemmap(self):
+        fhandle, fname = tempfile.mkstemp(suffix=".npy")
+        os.close(fhandle)
+        try:
+            output = self.qpd.map_blocks(lambda block: block + 1, output=fname, by="volume")
+            self.assertTrue(isinstance(output, np.memmap))
+            del output
+            self.assertTrue(np.allclose(np.load(fname), self.floats4d + 1))
+        finally:
+            os.remove(fname)
+
+    def testRunningStats(self):
+        data = np.random.normal(1000, 1, size=1000)
+        stats = RunningStats()
+        for start in range(0, 1000, 70):
+            stats.update(data[start:start+70])
+        self.assertEqual(stats.n, 1000)
+        self.assertAlmostEqual(stats.mean, np.mean(data))
+        self.assertAlmostEqual(stats.std, np.std(data))
+        self.assertEqual(stats.min, np.min(data))
+        self.assertEqual(stats.max, np.max(data))
+
+    def testPercentile(self):
+        data = np.random.rand(1001)
+        arrays = lambda: [data[start:start+70] for start in range(0, 1001, 70)]
+        for q in (0, 25, 50, 90, 100):
+            self.assertAlmostEqual(percentile(arrays, q), np.percentile(data, q))
+        self.assertAlmostEqual(percentile(lambda: [data[:500], data[500:1000]], 50), np.median(data[:1000]))
+
+    def testPercentileEmpty(self):
+        self.assertTrue(percentile(lambda: [np.array([])], 50) is None)
+
+if __name__ == '__main__':
+    unittest.main()
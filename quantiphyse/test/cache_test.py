@@ -0,0 +1,83 @@
+"""
+Quantiphyse - tests for memory-bounded caches
+
+Copyright (c) 2013-2018 University of Oxford
+"""
+
+import unittest
+
+import numpy as np
+
+from quantiphyse.data.cache import LruCache, sizeof
+
+class LruCacheTest(unittest.TestCase):
+    """ Tests for the LruCache class """
+
+    def testGetPut(self):
+        cache = LruCache(1000)
+        arr = np.zeros(10, dtype=np.float32)
+        cache.put("a", arr)
+        self.assertTrue("a" in cache)
+        self.assertTrue(cache.get("a") is arr)
+        self.assertEqual(cache.nbytes, 40)
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(cache.misses, 0)
+
+    def testMiss(self):
+        cache = LruCache(1000)
+        self.assertTrue(cache.get("a") is None)
+        self.assertEqual(cache.get("a", 7), 7)
+        self.assertEqual(cache.hits, 0)
+        self.assertEqual(cache.misses, 2)
+
+    def testEvictLru(self):
+        cache = LruCache(100)
+        cache.put("a", np.zeros(10, dtype=np.float32))
+        cache.put("b", np.zeros(10, dtype=np.float32))
+        cache.get("a")
+        cache.put("c", np.zeros(10, dtype=np.float32))
+        self.assertTrue("a" in cache)
+        self.assertFalse("b" in cache)
+        self.assertTrue("c" in cache)
+        self.assertEqual(cache.nbytes, 80)
+
+    def testTooBig(self):
+        cache = LruCache(100)
+        cache.put("a", np.zeros(100, dtype=np.float32))
+        self.assertFalse("a" in cache)
+        self.assertEqual(cache.nbytes, 0)
+
+    def testReplace(self):
+        cache = LruCache(1000)
+        cache.put("a", np.zeros(10, dtype=np.float32))
+        cache.put("a", np.zeros(20, dtype=np.float32))
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.nbytes, 80)
+
+    def testRemoveIf(self):
+        cache = LruCache(1000)
+        for idx in range(5):
+            cache.put(("x", idx), np.zeros(1, dtype=np.float32))
+            cache.put(("y", idx), np.zeros(1, dtype=np.float32))
+        cache.remove_if(lambda key: key[0] == "x")
+        self.assertEqual(len(cache), 5)
+        self.assertEqual(cache.nbytes, 20)
+        for idx in range(5):
+            self.assertTrue(("y", idx) in cache)
+
+    def testResize(self):
+        cache = LruCache(1000)
+        for idx in range(10):
+            cache.put(idx, np.zeros(10, dtype=np.float32))
+        cache.resize(100)
+        self.assertEqual(len(cache), 2)
+        self.assertTrue(8 in cache)
+        self.assertTrue(9 in cache)
+
+    def testSizeof(self):
+        self.assertEqual(sizeof(np.zeros(10, dtype=np.float32)), 40)
+        self.assertEqual(sizeof((np.zeros(10, dtype=np.float32), np.zeros(5, dtype=np.int8))), 45)
+        self.assertEqual(sizeof("not an array"), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+"""
+Quantiphyse - tests for virtual concatenation of data items
+
+Copyright (c) 2013-2018 University of Oxford
+"""
+
+import unittest
+
+import numpy as np
+
+from quantiphyse.data import NumpyData, DataGrid, ConcatData
+from quantiphyse.data.qpdata import RESAMPLE_CACHE
+
+GRIDSIZE = 5
+NVOLS = 3
+
+class ConcatDataTest(unittest.TestCase):
+    """ Tests for ConcatData """
+
+    def setUp(self):
+        self.shape = [GRIDSIZE, GRIDSIZE, GRIDSIZE]
+        self.grid = DataGrid(self.shape, np.identity(4))
+        self.data4d = np.random.rand(*(self.shape + [NVOLS,])).astype(np.float32)
+        self.data3d = np.random.rand(*self.shape).astype(np.float32)
+        self.qpd4d = NumpyData(self.data4d, grid=self.grid, name="data4d")
+        self.qpd3d = NumpyData(self.data3d, grid=self.grid, name="data3d")
+        self.expected = np.concatenate([self.data4d, self.data3d[..., np.newaxis]], 3)
+        RESAMPLE_CACHE.clear()
+
+    def testVolumes(self):
+        qpd = ConcatData([self.qpd4d, self.qpd3d])
+        self.assertEqual(qpd.nvols, NVOLS+1)
+        self.assertEqual(qpd.ndim, 4)
+        for vol in range(NVOLS+1):
+            self.assertTrue(np.all(qpd.volume(vol) == self.expected[..., vol]))
+        # Volumes are read from the items without creating the concatenated data
+        self.assertTrue(qpd.rawdata is None)
+        self.assertTrue(np.all(qpd.raw() == self.expected))
+
+    def testBlocks(self):
+        qpd = ConcatData([self.qpd4d, self.qpd3d])
+        for block in qpd.blocks(by="slab", size=2):
+            self.assertTrue(np.all(block.data == self.expected[block.slices]))
+        for block in qpd.blocks(by="volume"):
+            self.assertTrue(np.all(block.data == self.expected[block.slices]))
+        self.assertTrue(qpd.rawdata is None)
+
+    def testResample(self):
+        affine = np.identity(4)
+        affine[:3, :3] *= 0.5
+        grid = DataGrid([GRIDSIZE*2, GRIDSIZE*2, GRIDSIZE*2], affine)
+        qpd = ConcatData([self.qpd3d, self.qpd4d], grid=grid)
+        self.assertTrue(qpd.grid.matches(grid))
+        expected4d = self.qpd4d.resample(grid).raw()
+        for vol in range(NVOLS):
+            self.assertTrue(np.allclose(qpd.volume(vol+1), expected4d[..., vol]))
+
+        # Resampled volumes are cached and discarded when the source item changes
+        voldata = qpd.volume(1)
+        self.assertTrue(qpd.volume(1) is voldata)
+        self.assertEqual(len(RESAMPLE_CACHE), NVOLS+1)
+        self.qpd4d.raw()[..., 0] = 7
+        self.qpd4d.mark_dirty()
+        self.assertEqual(len(RESAMPLE_CACHE), 0)
+        self.assertTrue(np.allclose(qpd.volume(1), self.qpd4d.resample(grid).raw()[..., 0]))
+        self.assertFalse(np.allclose(qpd.volume(1), voldata))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+"""
+Quantiphyse - tests for loading DICOM folders
+
+Copyright (c) 2013-2018 University of Oxford
+"""
+
+import os
+import unittest
+import tempfile
+import shutil
+
+import numpy as np
+
+from quantiphyse.data import dicoms
+
+NROWS, NCOLS, NSLICES, NVOLS = 6, 5, 4, 3
+
+def _write_dicom(fname, pixels, slice_loc, instance, series_uid="1.2.3.4"):
+    meta = dicoms.dicom.dataset.FileMetaDataset()
+    meta.MediaStorageSOPClassUID = "1.2.840.10008.5.1.4.1.1.4"
+    meta.MediaStorageSOPInstanceUID = "1.2.3.%i" % instance
+    meta.TransferSyntaxUID = dicoms.dicom.uid.ExplicitVRLittleEndian
+    dcm = dicoms.dicom.dataset.FileDataset(fname, {}, file_meta=meta, preamble=b"\0" * 128)
+    dcm.SeriesInstanceUID = series_uid
+    dcm.SliceLocation = slice_loc
+    dcm.InstanceNumber = instance
+    dcm.ImagePositionPatient = [0, 0, slice_loc]
+    dcm.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+    dcm.PixelSpacing = [1, 1]
+    dcm.SliceThickness = 2
+    dcm.Rows, dcm.Columns = pixels.shape
+    dcm.BitsAllocated, dcm.BitsStored, dcm.HighBit = 16, 16, 15
+    dcm.SamplesPerPixel = 1
+    dcm.PixelRepresentation = 0
+    dcm.PhotometricInterpretation = "MONOCHROME2"
+    dcm.PixelData = pixels.astype(np.uint16).tobytes()
+    dcm.save_as(fname, enforce_file_format=True)
+
+@unittest.skipIf(not dicoms.HAVE_PYDICOM, "pydicom not available")
+class DicomFolderTest(unittest.TestCase):
+    """ Tests for the DicomFolder class """
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix="qp")
+        self.data = np.random.randint(0, 1000, (NROWS, NCOLS, NSLICES, NVOLS))
+        instance = 1
+        for vol in range(NVOLS):
+            # Write slices in reverse order to check they are sorted by location
+            for slc in reversed(range(NSLICES)):
+                fname = os.path.join(self.tempdir, "file%i.dcm" % (instance * 7 % 13))
+                _write_dicom(fname, self.data[:, :, slc, vol], slc * 2.0, instance)
+                instance += 1
+        with open(os.path.join(self.tempdir, "README.txt"), "w") as readme:
+            readme.write("Not a DICOM file")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def testLoad(self):
+        progress = []
+        qpd = dicoms.DicomFolder(self.tempdir, progress_cb=progress.append)
+        self.assertEqual(list(qpd.grid.shape), [NROWS, NCOLS, NSLICES])
+        self.assertEqual(qpd.nvols, NVOLS)
+        self.assertTrue(qpd.dcmdata is None)
+        self.assertAlmostEqual(progress[-1], 1)
+
+        self.assertEqual(qpd.raw().dtype, np.float32)
+        self.assertTrue(np.all(qpd.raw() == self.data))
+
+    def testIgnoreOtherSeries(self):
+        _write_dicom(os.path.join(self.tempdir, "other.dcm"), self.data[:, :, 0, 0], 0, 1, series_uid="5.6.7")
+        qpd = dicoms.DicomFolder(self.tempdir)
+        self.assertEqual(qpd.nvols, NVOLS)
+        self.assertTrue(np.all(qpd.raw() == self.data))
+
+    def testUncache(self):
+        qpd = dicoms.DicomFolder(self.tempdir)
+        qpd.raw()
+        qpd.uncache()
+        self.assertTrue(qpd.dcmdata is None)
+        self.assertTrue(np.all(qpd.raw() == self.data))
+
+    def testIndex(self):
+        dicoms.DicomFolder(self.tempdir)
+        self.assertTrue(os.path.exists(os.path.join(self.tempdir, dicoms.INDEX_FNAME)))
+
+        # Reloading should use the index rather than reading the headers again
+        scan = dicoms.DicomSeries.scan
+        try:
+            dicoms.DicomSeries.scan = None
+            qpd = dicoms.DicomFolder(self.tempdir)
+        finally:
+            dicoms.DicomSeries.scan = scan
+        self.assertEqual(qpd.nvols, NVOLS)
+        self.assertTrue(np.all(qpd.raw() == self.data))
+
+    def testIndexChanged(self):
+        dicoms.DicomFolder(self.tempdir)
+        for slc in range(NSLICES):
+            _write_dicom(os.path.join(self.tempdir, "extra%i.dcm" % slc), self.data[:, :, slc, 0], slc * 2.0, 100 + slc)
+        qpd = dicoms.DicomFolder(self.tempdir)
+        self.assertEqual(qpd.nvols, NVOLS + 1)
+        self.assertTrue(np.all(qpd.raw()[..., NVOLS] == self.data[..., 0]))
+
+if __name__ == '__main__':
+    unittest.main()
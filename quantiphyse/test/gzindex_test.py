@@ -0,0 +1,86 @@
+"""
+Quantiphyse - tests for random access to gzip files
+
+Copyright (c) 2013-2018 University of Oxford
+"""
+
+import os
+import gzip
+import unittest
+import tempfile
+import shutil
+
+import numpy as np
+
+from quantiphyse.data import gzindex
+
+DATA_SIZE = 500000
+SPACING = 20000
+
+class GzipIndexTest(unittest.TestCase):
+    """ Tests for GzipIndex and IndexedGzipFile """
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix="qp")
+        self.data = np.random.randint(0, 16, DATA_SIZE).astype(np.uint8).tobytes()
+        self.spacing = gzindex.CHECKPOINT_SPACING
+        gzindex.CHECKPOINT_SPACING = SPACING
+
+    def tearDown(self):
+        gzindex.CHECKPOINT_SPACING = self.spacing
+        shutil.rmtree(self.tempdir)
+
+    def _write(self, member_size=None):
+        fname = os.path.join(self.tempdir, "test.gz")
+        if member_size is None:
+            member_size = len(self.data)
+        with open(fname, "wb") as gzfile:
+            for start in range(0, len(self.data), member_size):
+                with gzip.GzipFile(fileobj=gzfile, mode="wb") as member:
+                    member.write(self.data[start:start+member_size])
+        return fname
+
+    def testRandomReads(self):
+        gzfile = gzindex.IndexedGzipFile(self._write())
+        for offset, size in [(DATA_SIZE // 2, 1000), (10, 100), (DATA_SIZE - 50, 100), (12345, 54321), (DATA_SIZE - 10, 100)]:
+            gzfile.seek(offset)
+            self.assertEqual(gzfile.read(size), self.data[offset:offset+size])
+            self.assertEqual(gzfile.tell(), min(offset+size, DATA_SIZE))
+        gzfile.seek(0, os.SEEK_END)
+        self.assertEqual(gzfile.tell(), DATA_SIZE)
+
+    def testCheckpoints(self):
+        gzfile = gzindex.IndexedGzipFile(self._write())
+        self.assertEqual(gzfile.read(), self.data)
+        points = gzfile.index.points
+        self.assertTrue(len(points) > 1)
+        self.assertTrue(all([b.uoffset - a.uoffset >= SPACING for a, b in zip(points[:-1], points[1:])]))
+
+        # Re-reading should not add checkpoints
+        gzfile.seek(SPACING // 3)
+        gzfile.read()
+        self.assertEqual(len(gzfile.index.points), len(points))
+
+    def testMembersIndex(self):
+        fname = self._write(member_size=DATA_SIZE // 10)
+        gzfile = gzindex.IndexedGzipFile(fname)
+        self.assertEqual(gzfile.read(), self.data)
+        self.assertTrue(os.path.exists(fname + gzindex.INDEX_EXT))
+
+        # Member start points should be loaded from the index file
+        index = gzindex.GzipIndex(fname)
+        self.assertTrue(index.load())
+        self.assertEqual(index.length, DATA_SIZE)
+        self.assertEqual([p.uoffset for p in index.points], list(range(0, DATA_SIZE, DATA_SIZE // 10)))
+
+    def testIndexChanged(self):
+        fname = self._write()
+        gzindex.IndexedGzipFile(fname).read()
+        self.data = self.data[:DATA_SIZE // 2]
+        os.utime(self._write(), (0, 0))
+        gzfile = gzindex.IndexedGzipFile(fname)
+        self.assertTrue(gzfile.index.length is None)
+        self.assertEqual(gzfile.read(), self.data)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -8,6 +8,7 @@ import unittest
 import numpy as np
 
 from quantiphyse.data import ImageVolumeManagement, NumpyData, DataGrid
+from quantiphyse.data.qpdata import RESAMPLE_CACHE
 
 GRIDSIZE = 5
 
@@ -158,6 +159,16 @@ class IVMTest(unittest.TestCase):
         self.assertTrue(self.ivm.current_roi is None)
         self.assertTrue(self.ivm.main is None)
       
+    def testDeleteUncachesResampled(self):
+        shape = [GRIDSIZE, GRIDSIZE, GRIDSIZE]
+        grid = DataGrid(shape, np.identity(4))
+        qpd = NumpyData(np.random.rand(*shape), name="test", grid=grid)
+        self.ivm.add(qpd)
+        qpd.resample(DataGrid(shape, np.diag([0.5, 0.5, 0.5, 1])), order=1)
+        self.assertTrue(any([key[0] == qpd.uid for key in RESAMPLE_CACHE._items]))
+        self.ivm.delete(qpd.name)
+        self.assertFalse(any([key[0] == qpd.uid for key in RESAMPLE_CACHE._items]))
+
     def testRename(self):
         shape = [GRIDSIZE, GRIDSIZE, GRIDSIZE]
         grid = DataGrid(shape, np.identity(4))
@@ -171,5 +182,82 @@ class IVMTest(unittest.TestCase):
         self.assertEqual(self.ivm.main, self.ivm.data["test2"])
         self.assertTrue(np.all(self.ivm.data["test2"].raw() == qpd.raw()))
 
+    def testMemoryUsage(self):
+        shape = [GRIDSIZE, GRIDSIZE, GRIDSIZE]
+        grid = DataGrid(shape, np.identity(4))
+        qpd = NumpyData(np.random.rand(*shape), name="test", grid=grid)
+        self.ivm.add(qpd)
+        self.assertEqual(self.ivm.memory_usage(), {"test" : qpd.raw().nbytes})
+
+    def testMemoryBudget(self):
+        shape = [GRIDSIZE, GRIDSIZE, GRIDSIZE]
+        grid = DataGrid(shape, np.identity(4))
+        self.ivm.memory_budget = 3 * np.random.rand(*shape).astype(np.float32).nbytes
+        data = {}
+        for idx in range(5):
+            data[idx] = np.random.rand(*shape).astype(np.float32)
+            self.ivm.add(NumpyData(data[idx], name="test%i" % idx, grid=grid))
+        self.assertTrue(sum(self.ivm.memory_usage().values()) <= self.ivm.memory_budget)
+        
+        # Main and current data should not have been spilled, but the next oldest should
+        self.assertFalse(self.ivm.data["test0"].spilled)
+        self.assertFalse(self.ivm.data["test1"].spilled)
+        self.assertTrue(self.ivm.data["test2"].spilled)
+        self.assertTrue(self.ivm.data["test3"].spilled)
+        self.assertFalse(self.ivm.data["test4"].spilled)
+        for idx in range(5):
+            self.assertTrue(np.all(self.ivm.data["test%i" % idx].raw() == data[idx]))
+
+    def testMemoryBudgetRoi(self):
+        shape = [GRIDSIZE, GRIDSIZE, GRIDSIZE]
+        grid = DataGrid(shape, np.identity(4))
+        self.ivm.memory_budget = 0
+        self.ivm.add(NumpyData(np.random.rand(*shape), name="main", grid=grid))
+        self.ivm.add(NumpyData(np.random.randint(0, 10, size=shape), name="roi", grid=grid, roi=True))
+        self.ivm.add(NumpyData(np.random.rand(*shape), name="data", grid=grid))
+        self.ivm.add(NumpyData(np.random.rand(*shape), name="data2", grid=grid))
+        self.assertFalse(self.ivm.data["main"].spilled)
+        self.assertFalse(self.ivm.data["roi"].spilled)
+        self.assertFalse(self.ivm.data["data"].spilled)
+        self.assertTrue(self.ivm.data["data2"].spilled)
+
+    def testSample(self):
+        shape = [GRIDSIZE, GRIDSIZE, GRIDSIZE]
+        grid = DataGrid(shape, np.identity(4))
+        affine = np.identity(4)
+        affine[0, 3] = 1
+        grid2 = DataGrid(shape, affine)
+        data3d = np.random.rand(*shape)
+        data4d = np.random.rand(*(shape + [3,]))
+        data_shifted = np.random.rand(*shape)
+        self.ivm.add(NumpyData(data3d, name="data3d", grid=grid))
+        self.ivm.add(NumpyData(data4d, name="data4d", grid=grid))
+        self.ivm.add(NumpyData(data_shifted, name="shifted", grid=grid2))
+
+        samples = self.ivm.sample([[1, 2, 3], [2, 2, 2]])
+        self.assertEqual(sorted(samples.keys()), ["data3d", "data4d", "shifted"])
+        self.assertTrue(np.allclose(samples["data3d"][:, 0], data3d[[1, 2], [2, 2], [3, 2]]))
+        self.assertTrue(np.allclose(samples["data4d"], data4d[[1, 2], [2, 2], [3, 2], :]))
+        self.assertTrue(np.allclose(samples["shifted"][:, 0], data_shifted[[0, 1], [2, 2], [3, 2]]))
+
+        samples = self.ivm.sample([[1, 2, 3]], vols=1, names=["data4d"])
+        self.assertEqual(list(samples.keys()), ["data4d"])
+        self.assertAlmostEqual(samples["data4d"][0], data4d[1, 2, 3, 1])
+
+    def testValuesTimeseries(self):
+        shape = [GRIDSIZE, GRIDSIZE, GRIDSIZE]
+        grid = DataGrid(shape, np.identity(4))
+        data3d = np.random.rand(*shape)
+        data4d = np.random.rand(*(shape + [3,]))
+        self.ivm.add(NumpyData(data3d, name="data3d", grid=grid))
+        self.ivm.add(NumpyData(data4d, name="data4d", grid=grid))
+
+        values = self.ivm.values([1, 2, 3, 0])
+        self.assertEqual(list(values.keys()), ["data3d"])
+        self.assertAlmostEqual(values["data3d"], data3d[1, 2, 3])
+        timeseries = self.ivm.timeseries([1, 2, 3, 0])
+        self.assertEqual(list(timeseries.keys()), ["data4d"])
+        self.assertTrue(np.allclose(timeseries["data4d"], data4d[1, 2, 3, :]))
+
 if __name__ == '__main__':
     unittest.main()
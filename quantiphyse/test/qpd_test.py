@@ -9,9 +9,13 @@ import unittest
 import tempfile
 
 import numpy as np
+import nibabel as nib
 
-from quantiphyse.data import NumpyData, DataGrid
+from quantiphyse.data import NumpyData, DataGrid, OrthoSlice
+from quantiphyse.data import qpdata
+from quantiphyse.data.qpdata import RESAMPLE_CACHE, SLICE_CACHE, SLICE_GEOMETRY_CACHE
 import quantiphyse.data.nifti as nifti
+import quantiphyse.data.gzindex as gzindex
 
 GRIDSIZE = 5
 NVOLS = 4
@@ -55,8 +59,54 @@ class NumpyDataTest(unittest.TestCase):
     def testRoiFloats(self):
         """ Check that ROIs can contain float data so long as the numbers are really integers """
         qpd = NumpyData(self.ints.astype(np.float), grid=self.grid, name="test", roi=True)
-        self.assertTrue(issubclass(qpd.raw().dtype.type, np.floating))
         self.assertTrue(qpd.roi)
+        self.assertEqual(qpd.raw().dtype, np.uint8)
+        self.assertTrue(np.all(qpd.raw() == self.ints))
+
+    def testWorkingDtype(self):
+        """ Float data is stored in the working type and is not copied if already in that type """
+        qpd = NumpyData(self.floats4d, grid=self.grid, name="test")
+        self.assertEqual(qpd.raw().dtype, np.float32)
+        floats = self.floats4d.astype(np.float32)
+        qpd = NumpyData(floats, grid=self.grid, name="test")
+        self.assertTrue(qpd.raw() is floats)
+
+    def testWorkingDtypeConfig(self):
+        """ The working type can be changed """
+        orig = qpdata.WORKING_DTYPE
+        try:
+            qpdata.WORKING_DTYPE = np.float64
+            qpd = NumpyData(self.floats4d, grid=self.grid, name="test")
+            self.assertTrue(qpd.raw() is self.floats4d)
+            self.assertEqual(qpd.map_blocks(lambda x: x).dtype, np.float64)
+        finally:
+            qpdata.WORKING_DTYPE = orig
+
+    def testRoiLabelDtype(self):
+        """ ROI data uses the smallest integer type which holds the labels """
+        qpd = NumpyData(self.ints * 100, grid=self.grid, name="test", roi=True)
+        self.assertEqual(qpd.raw().dtype, np.uint16)
+        qpd = NumpyData(-self.ints, grid=self.grid, name="test", roi=True)
+        self.assertEqual(qpd.raw().dtype, np.int8)
+        qpd = NumpyData(self.ints, grid=self.grid, name="test", roi=False)
+        self.assertEqual(qpd.raw().dtype, self.ints.dtype)
+
+    def testRoiLabelDtypeResample(self):
+        qpd = NumpyData(self.ints, grid=self.grid, name="test", roi=True)
+        affine = np.identity(4)
+        affine[:3, :3] *= 0.5
+        resampled = qpd.resample(DataGrid([GRIDSIZE*2]*3, affine))
+        self.assertEqual(resampled.raw().dtype, np.uint8)
+        masked = qpd.mask(qpd)
+        self.assertEqual(masked.dtype, np.uint8)
+
+    def testEnsureLabel(self):
+        qpd = NumpyData(self.ints, grid=self.grid, name="test", roi=True)
+        qpd.ensure_label(200)
+        self.assertEqual(qpd.raw().dtype, np.uint8)
+        qpd.ensure_label(1000)
+        self.assertEqual(qpd.raw().dtype, np.uint16)
+        self.assertTrue(np.all(qpd.raw() == self.ints))
         
     def testRoiRegions(self):
         qpd = NumpyData(self.ints, grid=self.grid, name="test", roi=True)
@@ -108,6 +158,218 @@ class NumpyDataTest(unittest.TestCase):
         POS = [2, 3, 4]
         self.assertAlmostEqual(qpd.value(POS), self.floats4d[POS[0], POS[1], POS[2], 0])
         
+    def testValueOutside(self):
+        qpd = NumpyData(self.floats, grid=self.grid, name="test")
+        self.assertEqual(qpd.value([-1, 3, 4]), 0)
+        self.assertEqual(qpd.value([2, GRIDSIZE, 4]), 0)
+
+    def testTimeseries(self):
+        qpd = NumpyData(self.floats4d, grid=self.grid, name="test")
+        self.assertTrue(np.allclose(qpd.timeseries([2, 3, 4]), self.floats4d[2, 3, 4, :]))
+        self.assertEqual(qpd.timeseries([2, 3, GRIDSIZE]), [])
+
+    def testSample(self):
+        qpd = NumpyData(self.floats4d, grid=self.grid, name="test")
+        points = np.array([[0, 0, 0], [2, 3, 4], [1.2, 0.8, 3.4], [-1, 2, 2], [4, 4, 5]])
+        samples = qpd.sample(points)
+        self.assertEqual(samples.shape, (5, NVOLS))
+        self.assertTrue(np.allclose(samples[0], self.floats4d[0, 0, 0, :]))
+        self.assertTrue(np.allclose(samples[1], self.floats4d[2, 3, 4, :]))
+        self.assertTrue(np.allclose(samples[2], self.floats4d[1, 1, 3, :]))
+        self.assertTrue(np.all(samples[3:] == 0))
+
+        samples = qpd.sample(points, vols=2)
+        self.assertEqual(samples.shape, (5,))
+        self.assertAlmostEqual(samples[1], self.floats4d[2, 3, 4, 2])
+
+        samples = qpd.sample(points, vols=[3, 1], fill=np.nan)
+        self.assertEqual(samples.shape, (5, 2))
+        self.assertTrue(np.allclose(samples[1], self.floats4d[2, 3, 4, [3, 1]]))
+        self.assertTrue(np.all(np.isnan(samples[3:])))
+
+    def testSampleGrid(self):
+        qpd = NumpyData(self.floats, grid=self.grid, name="test")
+        affine = np.identity(4)
+        affine[:3, :3] *= 2
+        affine[:3, 3] = [1, 0, 0]
+        grid = DataGrid([3, 3, 3], affine)
+        samples = qpd.sample([[0, 1, 2], [1, 1, 1]], grid=grid)
+        self.assertTrue(np.allclose(samples[:, 0], [self.floats[1, 2, 4], self.floats[3, 2, 2]]))
+
+    def testSampleInterp(self):
+        qpd = NumpyData(self.floats4d, grid=self.grid, name="test")
+        samples = qpd.sample([[1, 2, 3], [1.5, 2, 3]], order=1)
+        self.assertTrue(np.allclose(samples[0], self.floats4d[1, 2, 3, :]))
+        expected = (self.floats4d[1, 2, 3, :] + self.floats4d[2, 2, 3, :]) / 2
+        self.assertTrue(np.allclose(samples[1], expected))
+
+    def testSampleInts(self):
+        qpd = NumpyData(self.ints, grid=self.grid, name="test")
+        samples = qpd.sample([[1, 2, 3], [GRIDSIZE, 0, 0]], vols=0)
+        self.assertTrue(np.issubdtype(samples.dtype, np.integer))
+        self.assertEqual(samples[0], self.ints[1, 2, 3])
+        self.assertEqual(samples[1], 0)
+
+    def testResampleCache(self):
+        qpd = NumpyData(self.floats4d, grid=self.grid, name="test")
+        grid = DataGrid([GRIDSIZE*2, GRIDSIZE*2, GRIDSIZE*2], np.diag([0.5, 0.5, 0.5, 1]))
+        res1 = qpd.resample(grid, order=1)
+        hits = RESAMPLE_CACHE.hits
+        res2 = qpd.resample(grid, order=1)
+        self.assertEqual(RESAMPLE_CACHE.hits, hits + 1)
+        self.assertTrue(np.allclose(res1.raw(), res2.raw()))
+
+        # Different interpolation order should not use cached data
+        qpd.resample(grid, order=0)
+        self.assertEqual(RESAMPLE_CACHE.hits, hits + 1)
+
+    def testResampleCacheModified(self):
+        qpd = NumpyData(self.floats, grid=self.grid, name="test")
+        grid = DataGrid([GRIDSIZE*2, GRIDSIZE*2, GRIDSIZE*2], np.diag([0.5, 0.5, 0.5, 1]))
+        res1 = qpd.resample(grid, order=0)
+        qpd.raw()[:] = 7
+        qpd.mark_dirty()
+        res2 = qpd.resample(grid, order=0)
+        expected = NumpyData(np.full(self.shape, 7), grid=self.grid, name="expected").resample(grid, order=0)
+        self.assertTrue(np.all(res2.raw() == expected.raw()))
+        self.assertFalse(np.all(res1.raw() == expected.raw()))
+
+    def testSliceCache(self):
+        qpd = NumpyData(self.floats4d, grid=self.grid, name="test")
+        plane = OrthoSlice(self.grid, 2, 3)
+        sdata, smask, _, _ = qpd.slice_data(plane, vol=1)
+        self.assertTrue(np.allclose(sdata, self.floats4d[:, :, 3, 1]))
+        self.assertTrue(np.all(smask == 1))
+        self.assertFalse(sdata.flags.writeable)
+        hits = SLICE_CACHE.hits
+        self.assertTrue(qpd.slice_data(plane, vol=1)[0] is sdata)
+        self.assertEqual(SLICE_CACHE.hits, hits + 1)
+
+        # Interpolation order is irrelevant for orthogonal slices
+        self.assertTrue(qpd.slice_data(plane, vol=1, interp_order=1)[0] is sdata)
+
+        qpd.raw()[:, :, 3, 1] = 7
+        qpd.mark_dirty()
+        self.assertTrue(np.all(qpd.slice_data(plane, vol=1)[0] == 7))
+
+    def testSliceCacheOblique(self):
+        affine = np.identity(4)
+        affine[1:3, 1:3] = [[0.8, -0.6], [0.6, 0.8]]
+        plane = OrthoSlice(DataGrid(self.shape, affine), 2, 2)
+        qpd = NumpyData(self.floats, grid=self.grid, name="test")
+        qpd2 = NumpyData(self.floats * 2, grid=self.grid, name="test2")
+        sdata, smask, _, _ = qpd.slice_data(plane, interp_order=1)
+        self.assertTrue((self.grid.key(), plane.key()) in SLICE_GEOMETRY_CACHE)
+
+        # Slice geometry is shared by data on the same grid
+        hits = SLICE_GEOMETRY_CACHE.hits
+        sdata2, smask2, _, _ = qpd2.slice_data(plane, interp_order=1)
+        self.assertEqual(SLICE_GEOMETRY_CACHE.hits, hits + 1)
+        self.assertTrue(np.allclose(sdata2, sdata * 2))
+        self.assertTrue(np.all(smask2 == smask))
+        self.assertTrue(np.any(smask == 0))
+        self.assertTrue(np.all(sdata[smask == 0] == 0))
+
+        # Interpolation order matters for oblique slices
+        sdata0, _, _, _ = qpd.slice_data(plane, interp_order=0)
+        self.assertFalse(np.allclose(sdata0, sdata))
+
+    def testPyramid(self):
+        data = np.random.rand(32, 33, 1, 2)
+        qpd = NumpyData(data, grid=DataGrid([32, 33, 1], np.identity(4)), name="test")
+        self.assertEqual(qpd.pyramid_levels, 2)
+
+        level1 = qpd.pyramid(1, vol=1)
+        self.assertEqual(list(level1.grid.shape), [16, 17, 1])
+        self.assertAlmostEqual(level1.raw()[3, 4, 0], np.mean(data[6:8, 8:10, 0, 1]), places=5)
+        # Odd sized axes are padded by repeating the edge voxel
+        self.assertAlmostEqual(level1.raw()[3, 16, 0], np.mean(data[6:8, 32, 0, 1]), places=5)
+        self.assertTrue(np.allclose(level1.grid.spacing, [2, 2, 1]))
+        self.assertTrue(np.allclose(level1.grid.origin, [0.5, 0.5, 0]))
+        self.assertTrue(qpd.pyramid(1, vol=1) is level1)
+        self.assertTrue(qpd.pyramid(5, vol=1) is level1)
+
+        qpd.mark_dirty()
+        self.assertFalse(qpd.pyramid(1, vol=1) is level1)
+
+    def testPyramidRoi(self):
+        qpd = NumpyData(np.random.randint(0, 5, (64, 64, 64)), grid=DataGrid([64, 64, 64], np.identity(4)), name="test", roi=True)
+        self.assertEqual(qpd.pyramid_levels, 3)
+        level2 = qpd.pyramid(2)
+        self.assertEqual(list(level2.grid.shape), [16, 16, 16])
+        self.assertTrue(np.all(level2.raw() == qpd.raw()[::4, ::4, ::4]))
+        self.assertTrue(np.allclose(level2.grid.origin, [0, 0, 0]))
+
+    def testSlicePyramid(self):
+        data = np.random.rand(64, 64, 64)
+        qpd = NumpyData(data, grid=DataGrid([64, 64, 64], np.identity(4)), name="test")
+        plane = OrthoSlice(qpd.grid, 2, 32)
+        sdata, _, scale, offset = qpd.slice_data(plane, level=1)
+        self.assertEqual(sdata.shape, (32, 32))
+        self.assertTrue(np.allclose(sdata, qpd.pyramid(1).raw()[:, :, 16]))
+        # Reduced resolution slice covers the same area as the full resolution slice
+        self.assertTrue(np.allclose(scale, [[2, 0], [0, 2]]))
+        self.assertTrue(np.allclose(offset, qpd.slice_data(plane)[3]))
+
+    def testSpill(self):
+        qpd = NumpyData(self.floats4d, grid=self.grid, name="test")
+        qpd.uncache()
+        self.assertTrue(qpd.spilled)
+        self.assertEqual(qpd.memory_usage, 0)
+        self.assertTrue(np.allclose(qpd.raw(), self.floats4d))
+        self.assertTrue(np.allclose(qpd.volume(1), self.floats4d[..., 1]))
+        fname = qpd._spill_fname
+        self.assertTrue(os.path.exists(fname))
+        del qpd
+        self.assertFalse(os.path.exists(fname))
+
+    def testMarkDirtyVersion(self):
+        qpd = NumpyData(self.floats, grid=self.grid, name="test")
+        version = qpd.version
+        qpd.mark_dirty()
+        self.assertTrue(qpd.version > version)
+
+    def testMarkDirtyRange(self):
+        qpd = NumpyData(self.floats, grid=self.grid, name="test")
+        qpd.range()
+        qpd.raw()[:] = 7
+        qpd.mark_dirty()
+        self.assertAlmostEqual(qpd.range()[0], 7)
+        self.assertAlmostEqual(qpd.range()[1], 7)
+
+    def testMarkDirtyRegions(self):
+        ints = np.zeros(self.shape, dtype=np.int32)
+        ints[1, 1, 1] = 1
+        ints[2, 2, 2] = 2
+        qpd = NumpyData(ints, grid=self.grid, name="test", roi=True)
+        qpd.regions[2] = "Tumour"
+        qpd.raw()[3, 3, 3] = 3
+        qpd.mark_dirty()
+        self.assertEqual(sorted(qpd.regions.keys()), [1, 2, 3])
+        self.assertEqual(qpd.regions[2], "Tumour")
+
+    def testMarkDirtyBoundingBox(self):
+        ints = np.zeros(self.shape, dtype=np.int32)
+        ints[1:3, 1:3, 1:3] = 1
+        qpd = NumpyData(ints, grid=self.grid, name="test", roi=True)
+        self.assertEqual(qpd.get_bounding_box(), [slice(1, 3)] * 3)
+        qpd.raw()[4, 4, 4] = 1
+        qpd.mark_dirty()
+        self.assertEqual(qpd.get_bounding_box(), [slice(1, 5)] * 3)
+
+    def testMarkDirtySignal(self):
+        qpd = NumpyData(self.floats, grid=self.grid, name="test")
+        changed = []
+        qpd.sig_changed.connect(changed.append)
+        qpd.mark_dirty()
+        self.assertEqual(changed, [qpd])
+
+    def testSet2dtVersion(self):
+        qpd = NumpyData(self.floats, grid=self.grid, name="test")
+        version = qpd.version
+        qpd.set_2dt()
+        self.assertTrue(qpd.version > version)
+
 class NiftiDataTest(unittest.TestCase):
     """ Tests for the NiftiData subclass of QpData """
 
@@ -148,5 +410,153 @@ class NiftiDataTest(unittest.TestCase):
         nifti_data = nifti.NiftiData(fname)
         nifti.save(nifti_data, fname)
 
+    def testMmap(self):
+        qpd = NumpyData(self.floats4d, grid=self.grid, name="test")
+        tempdir = tempfile.mkdtemp(prefix="qp")
+        fname = os.path.join(tempdir, "test.nii")
+        nifti.save(qpd, fname)
+
+        nifti_data = nifti.NiftiData(fname, mmap=True)
+        self.assertTrue(isinstance(nifti_data.raw(), np.memmap))
+        self.assertTrue(np.allclose(nifti_data.raw(), self.floats4d))
+
+    def testNoMmap(self):
+        qpd = NumpyData(self.floats4d, grid=self.grid, name="test")
+        tempdir = tempfile.mkdtemp(prefix="qp")
+        fname = os.path.join(tempdir, "test.nii")
+        nifti.save(qpd, fname)
+
+        nifti_data = nifti.NiftiData(fname, mmap=False)
+        self.assertFalse(isinstance(nifti_data.raw(), np.memmap))
+        self.assertTrue(np.allclose(nifti_data.raw(), self.floats4d))
+
+    def testMmapAutoSmall(self):
+        qpd = NumpyData(self.floats4d, grid=self.grid, name="test")
+        tempdir = tempfile.mkdtemp(prefix="qp")
+        fname = os.path.join(tempdir, "test.nii")
+        nifti.save(qpd, fname)
+
+        nifti_data = nifti.NiftiData(fname)
+        self.assertFalse(isinstance(nifti_data.raw(), np.memmap))
+
+    def testVolumeCache(self):
+        qpd = NumpyData(self.floats4d, grid=self.grid, name="test")
+        tempdir = tempfile.mkdtemp(prefix="qp")
+        fname = os.path.join(tempdir, "test.nii.gz")
+        nifti.save(qpd, fname)
+
+        prefetch = nifti.PREFETCH_VOLS
+        try:
+            nifti.PREFETCH_VOLS = 0
+            nifti_data = nifti.NiftiData(fname)
+            hits, misses = nifti.VOLUME_CACHE.hits, nifti.VOLUME_CACHE.misses
+            for idx in range(NVOLS):
+                self.assertTrue(np.allclose(nifti_data.volume(idx), self.floats4d[..., idx]))
+            self.assertEqual(nifti.VOLUME_CACHE.misses, misses + NVOLS)
+            for idx in range(NVOLS):
+                self.assertTrue(np.allclose(nifti_data.volume(idx), self.floats4d[..., idx]))
+            self.assertEqual(nifti.VOLUME_CACHE.hits, hits + NVOLS)
+
+            nifti_data.uncache()
+            for idx in range(NVOLS):
+                self.assertFalse((nifti_data.uid, idx) in nifti.VOLUME_CACHE)
+        finally:
+            nifti.PREFETCH_VOLS = prefetch
+
+    def testVolumePrefetch(self):
+        qpd = NumpyData(self.floats4d, grid=self.grid, name="test")
+        tempdir = tempfile.mkdtemp(prefix="qp")
+        fname = os.path.join(tempdir, "test.nii.gz")
+        nifti.save(qpd, fname)
+
+        nifti_data = nifti.NiftiData(fname)
+        nifti_data.prefetch(range(NVOLS)).join()
+        for idx in range(NVOLS):
+            self.assertTrue((nifti_data.uid, idx) in nifti.VOLUME_CACHE)
+            self.assertTrue(np.allclose(nifti_data.volume(idx), self.floats4d[..., idx]))
+
+    def testSampleVolumeFile(self):
+        qpd = NumpyData(self.floats4d, grid=self.grid, name="test")
+        tempdir = tempfile.mkdtemp(prefix="qp")
+        fname = os.path.join(tempdir, "test.nii")
+        nifti.save(qpd, fname)
+
+        nifti_data = nifti.NiftiData(fname, mmap=False)
+        points = [[2, 3, 4], [0, 1, 0]]
+        samples = nifti_data.sample(points)
+        self.assertTrue(np.allclose(samples, self.floats4d[[2, 0], [3, 1], [4, 0], :]))
+        self.assertTrue(np.allclose(nifti_data.sample(points, vols=1), self.floats4d[[2, 0], [3, 1], [4, 0], 1]))
+        # Sampling should not load the whole data
+        self.assertTrue(nifti_data.rawdata is None)
+
+    def testSlabBlocks(self):
+        """ Slabs are read from the file without loading the whole data """
+        qpd = NumpyData(self.floats4d, grid=self.grid, name="test")
+        tempdir = tempfile.mkdtemp(prefix="qp")
+        fname = os.path.join(tempdir, "test.nii")
+        nifti.save(qpd, fname)
+
+        nifti_data = nifti.NiftiData(fname, mmap=False)
+        for block in nifti_data.blocks(by="slab", size=2):
+            self.assertTrue(np.allclose(block.core, self.floats4d[block.slices]))
+        self.assertTrue(nifti_data.rawdata is None)
+
+    def testVolumeCompressed(self):
+        """ Volumes are read from compressed files in any order using the gzip index """
+        qpd = NumpyData(self.floats4d, grid=self.grid, name="test")
+        tempdir = tempfile.mkdtemp(prefix="qp")
+        fname = os.path.join(tempdir, "test.nii.gz")
+        nifti.save(qpd, fname)
+
+        prefetch = nifti.PREFETCH_VOLS
+        try:
+            nifti.PREFETCH_VOLS = 0
+            nifti_data = nifti.NiftiData(fname)
+            for idx in reversed(range(NVOLS)):
+                self.assertTrue(np.allclose(nifti_data.volume(idx), self.floats4d[..., idx]))
+            self.assertTrue(np.allclose(nifti_data.timeseries([1, 2, 3]), self.floats4d[1, 2, 3, :]))
+            self.assertTrue(nifti_data.rawdata is None)
+        finally:
+            nifti.PREFETCH_VOLS = prefetch
+
+    def testSaveCompressedMembers(self):
+        """ Compressed files are written in multiple gzip members which are indexed """
+        qpd = NumpyData(self.floats4d, grid=self.grid, name="test")
+        tempdir = tempfile.mkdtemp(prefix="qp")
+        fname = os.path.join(tempdir, "test.nii.gz")
+        member_size = gzindex.MEMBER_SIZE
+        try:
+            gzindex.MEMBER_SIZE = 200
+            nifti.save(qpd, fname, compresslevel=9, threads=3)
+        finally:
+            gzindex.MEMBER_SIZE = member_size
+
+        index = gzindex.GzipIndex(fname)
+        self.assertTrue(index.load())
+        self.assertTrue(len(index.points) > NVOLS)
+        nii = nib.load(fname)
+        self.assertTrue(np.allclose(nii.get_fdata(), self.floats4d))
+        self.assertTrue(np.allclose(nii.affine, self.grid.affine))
+        nifti_data = nifti.NiftiData(fname)
+        self.assertTrue(np.allclose(nifti_data.volume(NVOLS-1), self.floats4d[..., NVOLS-1]))
+
+    def testSaveRoiLabelDtype(self):
+        qpd = NumpyData(self.ints, grid=self.grid, name="test", roi=True)
+        tempdir = tempfile.mkdtemp(prefix="qp")
+        fname = os.path.join(tempdir, "test.nii")
+        nifti.save(qpd, fname)
+        self.assertEqual(nib.load(fname).get_data_dtype(), np.uint8)
+
+    def testMmapCompressed(self):
+        """ Compressed files cannot be memory mapped so are read into memory """
+        qpd = NumpyData(self.floats4d, grid=self.grid, name="test")
+        tempdir = tempfile.mkdtemp(prefix="qp")
+        fname = os.path.join(tempdir, "test.nii.gz")
+        nifti.save(qpd, fname)
+
+        nifti_data = nifti.NiftiData(fname, mmap=True)
+        self.assertFalse(isinstance(nifti_data.raw(), np.memmap))
+        self.assertTrue(np.allclose(nifti_data.raw(), self.floats4d))
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,150 @@
+"""
+Quantiphyse - tests for ROI region index
+
+Copyright (c) 2013-2018 University of Oxford
+"""
+
+import unittest
+
+import numpy as np
+
+from quantiphyse.data import NumpyData, DataGrid
+from quantiphyse.data.regions import RegionIndex
+
+GRIDSIZE = 5
+NVOLS = 3
+
+class RegionIndexTest(unittest.TestCase):
+    """ Tests for the RegionIndex class """
+
+    def setUp(self):
+        self.shape = [GRIDSIZE, GRIDSIZE+1, GRIDSIZE+2]
+        self.grid = DataGrid(self.shape, np.identity(4))
+        self.roi = np.random.randint(0, 4, size=self.shape)
+        self.floats4d = np.random.rand(*(self.shape + [NVOLS,]))
+
+    def testLabels(self):
+        index = RegionIndex(self.roi)
+        labels = [label for label in np.unique(self.roi) if label != 0]
+        self.assertEqual(list(index.labels), labels)
+        for label in labels:
+            self.assertTrue(label in index)
+            self.assertEqual(index.count(label), np.count_nonzero(self.roi == label))
+        self.assertFalse(0 in index)
+        self.assertEqual(index.count(7), 0)
+
+    def testLargeLabels(self):
+        roi = np.zeros(self.shape, dtype=np.int64)
+        roi[1, 1, 1] = 10000000
+        roi[2, 2, 2] = -3
+        index = RegionIndex(roi)
+        self.assertEqual(list(index.labels), [-3, 10000000])
+        self.assertEqual(index.count(-3), 1)
+
+    def testIndices(self):
+        index = RegionIndex(self.roi)
+        for label in index.labels:
+            self.assertTrue(np.all(index.indices(label) == np.flatnonzero(self.roi == label)))
+
+    def testIndicesRange(self):
+        index = RegionIndex(self.roi)
+        expected = np.flatnonzero(self.roi == 1)
+        expected = expected[(expected >= 20) & (expected < 100)]
+        self.assertTrue(np.all(index.indices(1, 20, 100) == expected))
+
+    def testTake(self):
+        index = RegionIndex(self.roi)
+        for label in index.labels:
+            self.assertTrue(np.all(index.take(self.floats4d, label) == self.floats4d[self.roi == label]))
+            self.assertTrue(np.all(index.take(self.floats4d[..., 0], label) == self.floats4d[..., 0][self.roi == label]))
+
+    def testPut(self):
+        index = RegionIndex(self.roi)
+        output = np.zeros(self.shape + [NVOLS,])
+        index.put(output, 2, [1, 2, 3])
+        self.assertTrue(np.all(output[self.roi == 2] == [1, 2, 3]))
+        self.assertTrue(np.all(output[self.roi != 2] == 0))
+
+    def testPutNonContiguous(self):
+        index = RegionIndex(self.roi)
+        output = np.zeros(self.shape + [NVOLS,])
+        index.put(output[..., 1], 2, 7)
+        self.assertTrue(np.all(output[..., 1][self.roi == 2] == 7))
+        self.assertTrue(np.all(output[..., 1][self.roi != 2] == 0))
+
+    def testBbox(self):
+        roi = np.zeros(self.shape, dtype=np.int32)
+        roi[1:3, 2:5, 0:2] = 1
+        roi[4, 0, 6] = 2
+        index = RegionIndex(roi)
+        self.assertEqual(index.bbox(1), (slice(1, 3), slice(2, 5), slice(0, 2)))
+        self.assertEqual(index.bbox(2), (slice(4, 5), slice(0, 1), slice(6, 7)))
+        self.assertTrue(index.bbox(3) is None)
+
+    def testValues(self):
+        roi = NumpyData(self.roi, grid=self.grid, name="roi", roi=True)
+        data = NumpyData(self.floats4d, grid=self.grid, name="data")
+        index = roi.region_index()
+        for label in index.labels:
+            values = np.concatenate(list(index.values(data, label)))
+            self.assertTrue(np.allclose(values, self.floats4d[self.roi == label]))
+            values = np.concatenate(list(index.values(data, label, vol=1)))
+            self.assertTrue(np.allclose(values, self.floats4d[..., 1][self.roi == label]))
+
+    def testStats(self):
+        roi = NumpyData(self.roi, grid=self.grid, name="roi", roi=True)
+        data = NumpyData(self.floats4d, grid=self.grid, name="data")
+        index = roi.region_index()
+        stats = index.stats(data, hist_bins=10)
+        for pos, label in enumerate(index.labels):
+            values = self.floats4d[self.roi == label]
+            self.assertEqual(stats["count"][pos], values.size)
+            self.assertAlmostEqual(stats["mean"][pos], np.mean(values), places=5)
+            self.assertAlmostEqual(stats["median"][pos], np.median(values), places=5)
+            self.assertAlmostEqual(stats["std"][pos], np.std(values), places=5)
+            self.assertAlmostEqual(stats["min"][pos], np.min(values), places=5)
+            self.assertAlmostEqual(stats["max"][pos], np.max(values), places=5)
+            hist, edges = np.histogram(values, bins=10)
+            self.assertTrue(np.all(stats["hist"][pos] == hist))
+            self.assertTrue(np.allclose(stats["hist_edges"][pos], edges))
+
+    def testStatsPerVolume(self):
+        roi = NumpyData(self.roi, grid=self.grid, name="roi", roi=True)
+        data = NumpyData(self.floats4d, grid=self.grid, name="data")
+        index = roi.region_index()
+        stats = index.stats(data, per_volume=True, hist_bins=5, hist_range=(0.2, 0.8))
+        for pos, label in enumerate(index.labels):
+            for vol in range(NVOLS):
+                values = self.floats4d[..., vol][self.roi == label]
+                self.assertAlmostEqual(stats["mean"][pos, vol], np.mean(values), places=5)
+                self.assertAlmostEqual(stats["median"][pos, vol], np.median(values), places=5)
+                self.assertAlmostEqual(stats["std"][pos, vol], np.std(values), places=5)
+                hist, _ = np.histogram(values, bins=5, range=(0.2, 0.8))
+                self.assertTrue(np.all(stats["hist"][pos, vol] == hist))
+
+    def testStatsVol(self):
+        roi = NumpyData(self.roi, grid=self.grid, name="roi", roi=True)
+        data = NumpyData(self.floats4d, grid=self.grid, name="data")
+        index = roi.region_index()
+        stats = index.stats(data, vol=1)
+        for pos, label in enumerate(index.labels):
+            values = self.floats4d[..., 1][self.roi == label]
+            self.assertEqual(stats["count"][pos], values.size)
+            self.assertAlmostEqual(stats["mean"][pos], np.mean(values), places=5)
+            self.assertAlmostEqual(stats["median"][pos], np.median(values), places=5)
+
+    def testCached(self):
+        roi = NumpyData(self.roi, grid=self.grid, name="roi", roi=True)
+        index = roi.region_index()
+        self.assertTrue(roi.region_index() is index)
+        roi.raw()[0, 0, 0] = 9
+        roi.mark_dirty()
+        self.assertFalse(roi.region_index() is index)
+        self.assertEqual(roi.region_index().count(9), 1)
+
+    def testNotRoi(self):
+        data = NumpyData(self.floats4d, grid=self.grid, name="data")
+        self.assertRaises(TypeError, data.region_index)
+
+if __name__ == '__main__':
+    unittest.main()
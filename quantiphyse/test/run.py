@@ -6,8 +6,22 @@ from .ivm_test import IVMTest
 from .qpd_test import NumpyDataTest, NiftiDataTest
 from .slice_plane_test import OrthoSliceTest
 from .io_test import IoProcessTest
-
-class_tests = [IVMTest, NumpyDataTest, NiftiDataTest, OrthoSliceTest, IoProcessTest,]
+from .cache_test import LruCacheTest
+from .blocks_test import BlocksTest
+from .regions_test import RegionIndexTest
+from .voxels_test import VoxelTableTest
+from .dicom_test import DicomFolderTest
+from .gzindex_test import GzipIndexTest
+from .session_test import SessionTest
+from .concat_test import ConcatDataTest
+from .views_test import CropDataTest, VolumeSubsetDataTest
+from .workers_test import WorkerPoolTest
+from .transport_test import ArrayTransportTest, WeightedChunksTest
+
+class_tests = [IVMTest, NumpyDataTest, NiftiDataTest, OrthoSliceTest, IoProcessTest, LruCacheTest, BlocksTest,
+               RegionIndexTest, VoxelTableTest, DicomFolderTest, GzipIndexTest,
+               SessionTest, ConcatDataTest, CropDataTest, VolumeSubsetDataTest,
+               WorkerPoolTest, ArrayTransportTest, WeightedChunksTest,]
 
 def run_tests(test_filter=None):
     """
@@ -0,0 +1,101 @@
+"""
+Quantiphyse - tests for saving and restoring sessions
+
+Copyright (c) 2013-2018 University of Oxford
+"""
+
+import os
+import unittest
+import tempfile
+import shutil
+
+import numpy as np
+
+from quantiphyse.data import ImageVolumeManagement, NumpyData, DataGrid
+from quantiphyse.data.extras import MatrixExtra
+from quantiphyse.data import session
+
+GRIDSIZE = 5
+NVOLS = 3
+
+class SessionTest(unittest.TestCase):
+    """ Tests for save_session and load_session """
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix="qp")
+        self.path = os.path.join(self.tempdir, "test" + session.SESSION_EXT)
+        shape = [GRIDSIZE, GRIDSIZE, GRIDSIZE]
+        affine = np.identity(4)
+        affine[:3, 3] = [1, 2, 3]
+        self.grid = DataGrid(shape, affine)
+        self.data4d = np.random.rand(*(shape + [NVOLS,])).astype(np.float32)
+        self.roi = np.random.randint(0, 3, shape)
+
+        self.ivm = ImageVolumeManagement()
+        self.ivm.add(NumpyData(self.data4d, grid=self.grid, name="data4d"), make_main=True)
+        self.ivm.add(NumpyData(self.data4d[..., 0], grid=self.grid, name="data3d"), make_current=True)
+        self.ivm.add(NumpyData(self.roi, grid=self.grid, name="mask", roi=True), make_current=True)
+        self.ivm.data["data3d"].metadata["cmap"] = "hot"
+        self.ivm.add_extra("matrix", MatrixExtra("matrix", [[1, 2], [3, 4]], col_headers=["a", "b"]))
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _files(self):
+        return sorted([fname for fname in os.listdir(self.path) if fname.endswith(".npy")])
+
+    def testRestore(self):
+        session.save_session(self.ivm, self.path)
+        ivm = ImageVolumeManagement()
+        session.load_session(self.path, ivm)
+
+        self.assertEqual(sorted(ivm.data.keys()), ["data3d", "data4d", "mask"])
+        for qpdata in ivm.data.values():
+            # Data is not read until it is needed
+            self.assertTrue(qpdata.rawdata is None)
+        self.assertEqual(ivm.main.name, "data4d")
+        self.assertEqual(ivm.current_data.name, "data3d")
+        self.assertEqual(ivm.current_roi.name, "mask")
+        self.assertEqual(ivm.data["data3d"].metadata["cmap"], "hot")
+        self.assertTrue(ivm.data["mask"].roi)
+        self.assertTrue(np.allclose(ivm.data["data4d"].grid.affine, self.grid.affine))
+        self.assertEqual(ivm.data["data4d"].nvols, NVOLS)
+        self.assertTrue(np.all(ivm.data["data4d"].raw() == self.data4d))
+        self.assertTrue(np.all(ivm.data["mask"].raw() == self.roi))
+        self.assertEqual(ivm.extras["matrix"].col_headers, ["a", "b"])
+
+    def testIncremental(self):
+        session.save_session(self.ivm, self.path)
+        files = self._files()
+
+        # Nothing has changed
+        session.save_session(self.ivm, self.path)
+        self.assertEqual(self._files(), files)
+
+        # Only the modified and new items are written
+        self.ivm.data["data3d"].raw()[0, 0, 0] = 7
+        self.ivm.data["data3d"].mark_dirty()
+        self.ivm.add(NumpyData(self.roi, grid=self.grid, name="mask2", roi=True))
+        self.ivm.delete("data4d")
+        session.save_session(self.ivm, self.path)
+        self.assertEqual(self._files(), ["data3d.3.npy", "mask.1.npy", "mask2.3.npy"])
+
+    def testIncrementalRestored(self):
+        session.save_session(self.ivm, self.path)
+        ivm = ImageVolumeManagement()
+        session.load_session(self.path, ivm)
+        files = self._files()
+
+        session.save_session(ivm, self.path)
+        self.assertEqual(self._files(), files)
+
+        # Modifications do not change the session file until saved
+        ivm.data["mask"].raw()[0, 0, 0] = 5
+        ivm.data["mask"].mark_dirty()
+        self.assertEqual(np.load(os.path.join(self.path, "mask.1.npy"))[0, 0, 0], self.roi[0, 0, 0])
+        session.save_session(ivm, self.path)
+        self.assertTrue("mask.3.npy" in self._files())
+        self.assertEqual(np.load(os.path.join(self.path, "mask.3.npy"))[0, 0, 0], 5)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+"""
+Quantiphyse - tests for the shared memory transport of arrays to worker processes
+
+Copyright (c) 2013-2018 University of Oxford
+"""
+
+import os
+import pickle
+import unittest
+
+import numpy as np
+
+from quantiphyse.processes import workers
+from quantiphyse.processes.transport import ArrayTransport, SharedArray, run_worker, weighted_chunk_slices
+
+N_CHUNKS = 3
+
+def _double(worker_id, queue, inp, out):
+    out[...] = inp * 2
+    return worker_id, True, (inp.sum(), inp * 3)
+
+class ArrayTransportTest(unittest.TestCase):
+    """ Tests for ArrayTransport """
+
+    def setUp(self):
+        self.transport = ArrayTransport(min_bytes=500)
+        self.data = np.random.rand(10, 6, 7).astype(np.float32)
+
+    def tearDown(self):
+        self.transport.close()
+        workers.shutdown_pool()
+
+    def testSplit(self):
+        chunks = self.transport.split(self.data, N_CHUNKS, 0)
+        self.assertTrue(all([isinstance(chunk, SharedArray) for chunk in chunks]))
+        arrays = [pickle.loads(pickle.dumps(chunk)) for chunk in chunks]
+        for arr, expected in zip(arrays, np.array_split(self.data, N_CHUNKS, 0)):
+            self.assertTrue(isinstance(arr, np.memmap))
+            self.assertTrue(np.all(arr == expected))
+        # Inputs are copy on write so workers cannot modify each other's data
+        arrays[0][...] = 0
+        self.assertTrue(np.all(chunks[0].open() == np.array_split(self.data, N_CHUNKS, 0)[0]))
+
+    def testSplitSlices(self):
+        slices = [slice(0, 2), slice(2, 3), slice(3, 10)]
+        chunks = [chunk.open() for chunk in self.transport.split(self.data, slices, 0)]
+        self.assertEqual([chunk.shape[0] for chunk in chunks], [2, 1, 7])
+        self.assertTrue(np.all(np.concatenate(chunks, 0) == self.data))
+
+    def testSmallArrays(self):
+        small = np.zeros((2, 3))
+        chunks = self.transport.split(small, N_CHUNKS, 0)
+        self.assertTrue(all([isinstance(chunk, np.ndarray) for chunk in chunks]))
+        self.assertEqual(os.listdir(self.transport.path), [])
+
+    def testWorkers(self):
+        out = self.transport.empty(self.data.shape, np.float32)
+        pool = workers.get_pool()
+        tasks = []
+        for worker_id, (inp, out_chunk) in enumerate(zip(self.transport.split(self.data, N_CHUNKS, 0),
+                                                         self.transport.split(out, N_CHUNKS, 0))):
+            tasks.append(pool.apply_async(run_worker, (self.transport, _double, worker_id, None, inp, out_chunk)))
+        results = [task.get(10) for task in tasks]
+
+        # Output written directly by the workers
+        self.assertTrue(np.allclose(out, self.data * 2))
+
+        # Large results are returned as memory maps, small ones as normal
+        for worker_id, success, (total, tripled) in results:
+            expected = np.array_split(self.data, N_CHUNKS, 0)[worker_id]
+            self.assertTrue(success)
+            self.assertAlmostEqual(total, expected.sum(), places=3)
+            self.assertTrue(isinstance(tripled, np.memmap))
+            self.assertTrue(np.allclose(tripled, expected * 3))
+
+class WeightedChunksTest(unittest.TestCase):
+    """ Tests for dividing an axis into chunks of equal weight """
+
+    def _check_cover(self, slices, size):
+        self.assertEqual(slices[0].start, 0)
+        self.assertEqual(slices[-1].stop, size)
+        for prev, chunk in zip(slices[:-1], slices[1:]):
+            self.assertEqual(prev.stop, chunk.start)
+        self.assertTrue(all([chunk.stop > chunk.start for chunk in slices]))
+
+    def testUneven(self):
+        # Most of the weight in a few slices
+        weights = [0] * 10 + [100] * 4 + [1] * 10
+        slices = weighted_chunk_slices(weights, 4)
+        self._check_cover(slices, len(weights))
+        self.assertEqual(len(slices), 4)
+        totals = [sum(weights[chunk]) for chunk in slices]
+        self.assertTrue(max(totals) <= 110)
+
+    def testZeroWeights(self):
+        slices = weighted_chunk_slices(np.zeros(10), 3)
+        self.assertEqual([chunk.stop - chunk.start for chunk in slices], [4, 3, 3])
+
+    def testMoreChunksThanSlices(self):
+        slices = weighted_chunk_slices([5, 0, 1], 10)
+        self._check_cover(slices, 3)
+        self.assertEqual(len(slices), 3)
+
+if __name__ == '__main__':
+    unittest.main()
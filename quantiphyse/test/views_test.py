@@ -0,0 +1,106 @@
+"""
+Quantiphyse - tests for cropped and volume subset views of data
+
+Copyright (c) 2013-2018 University of Oxford
+"""
+
+import unittest
+
+import numpy as np
+
+from quantiphyse.data import NumpyData, DataGrid, CropData, VolumeSubsetData
+
+GRIDSIZE = 6
+NVOLS = 5
+
+class CropDataTest(unittest.TestCase):
+    """ Tests for CropData """
+
+    def setUp(self):
+        self.shape = [GRIDSIZE, GRIDSIZE, GRIDSIZE]
+        affine = np.identity(4)
+        affine[:3, :3] *= 2
+        affine[:3, 3] = [1, 2, 3]
+        self.grid = DataGrid(self.shape, affine)
+        self.data4d = np.random.rand(*(self.shape + [NVOLS,])).astype(np.float32)
+        self.qpd = NumpyData(self.data4d, grid=self.grid, name="data4d")
+        self.slices = [slice(1, 4), slice(2, 6), slice(0, 5, 2)]
+
+    def testView(self):
+        crop = CropData(self.qpd, self.slices)
+        expected = self.data4d[tuple(self.slices)]
+        self.assertEqual(list(crop.grid.shape), [3, 4, 3])
+        self.assertEqual(crop.nvols, NVOLS)
+        self.assertTrue(np.all(crop.raw() == expected))
+        self.assertTrue(np.shares_memory(crop.raw(), self.data4d))
+        self.assertTrue(np.all(crop.volume(2) == expected[..., 2]))
+        for block in crop.blocks(by="slab", size=2):
+            self.assertTrue(np.all(block.data == expected[block.slices]))
+
+    def testGrid(self):
+        crop = CropData(self.qpd, self.slices)
+        # Voxels are in the same place in world space
+        for voxel in [(0, 0, 0), (2, 3, 2)]:
+            parent_voxel = [s.start + v*s.step for s, v in zip(crop.slices, voxel)]
+            self.assertTrue(np.allclose(np.dot(crop.grid.affine, list(voxel) + [1]),
+                                        np.dot(self.grid.affine, parent_voxel + [1])))
+        self.assertTrue(np.allclose(crop.resample(self.grid).raw()[tuple(self.slices)], crop.raw()))
+
+    def testUncrop(self):
+        crop = CropData(self.qpd, self.slices)
+        output = crop.uncrop(crop.raw() * 2)
+        self.assertEqual(list(output.shape), self.shape + [NVOLS,])
+        self.assertTrue(np.allclose(output[tuple(self.slices)], self.data4d[tuple(self.slices)] * 2))
+        self.assertEqual(np.count_nonzero(output), np.count_nonzero(crop.raw()))
+
+    def testRoiBoundingBox(self):
+        roi = np.zeros(self.shape, dtype=np.int8)
+        roi[1:3, 2:5, 3] = 2
+        roiqpd = NumpyData(roi, grid=self.grid, name="roi", roi=True)
+        crop = CropData(roiqpd, roiqpd.get_bounding_box())
+        self.assertTrue(crop.roi)
+        self.assertEqual(list(crop.grid.shape), [2, 3, 1])
+        self.assertTrue(np.all(crop.raw() == 2))
+
+    def testParentModified(self):
+        crop = CropData(self.qpd, self.slices)
+        version = crop.version
+        self.qpd.raw()[1, 2, 0, 0] = 7
+        self.qpd.mark_dirty()
+        self.assertTrue(crop.version > version)
+        self.assertEqual(crop.raw()[0, 0, 0, 0], 7)
+
+class VolumeSubsetDataTest(unittest.TestCase):
+    """ Tests for VolumeSubsetData """
+
+    def setUp(self):
+        self.shape = [GRIDSIZE, GRIDSIZE, GRIDSIZE]
+        self.grid = DataGrid(self.shape, np.identity(4))
+        self.data4d = np.random.rand(*(self.shape + [NVOLS,])).astype(np.float32)
+        self.qpd = NumpyData(self.data4d, grid=self.grid, name="data4d")
+
+    def testSlice(self):
+        subset = VolumeSubsetData(self.qpd, slice(1, None, 2))
+        self.assertEqual(subset.nvols, 2)
+        self.assertTrue(np.all(subset.raw() == self.data4d[..., 1::2]))
+        self.assertTrue(np.shares_memory(subset.raw(), self.data4d))
+        self.assertTrue(np.all(subset.volume(1) == self.data4d[..., 3]))
+
+    def testList(self):
+        subset = VolumeSubsetData(self.qpd, [4, 0, 1])
+        self.assertTrue(np.all(subset.raw() == self.data4d[..., [4, 0, 1]]))
+        for block in subset.blocks(by="slab", size=2):
+            self.assertTrue(np.all(block.data == self.data4d[..., [4, 0, 1]][block.slices]))
+
+    def testSingleVolume(self):
+        subset = VolumeSubsetData(self.qpd, [3])
+        self.assertEqual(subset.ndim, 3)
+        self.assertTrue(np.all(subset.raw() == self.data4d[..., 3]))
+
+    def testCropSubset(self):
+        slices = [slice(1, 3), slice(0, 4), slice(2, 6)]
+        subset = VolumeSubsetData(CropData(self.qpd, slices), [0, 2, 4])
+        self.assertTrue(np.all(subset.raw() == self.data4d[tuple(slices)][..., ::2]))
+
+if __name__ == '__main__':
+    unittest.main()
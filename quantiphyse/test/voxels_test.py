@@ -0,0 +1,86 @@
+"""
+Quantiphyse - tests for voxel tables
+
+Copyright (c) 2013-2018 University of Oxford
+"""
+
+import unittest
+
+import numpy as np
+
+from quantiphyse.data import NumpyData, DataGrid, VoxelTable
+from quantiphyse.data.qpdata import VOXEL_TABLE_CACHE, working_dtype
+
+GRIDSIZE = 5
+NVOLS = 3
+
+class VoxelTableTest(unittest.TestCase):
+    """ Tests for the VoxelTable class """
+
+    def setUp(self):
+        self.shape = [GRIDSIZE, GRIDSIZE+1, GRIDSIZE+2]
+        self.grid = DataGrid(self.shape, np.identity(4))
+        self.roi = np.random.randint(0, 4, size=self.shape)
+        self.floats4d = np.random.rand(*(self.shape + [NVOLS,])).astype(np.float32)
+        self.data = NumpyData(self.floats4d, grid=self.grid, name="data")
+        self.qproi = NumpyData(self.roi, grid=self.grid, name="roi", roi=True)
+        VOXEL_TABLE_CACHE.clear()
+
+    def testArray(self):
+        mask = self.roi > 0
+        table = VoxelTable(self.floats4d, mask)
+        self.assertEqual(table.nvoxels, np.count_nonzero(mask))
+        self.assertEqual(table.nvols, NVOLS)
+        self.assertEqual(table.values.dtype, working_dtype())
+        self.assertTrue(table.values.flags.c_contiguous)
+        self.assertTrue(np.all(table.values == self.floats4d[mask]))
+        self.assertTrue(np.all(table.indices == np.flatnonzero(mask)))
+
+    def test3d(self):
+        table = VoxelTable(self.floats4d[..., 0])
+        self.assertEqual(table.values.shape, (np.prod(self.shape), 1))
+        self.assertTrue(np.all(table.values[:, 0] == self.floats4d[..., 0].flatten()))
+
+    def testData(self):
+        table = self.data.voxel_table(self.qproi)
+        mask = self.roi > 0
+        self.assertTrue(np.all(table.values == self.floats4d[mask]))
+        self.assertTrue(np.all(table.labels == self.roi[mask]))
+
+        inverted = self.data.voxel_table(self.qproi, invert=True)
+        self.assertTrue(np.all(inverted.values == self.floats4d[~mask]))
+
+    def testScatter(self):
+        mask = self.roi > 0
+        table = VoxelTable(self.floats4d, mask)
+        image = table.scatter(table.values)
+        expected = np.zeros(self.floats4d.shape, dtype=np.float32)
+        expected[mask] = self.floats4d[mask]
+        self.assertTrue(np.all(image == expected))
+
+        labels = table.scatter(np.arange(table.nvoxels) + 1, fill=-1, dtype=np.int32)
+        self.assertEqual(labels.dtype, np.int32)
+        self.assertTrue(np.all(labels[~mask] == -1))
+        self.assertTrue(np.all(labels[mask] == np.arange(table.nvoxels) + 1))
+
+    def testScatterNonContiguous(self):
+        mask = self.roi > 0
+        table = VoxelTable(self.floats4d, mask)
+        output = np.zeros(self.shape[::-1], dtype=np.float32).T
+        table.scatter(table.values[:, 1], output=output)
+        self.assertTrue(np.all(output[mask] == self.floats4d[mask][:, 1]))
+
+    def testCached(self):
+        table = self.data.voxel_table(self.qproi)
+        self.assertTrue(self.data.voxel_table(self.qproi) is table)
+        self.assertFalse(table.values.flags.writeable)
+
+        # Modifying the ROI gives a new table
+        self.qproi.raw()[...] = 1
+        self.qproi.mark_dirty()
+        new_table = self.data.voxel_table(self.qproi)
+        self.assertFalse(new_table is table)
+        self.assertEqual(new_table.nvoxels, np.prod(self.shape))
+
+if __name__ == '__main__':
+    unittest.main()
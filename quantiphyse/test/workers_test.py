@@ -0,0 +1,121 @@
+"""
+Quantiphyse - tests for the shared worker pool
+
+Copyright (c) 2013-2018 University of Oxford
+"""
+
+import os
+import time
+import unittest
+
+from quantiphyse.processes import workers
+
+def _report(channel, values):
+    for value in values:
+        channel.put(value)
+    return os.getpid()
+
+def _poll(channel, duration):
+    start = time.time()
+    while time.time() - start < duration:
+        channel.put(time.time() - start)
+        time.sleep(0.05)
+
+def _sleep(channel, duration):
+    time.sleep(duration)
+
+class WorkerPoolTest(unittest.TestCase):
+    """ Tests for the shared worker pool """
+
+    def setUp(self):
+        self.pool_size = workers.POOL_SIZE
+        workers.POOL_SIZE = 2
+
+    def tearDown(self):
+        workers.shutdown_pool()
+        workers.POOL_SIZE = self.pool_size
+
+    def _read(self, channel, num):
+        return [channel.get(timeout=10) for _ in range(num)]
+
+    def testReused(self):
+        pool = workers.get_pool()
+        self.assertTrue(pool.healthy())
+        self.assertTrue(workers.get_pool() is pool)
+        pids = set([pool.apply_async(os.getpid).get(10) for _ in range(10)])
+        self.assertTrue(len(pids) <= 2)
+        self.assertFalse(os.getpid() in pids)
+
+    def testProgressChannels(self):
+        pool = workers.get_pool()
+        channel1, channel2 = pool.channel(), pool.channel()
+        task1 = pool.apply_async(_report, (channel1, [1, 2, 3]))
+        task2 = pool.apply_async(_report, (channel2, ["a", "b"]))
+        task1.get(10)
+        task2.get(10)
+        self.assertEqual(self._read(channel1, 3), [1, 2, 3])
+        self.assertEqual(self._read(channel2, 2), ["a", "b"])
+        self.assertTrue(channel1.empty())
+        pool.release(channel1)
+        pool.release(channel2)
+
+    def testShutdown(self):
+        pool = workers.get_pool()
+        workers.shutdown_pool()
+        self.assertFalse(pool.healthy())
+        new_pool = workers.get_pool()
+        self.assertFalse(new_pool is pool)
+        self.assertEqual(new_pool.apply_async(os.getpid).get(10) != os.getpid(), True)
+
+    def testUnhealthy(self):
+        pool = workers.get_pool()
+        pool._pool._pool[0].terminate()
+        pool._pool._pool[0].join()
+        self.assertFalse(pool.healthy())
+        self.assertFalse(workers.get_pool() is pool)
+
+    def testSize(self):
+        pool = workers.get_pool()
+        workers.POOL_SIZE = 3
+        new_pool = workers.get_pool()
+        self.assertFalse(new_pool is pool)
+        self.assertEqual(new_pool.size, 3)
+
+    def testCancel(self):
+        pool = workers.get_pool()
+        channel = pool.channel()
+        task = pool.apply_async(_poll, (channel, 30), channel=channel)
+        time.sleep(0.5)
+        self.assertTrue(pool.running(channel))
+        start = time.time()
+        pool.cancel(channel)
+        self.assertTrue(channel.cancelled())
+        self.assertRaises(workers.TaskCancelled, task.get, 10)
+        self.assertTrue(time.time() - start < workers.CANCEL_TIMEOUT)
+        pool.release(channel)
+        time.sleep(workers.CANCEL_TIMEOUT + 0.5)
+        self.assertTrue(workers.get_pool() is pool)
+
+    def testCancelTerminates(self):
+        pool = workers.get_pool()
+        channel = pool.channel()
+        pool.apply_async(_sleep, (channel, 30), channel=channel)
+        time.sleep(0.5)
+        pool.cancel(channel)
+        time.sleep(workers.CANCEL_TIMEOUT + 1)
+        self.assertTrue(pool.terminated)
+        self.assertFalse(pool.healthy())
+        new_pool = workers.get_pool()
+        self.assertFalse(new_pool is pool)
+        self.assertTrue(new_pool.apply_async(os.getpid).get(10) != os.getpid())
+
+    def testChannelReuse(self):
+        pool = workers.get_pool()
+        channel = pool.channel()
+        pool.cancel(channel)
+        pool.release(channel)
+        new_channel = pool.channel()
+        self.assertFalse(new_channel.cancelled())
+
+if __name__ == '__main__':
+    unittest.main()
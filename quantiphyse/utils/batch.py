@@ -53,7 +53,9 @@ BASIC_PROCESSES = {
     "LoadData" : LoadDataProcess,
     "LoadRois" : LoadRoisProcess,
     "SaveArtifacts" : SaveArtifactsProcess,
-    "SaveExtras" : SaveArtifactsProcess
+    "SaveExtras" : SaveArtifactsProcess,
+    "SaveSession" : SaveSessionProcess,
+    "LoadSession" : LoadSessionProcess,
 }
 
 def to_yaml(processes, indent=""):
@@ -210,8 +212,19 @@ class Script(Process):
             raise QpException("Unknown mode: %s" % mode)
 
     def cancel(self):
-        if self._current_process is not None:
-            self._current_process.cancel()
+        """
+        Cancel the script, including the currently running process. No further
+        processes or cases are started
+        """
+        if self.status == Process.RUNNING:
+            # Set status first so the script does not move on to the next process
+            # when the current one reports that it has been cancelled
+            self.status = Process.CANCELLED
+            if self._current_process is not None:
+                self._current_process.cancel()
+            self._current_process = None
+            self._current_params = None
+        self._complete()
     
     def _load_yaml(self, root=None):
         """